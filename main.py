@@ -1,23 +1,41 @@
 import os
 import asyncio
+import bisect
+import heapq
+import itertools
+import threading
+import time
+from collections import defaultdict, OrderedDict, deque
 from datetime import datetime, timedelta
+from functools import partial
 import traceback
-from typing import Optional, List, Dict
+import tracemalloc
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, NamedTuple, Tuple
 import json
+import gzip
+import hashlib
+import secrets
 
+import numpy as np
 import pandas as pd
 from pydantic import BaseModel, Field as PydanticField
-from fastapi import FastAPI, HTTPException, Query, Path, BackgroundTasks, Depends, Header
+from fastapi import FastAPI, HTTPException, Query, Path, BackgroundTasks, Depends, Header, Request, Response, WebSocket
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
-from sqlalchemy import func
-from sqlmodel import Relationship, SQLModel, Field, create_engine, Session, select, delete
+import websockets
+from sqlalchemy import Index, UniqueConstraint, case, func, insert, inspect as sa_inspect, or_, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Relationship, SQLModel, Field, create_engine, Session, select, delete, update
 import yfinance as yf
 
 import firebase_admin
 from firebase_admin import credentials, messaging
 from dotenv import load_dotenv
-from sqlalchemy.orm import joinedload
 
 # ----------------------
 # .env, Config ve Firebase
@@ -34,6 +52,8 @@ if not CRON_SECRET_KEY:
 
 FINNHUB_API_KEY = os.getenv("FINNHUB_API_KEY")
 FINNHUB_BASE = "https://finnhub.io/api/v1"
+BINANCE_BASE = "https://api.binance.com/api/v3"
+YAHOO_BASE = os.getenv("YAHOO_BASE", "https://query1.finance.yahoo.com")
 
 # Firebase initialization
 firebase_json_str = os.getenv("FIREBASE_JSON")
@@ -43,12 +63,25 @@ if not firebase_json_str:
 cred_dict = json.loads(firebase_json_str)
 cred_dict["private_key"] = cred_dict["private_key"].replace("\\n", "\n").replace("\r", "")
 
+# Alarm değerlendirme modu: "index" (sıralı eşik indeksi) veya "numpy" (vektörel tarama)
+ALERT_EVAL_MODE = os.getenv("ALERT_EVAL_MODE", "index").lower()
+
 PLAN_LIMITS = {
     "free": 5,
     "pro": 20,
     "ultra": float('inf') # float('inf') sonsuz anlamına gelir, yani limitsiz.
 }
 
+# Planlara göre alarm kontrol sıklığı. Tanınmayan planlar free aralığıyla kontrol edilir.
+PLAN_CHECK_INTERVALS = {
+    "free": timedelta(minutes=10),
+    "pro": timedelta(minutes=3),
+    "ultra": timedelta(minutes=1),
+}
+
+def plan_check_interval(plan: Optional[str]) -> timedelta:
+    return PLAN_CHECK_INTERVALS.get(plan, PLAN_CHECK_INTERVALS["free"])
+
 if not firebase_admin._apps:
     cred = credentials.Certificate(cred_dict)
     firebase_admin.initialize_app(cred)
@@ -63,7 +96,59 @@ if not DB_URL:
 if DB_URL.startswith("postgres://"):
     DB_URL = DB_URL.replace("postgres://", "postgresql://", 1)
 
-engine = create_engine(DB_URL, echo=False)
+# Bağlantı havuzu ayarları (SQLite'ta kullanılmaz).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# Postgres tarafında tek bir sorgunun çalışabileceği en uzun süre (0 = sınırsız).
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+def _engine_options(url: str, async_driver: bool = False) -> Dict:
+    if url.startswith("sqlite"):
+        return {}
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        if async_driver:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+engine = create_engine(DB_URL, echo=False, **_engine_options(DB_URL))
+
+# Açıkken async endpoint'lerin sorguları asyncpg üzerinden çalışır ve event loop'u bloklamaz.
+# Kapalıyken aynı sorgular threadpool'da senkron motorla çalıştırılır.
+DB_ASYNC_ENABLED = os.getenv("DB_ASYNC_ENABLED", "0") == "1"
+async_engine = None
+if DB_ASYNC_ENABLED:
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    ASYNC_DB_URL = os.getenv("ASYNC_DATABASE_URL") or DB_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+    async_engine = create_async_engine(ASYNC_DB_URL, echo=False, **_engine_options(ASYNC_DB_URL, async_driver=True))
+
+def _run_with_session(fn, *args):
+    with Session(engine, expire_on_commit=False) as session:
+        return fn(session, *args)
+
+async def run_db(fn, *args):
+    """
+    `fn(session, *args)`'ı event loop'u bloklamadan çalıştırır ve sonucunu döndürür.
+    Async motor açıksa AsyncSession.run_sync ile, değilse threadpool'da çalışır.
+    Dönen nesneler commit sonrası expire edilmez, session kapandıktan sonra da okunabilir.
+    """
+    if async_engine is not None:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            return await session.run_sync(fn, *args)
+    return await run_in_threadpool(_run_with_session, fn, *args)
 
 # ----------------------
 # --- YENİ CACHE MEKANİZMASI ---
@@ -73,13 +158,560 @@ _prices_cache: Dict = {
     "base_data": {"timestamp": None, "data": None},
     "metals_data": {}  
 }
-_prices_cache_lock = asyncio.Lock()
 CACHE_DURATION = timedelta(seconds=30) # Cache'in 30 saniye geçerli olmasını sağlar
+# Bu süreden eski bir segment hiçbir koşulda sunulmaz; yenilenmesi beklenir.
+PRICES_MAX_STALENESS = timedelta(seconds=int(os.getenv("PRICES_MAX_STALENESS_SECONDS", "300")))
+# Son okunmasının üzerinden bu kadar geçen segmentler arka planda yenilenmez (API kotası boşa harcanmasın).
+PRICES_IDLE_TIMEOUT = timedelta(minutes=int(os.getenv("PRICES_IDLE_TIMEOUT_MINUTES", "5")))
+PRICES_REFRESH_POLL_SECONDS = float(os.getenv("PRICES_REFRESH_POLL_SECONDS", "5"))
+
+# asyncio kilitleri, Python 3.9'da oluşturuldukları event loop'a bağlanır.
+# Bu yüzden yeni kilitler ilk kullanıldıkları anda (çalışan loop içinde) oluşturulur.
+_async_locks: Dict[str, asyncio.Lock] = {}
+
+def get_async_lock(name: str) -> asyncio.Lock:
+    lock = _async_locks.get(name)
+    if lock is None:
+        lock = _async_locks[name] = asyncio.Lock()
+    return lock
+
+# Uygulama ömrü boyunca çalışan arka plan görevleri (lifespan'de başlatılır, kapanışta iptal edilir).
+_background_tasks: Dict[str, asyncio.Task] = {}
+
+def start_background_task(name: str, coro_fn):
+    task = _background_tasks.get(name)
+    if task is None or task.done():
+        _background_tasks[name] = asyncio.create_task(coro_fn())
+
+async def stop_background_tasks():
+    tasks = list(_background_tasks.values())
+    _background_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ----------------------
+# Paylaşılan HTTP İstemcileri
+# Her sağlayıcı için uygulama ömrü boyunca yaşayan, keep-alive ve HTTP/2 destekli tek bir istemci.
+# Böylece her çağrıda yeniden TCP/TLS kurulumu yapılmaz.
+# ----------------------
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+PROVIDER_CONFIG = {
+    "finnhub": {
+        "base_url": FINNHUB_BASE,
+        "timeout": 10,
+        "concurrency": int(os.getenv("FINNHUB_CONCURRENCY", "10")),
+        # Ücretsiz plan dakikada 60 çağrıya izin verir.
+        "rate_per_minute": float(os.getenv("FINNHUB_RATE_PER_MINUTE", "60")),
+        "burst": float(os.getenv("FINNHUB_BURST", "10")),
+    },
+    "binance": {
+        "base_url": BINANCE_BASE,
+        "timeout": 15,
+        "concurrency": int(os.getenv("BINANCE_CONCURRENCY", "10")),
+        # Binance limiti istek sayısı değil, dakikalık "weight" toplamıdır (istek başına weight provider_get'e verilir).
+        "rate_per_minute": float(os.getenv("BINANCE_WEIGHT_PER_MINUTE", "1200")),
+        "burst": float(os.getenv("BINANCE_BURST", "200")),
+    },
+    "yahoo": {
+        "base_url": YAHOO_BASE,
+        "timeout": 5,
+        "concurrency": int(os.getenv("YAHOO_CONCURRENCY", "10")),
+        "rate_per_minute": float(os.getenv("YAHOO_RATE_PER_MINUTE", "600")),
+        "burst": float(os.getenv("YAHOO_BURST", "120")),
+        # Yahoo, tarayıcı olmayan User-Agent'ları reddedebiliyor.
+        "headers": {"User-Agent": "Mozilla/5.0"},
+    },
+}
+
+# provider_get öncelikleri (küçük olan önce). Alarm kontrolleri, isim aramaları gibi arka plan işlerinin önüne geçer.
+PRIORITY_ALERTS = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKGROUND = 2
+# Açıkça öncelik verilmeyen çağrılar bu değişkenden okur; böylece alarm turunun içinden (cache üzerinden bile)
+# yapılan upstream çağrıları alarm önceliğini miras alır.
+provider_priority: ContextVar[int] = ContextVar("provider_priority", default=PRIORITY_DEFAULT)
+# 429 sonrası Retry-After kadar beklenip en fazla bu kadar tekrar denenir.
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "2"))
+PROVIDER_DEFAULT_RETRY_AFTER = 1.0
+
+class ProviderRateLimiter:
+    """
+    Sağlayıcı başına token bucket. Token yoksa istekler (öncelik, geliş sırası) ile kuyruğa girer ve
+    token biriktikçe sırayla bırakılır. 429 alındığında Retry-After süresince hiç token verilmez.
+    """
+    def __init__(self, rate_per_minute: float, burst: float):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters: list = []  # [(öncelik, sıra, maliyet, future)] min-heap
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.stats = {"granted": 0, "queued": 0, "max_queue_depth": 0, "rate_limited": 0, "retries": 0, "merged": 0}
+
+    def _take(self, cost: float, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until or self.tokens < cost:
+            return False
+        self.tokens -= cost
+        self.stats["granted"] += 1
+        return True
+
+    def _dispatch(self):
+        self._timer = None
+        now = time.monotonic()
+        while self._waiters:
+            _, _, cost, future = self._waiters[0]
+            if future.done():  # iptal edilmiş bekleyen
+                heapq.heappop(self._waiters)
+                continue
+            if not self._take(cost, now):
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+        if self._waiters and self._timer is None:
+            cost = self._waiters[0][2]
+            delay = max(self.blocked_until - now, (cost - self.tokens) / self.rate, 0.001)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int, cost: float = 1.0):
+        cost = min(cost, self.burst)
+        if not self._waiters and self._take(cost, time.monotonic()):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), cost, future))
+        self.stats["queued"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._waiters))
+        self._dispatch()
+        await future
+
+    def block_for(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.stats["rate_limited"] += 1
+
+def parse_retry_after(value: Optional[str]) -> float:
+    if not value:
+        return PROVIDER_DEFAULT_RETRY_AFTER
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        retry_at = parsedate_to_datetime(value)
+        return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return PROVIDER_DEFAULT_RETRY_AFTER
+
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+_provider_semaphores: Dict[str, asyncio.Semaphore] = {}
+_provider_limiters: Dict[str, ProviderRateLimiter] = {}
+# Aynı (sağlayıcı, path, parametreler) için süren istek varsa yenisi atılmaz, sonucu paylaşılır.
+_provider_inflight: Dict[tuple, asyncio.Task] = {}
+
+def get_http_client(provider: str) -> httpx.AsyncClient:
+    """Sağlayıcının paylaşılan istemcisini döndürür; henüz yoksa (örn. lifespan dışında) oluşturur."""
+    client = _http_clients.get(provider)
+    if client is None or client.is_closed:
+        config = PROVIDER_CONFIG[provider]
+        client = httpx.AsyncClient(
+            base_url=config["base_url"],
+            timeout=config["timeout"],
+            headers=config.get("headers"),
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _http_clients[provider] = client
+        # Semafor, istemciyle aynı event loop içinde oluşturulur.
+        _provider_semaphores[provider] = asyncio.Semaphore(config["concurrency"])
+        if provider not in _provider_limiters:
+            _provider_limiters[provider] = ProviderRateLimiter(config["rate_per_minute"], config["burst"])
+    return client
+
+def open_http_clients():
+    for provider in PROVIDER_CONFIG:
+        get_http_client(provider)
+
+async def close_http_clients():
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    _provider_semaphores.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+
+async def provider_get(
+    provider: str,
+    path: str,
+    params: Optional[Dict] = None,
+    priority: Optional[int] = None,
+    weight: float = 1.0,
+) -> httpx.Response:
+    """
+    Sağlayıcıya paylaşılan istemciyle GET isteği atar. Her çağrı sağlayıcının token bucket'ından
+    `weight` kadar token bekler (öncelik sırasıyla) ve eşzamanlılık semaforu altında çalışır.
+    Aynı istek zaten sürüyorsa ona katılır. 429'da Retry-After kadar tüm sağlayıcı durdurulur ve tekrar denenir.
+    """
+    key = (provider, path, tuple(sorted((params or {}).items())))
+    task = _provider_inflight.get(key)
+    if task is not None:
+        _provider_limiters[provider].stats["merged"] += 1
+    else:
+        # İstek kendi task'ında çalışır; ilk çağıran iptal edilse bile ona katılanlar cevabı alır.
+        task = asyncio.create_task(_provider_request(provider, path, params, priority, weight))
+        _provider_inflight[key] = task
+        task.add_done_callback(partial(_provider_request_done, key))
+    return await asyncio.shield(task)
+
+def _provider_request_done(key: tuple, task: asyncio.Task):
+    if _provider_inflight.get(key) is task:
+        del _provider_inflight[key]
+    if not task.cancelled():
+        task.exception()  # bekleyen kalmadıysa "never retrieved" uyarısı verilmesin
+
+async def _provider_request(provider: str, path: str, params: Optional[Dict], priority: Optional[int], weight: float) -> httpx.Response:
+    client = get_http_client(provider)
+    limiter = _provider_limiters[provider]
+    priority = provider_priority.get() if priority is None else priority
+    for attempt in range(PROVIDER_MAX_RETRIES + 1):
+        await limiter.acquire(priority, weight)
+        async with _provider_semaphores[provider]:
+            response = await client.get(path, params=params)
+        if response.status_code != 429:
+            return response
+        retry_after = parse_retry_after(response.headers.get("retry-after"))
+        limiter.block_for(retry_after)
+        print(f"{provider}: 429 alındı, {retry_after:.1f} sn bekleniyor ({path}, deneme {attempt + 1}).")
+        if attempt < PROVIDER_MAX_RETRIES:
+            limiter.stats["retries"] += 1
+    return response
+
+# ----------------------
+# yfinance Executor
+# yfinance ve pandas işleri event loop'u bloklamasın diye boyutu sınırlı, ayrı bir havuzda çalışır.
+# Zaman aşımına uğrayan çağrının thread'i arka planda bitene kadar havuzda bir yer tutmaya devam eder;
+# havuzun sınırlı olması bu yüzden önemlidir.
+# ----------------------
+YF_MAX_WORKERS = int(os.getenv("YF_MAX_WORKERS", "4"))
+YF_CALL_TIMEOUT = float(os.getenv("YF_CALL_TIMEOUT_SECONDS", "20"))
+
+_yf_executor = ThreadPoolExecutor(max_workers=YF_MAX_WORKERS, thread_name_prefix="yfinance")
+_yf_stats = {"queued": 0, "running": 0, "completed": 0, "failed": 0, "timeouts": 0, "max_queue_depth": 0}
+_yf_stats_lock = threading.Lock()
+
+def _yf_stats_update(**deltas):
+    with _yf_stats_lock:
+        for key, delta in deltas.items():
+            _yf_stats[key] += delta
+        _yf_stats["max_queue_depth"] = max(_yf_stats["max_queue_depth"], _yf_stats["queued"])
+
+async def run_yf(fn, *args, timeout: float = YF_CALL_TIMEOUT):
+    """Bir yfinance/pandas işini yfinance havuzunda, zaman aşımıyla çalıştırır."""
+    def job():
+        _yf_stats_update(queued=-1, running=1)
+        try:
+            return fn(*args)
+        finally:
+            _yf_stats_update(running=-1)
+
+    _yf_stats_update(queued=1)
+    future = asyncio.get_running_loop().run_in_executor(_yf_executor, job)
+    try:
+        result = await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        _yf_stats_update(timeouts=1)
+        raise
+    except Exception:
+        _yf_stats_update(failed=1)
+        raise
+    _yf_stats_update(completed=1)
+    return result
+
+def _yf_download_close(tickers: List[str]):
+    return yf.download(tickers, period="1d", progress=False, auto_adjust=True)['Close']
+
+def _yf_download_last_closes(tickers: List[str]) -> Dict[str, float]:
+    # İndirme ve ayrıştırma aynı havuz işinde yapılır; event loop'a DataFrame değil küçük bir sözlük döner.
+    data = _yf_download_close(tickers)
+    if data is None or data.empty:
+        return {}
+    return _yf_last_closes(data, tickers)
+
+def _yf_last_closes(data, tickers: List[str]) -> Dict[str, float]:
+    """Kapanış verisinden her ticker'ın son geçerli fiyatını çıkarır."""
+    closes = {}
+    # yfinance'tan gelen sonuç tek bir sembol içinse Series, çoklu ise DataFrame olur.
+    if isinstance(data, pd.Series):
+        series = data.dropna()
+        if not series.empty:
+            closes[tickers[0]] = float(series.iloc[-1])
+        return closes
+    for ticker in tickers:
+        if ticker in data:
+            series = data[ticker].dropna()
+            if not series.empty:
+                closes[ticker] = float(series.iloc[-1])
+    return closes
+
+async def yf_last_closes(tickers: List[str]) -> Dict[str, float]:
+    """Verilen ticker'lar için tek bir yf.download ile son kapanış fiyatlarını döndürür."""
+    if not tickers:
+        return {}
+    return await run_yf(_yf_download_last_closes, tickers)
+
+# ----------------------
+# Yahoo Chart İstemcisi
+# Son fiyat için yfinance'ın thread'lerini ve pandas DataFrame'lerini kullanmak yerine Yahoo'nun chart
+# verisi paylaşılan "yahoo" istemcisiyle (hız sınırı ve eşzamanlılık limiti altında) doğrudan okunur.
+# Ticker başına v8 chart isteği atmak yerine çoklu sembol kabul eden v7 spark endpoint'i kullanılır;
+# BIST'in ~74 ticker'ı böylece 4 istekte gelir. Sadece gereken alan ayrıştırılır.
+# Yahoo'dan alınamayan ticker'lar için yfinance yedek olarak kalır.
+# ----------------------
+YAHOO_CHART_ENABLED = os.getenv("YAHOO_CHART_ENABLED", "1") == "1"
+# Spark endpoint'i istek başına en fazla 20 sembol kabul ediyor.
+YAHOO_SPARK_BATCH_SIZE = int(os.getenv("YAHOO_SPARK_BATCH_SIZE", "20"))
+
+def _yahoo_chart_result_price(result: Dict) -> Optional[float]:
+    """Tek bir chart sonucundan son fiyatı okur: önce meta.regularMarketPrice, yoksa son geçerli kapanış."""
+    price = (result.get("meta") or {}).get("regularMarketPrice")
+    if price is None:
+        quotes = (result.get("indicators") or {}).get("quote") or [{}]
+        closes = [close for close in quotes[0].get("close") or [] if close is not None]
+        price = closes[-1] if closes else None
+    return float(price) if price is not None else None
+
+def parse_yahoo_spark_prices(payload: Dict) -> Dict[str, float]:
+    """
+    Spark cevabını {ticker: son fiyat} sözlüğüne çevirir. Hem {"spark": {"result": [...]}} biçimini
+    hem de eski {ticker: {"close": [...]}} biçimini okur; fiyatı olmayan ticker'lar atlanır.
+    """
+    prices = {}
+    spark = (payload or {}).get("spark")
+    if isinstance(spark, dict):
+        for item in spark.get("result") or []:
+            responses = item.get("response") or []
+            price = _yahoo_chart_result_price(responses[0]) if responses else None
+            if item.get("symbol") and price is not None:
+                prices[item["symbol"]] = price
+        return prices
+    for ticker, item in (payload or {}).items():
+        if not isinstance(item, dict):
+            continue
+        closes = [close for close in item.get("close") or [] if close is not None]
+        if closes:
+            prices[ticker] = float(closes[-1])
+    return prices
+
+async def yahoo_spark_last_prices(tickers: List[str]) -> Dict[str, float]:
+    """Ticker'ları YAHOO_SPARK_BATCH_SIZE'lık gruplar halinde (eşzamanlı) çeker; sadece fiyatı gelenler döner."""
+    if not tickers:
+        return {}
+    batches = [tickers[i:i + YAHOO_SPARK_BATCH_SIZE] for i in range(0, len(tickers), YAHOO_SPARK_BATCH_SIZE)]
+    responses = await asyncio.gather(
+        *(provider_get("yahoo", "/v7/finance/spark", params={"symbols": ",".join(batch), "range": "1d", "interval": "1d"}) for batch in batches),
+        return_exceptions=True,
+    )
+    prices = {}
+    for batch, r in zip(batches, responses):
+        if isinstance(r, BaseException) or r.status_code != 200:
+            continue
+        try:
+            batch_prices = parse_yahoo_spark_prices(r.json())
+        except ValueError:
+            continue
+        # Sadece istenen ticker'lar alınır.
+        prices.update({ticker: batch_prices[ticker] for ticker in batch if ticker in batch_prices})
+    return prices
+
+async def yahoo_last_closes(tickers: List[str]) -> Dict[str, float]:
+    """Son fiyatları Yahoo chart istemcisiyle çeker; eksik kalanlar tek bir yf.download ile tamamlanır."""
+    closes: Dict[str, float] = {}
+    if YAHOO_CHART_ENABLED and quote_source_health("yahoo").allow():
+        closes = await yahoo_spark_last_prices(tickers)
+    missing = [ticker for ticker in tickers if ticker not in closes]
+    if missing:
+        closes.update(await yf_last_closes(missing))
+    return closes
+
+# ----------------------
+# Birleşik Fiyat Cache'i
+# /prices, fetch_price (alarm oluşturma/düzenleme) ve run_price_checks aynı (piyasa, sembol) cache'inden okur.
+# - Piyasa bazlı TTL
+# - Aynı anda gelen ıskalamalar tek bir upstream çağrısında birleştirilir (single-flight)
+# - Süresi geçmiş değer, arka planda yenilenirken bir süre daha sunulabilir (stale-while-revalidate)
+# - LRU ile boyut sınırı
+# ----------------------
+QUOTE_TTLS = {
+    "BIST": float(os.getenv("QUOTE_TTL_SECONDS_BIST", "30")),
+    "NASDAQ": float(os.getenv("QUOTE_TTL_SECONDS_NASDAQ", "30")),
+    "CRYPTO": float(os.getenv("QUOTE_TTL_SECONDS_CRYPTO", "10")),
+    "METALS": float(os.getenv("QUOTE_TTL_SECONDS_METALS", "60")),
+}
+QUOTE_MAX_STALE_SECONDS = float(os.getenv("QUOTE_MAX_STALE_SECONDS", "300"))
+QUOTE_CACHE_MAX_ENTRIES = int(os.getenv("QUOTE_CACHE_MAX_ENTRIES", "5000"))
+
+class QuoteCache:
+    def __init__(self, ttls: Dict[str, float], max_stale: float, max_entries: int):
+        self.ttls = ttls
+        self.max_stale = max_stale
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()   # (market, symbol) -> (fiyat, monotonic zaman)
+        # Son upstream çekiminde yeni değeri gelmeyen, son bilinen değeri sunulan anahtarlar.
+        self._failed: set = set()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._tasks: set = set()
+        # Her başarılı upstream çekiminden sonra listener(market, {sembol: fiyat}, unix zamanı) çağrılır.
+        self.listeners: List = []
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "upstream_calls": 0, "evictions": 0}
+
+    def _ttl(self, market: str) -> float:
+        return self.ttls.get(market, 30.0)
+
+    def peek(self, market: str, symbol: str) -> Optional[float]:
+        """Yaşına bakmadan cache'teki son değeri döndürür (upstream çağrısı yapmaz)."""
+        entry = self._entries.get((market, symbol))
+        return entry[0] if entry else None
+
+    def stale_symbols(self, market: str, symbols) -> set:
+        """
+        Son upstream çekimi başarısız olduğu için son bilinen değeri sunulan sembolleri döndürür.
+        Sadece TTL'i geçmiş (arka planda yenilenen) değerler stale sayılmaz.
+        """
+        return {symbol for symbol in symbols if (market, symbol) in self._failed}
+
+    def _store(self, market: str, symbol: str, price: float, fetched_at: float):
+        key = (market, symbol)
+        self._entries[key] = (price, fetched_at)
+        self._entries.move_to_end(key)
+        self._failed.discard(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._failed.discard(evicted)
+            self.stats["evictions"] += 1
+
+    def _start_fetch(self, market: str, symbols: List[str], fetcher) -> Dict[str, asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for symbol in symbols:
+            future = loop.create_future()
+            self._inflight[(market, symbol)] = future
+            futures[symbol] = future
+        task = asyncio.create_task(self._run_fetch(market, futures, fetcher))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return futures
+
+    async def _run_fetch(self, market: str, futures: Dict[str, asyncio.Future], fetcher):
+        self.stats["upstream_calls"] += 1
+        try:
+            prices = await fetcher(set(futures))
+        except Exception as e:
+            print(f"Fiyat cache'i: {market} için upstream hatası: {e}")
+            prices = {}
+        fetched_at = time.monotonic()
+        fresh = {}
+        for symbol, future in futures.items():
+            price = prices.get(symbol)
+            if price is not None:
+                self._store(market, symbol, price, fetched_at)
+                fresh[symbol] = price
+            else:
+                # Yeni değer gelmediyse varsa son bilinen değer kullanılır ve stale olarak işaretlenir.
+                price = self.peek(market, symbol)
+                if price is not None:
+                    self._failed.add((market, symbol))
+            self._inflight.pop((market, symbol), None)
+            if not future.done():
+                future.set_result(price)
+        if fresh:
+            wall_time = time.time()
+            for listener in self.listeners:
+                try:
+                    listener(market, fresh, wall_time)
+                except Exception as e:
+                    print(f"Fiyat cache'i: listener hatası: {e}")
+
+    async def get_many(self, market: str, symbols, fetcher, allow_stale: bool = True) -> Dict[str, Optional[float]]:
+        """
+        Sembollerin fiyatlarını cache'ten döndürür. Eksik olanlar tek bir fetcher(set) çağrısıyla çekilir;
+        fetcher, fetch_*_batch fonksiyonlarıyla aynı imzaya sahiptir.
+        """
+        now = time.monotonic()
+        ttl = self._ttl(market)
+        result: Dict[str, Optional[float]] = {}
+        to_fetch, to_refresh = [], []
+        waiting: Dict[str, asyncio.Future] = {}
+
+        for symbol in dict.fromkeys(symbols):
+            key = (market, symbol)
+            entry = self._entries.get(key)
+            if entry:
+                age = now - entry[1]
+                if age < ttl:
+                    self.stats["hits"] += 1
+                    self._entries.move_to_end(key)
+                    result[symbol] = entry[0]
+                    continue
+                if allow_stale and age < ttl + self.max_stale:
+                    self.stats["stale_hits"] += 1
+                    result[symbol] = entry[0]
+                    if key not in self._inflight:
+                        to_refresh.append(symbol)
+                    continue
+            if key in self._inflight:
+                self.stats["coalesced"] += 1
+                waiting[symbol] = self._inflight[key]
+            else:
+                self.stats["misses"] += 1
+                to_fetch.append(symbol)
+
+        if to_refresh:
+            self._start_fetch(market, to_refresh, fetcher)
+        if to_fetch:
+            waiting.update(self._start_fetch(market, to_fetch, fetcher))
+        if waiting:
+            # shield: bekleyen istek iptal edilirse paylaşılan future iptal olmasın.
+            values = await asyncio.gather(*(asyncio.shield(f) for f in waiting.values()))
+            result.update(zip(waiting.keys(), values))
+        return result
+
+quote_cache = QuoteCache(QUOTE_TTLS, QUOTE_MAX_STALE_SECONDS, QUOTE_CACHE_MAX_ENTRIES)
 
 # ----------------------
 # FastAPI Uygulaması
 # ----------------------
-app = FastAPI(title="MarketWatcher Backend")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    on_startup()
+    open_http_clients()
+    start_background_task("prices_refresh", prices_refresh_loop)
+    if CRYPTO_STREAM_ENABLED:
+        start_background_task("crypto_stream", crypto_stream_loop)
+    if PRICE_CHECK_SCHEDULER_ENABLED:
+        start_background_task("price_check_scheduler", price_check_scheduler_loop)
+    if PRICE_HISTORY_ENABLED:
+        start_background_task("price_history_flush", price_history_flush_loop)
+    start_background_task("symbol_catalog_refresh", symbol_catalog_refresh_loop)
+    yield
+    await stop_background_tasks()
+    if PRICE_HISTORY_ENABLED:
+        await flush_price_history()
+    await close_http_clients()
+    # Kuyrukta bekleyen yfinance işleri kapanışı geciktirmesin.
+    _yf_executor.shutdown(wait=False, cancel_futures=True)
+    if async_engine is not None:
+        await async_engine.dispose()
+
+app = FastAPI(title="MarketWatcher Backend", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -106,6 +738,25 @@ class Alert(SQLModel, table=True):
 
     user: "User" = Relationship(back_populates="alerts")
 
+class PriceHistory(SQLModel, table=True):
+    __table_args__ = (Index("ix_pricehistory_market_symbol_ts", "market", "symbol", "ts"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    market: str
+    symbol: str
+    ts: datetime = Field(index=True)
+    price: float
+
+class SymbolCatalog(SQLModel, table=True):
+    __table_args__ = (UniqueConstraint("market", "symbol", name="uq_symbolcatalog_market_symbol"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    market: str = Field(index=True)
+    symbol: str
+    name: str
+    provider_ticker: str
+    active: bool = Field(default=True)
+    rank: int = Field(default=0)  # listedeki sıra (NASDAQ listesi sırası, kripto için hacim sırası)
+    updated_at: Optional[datetime] = Field(default=None)  # kaynaktan son yenilenme; NULL ise hiç yenilenmedi
+
 class AlertCreate(SQLModel):
     market: str
     symbol: str
@@ -121,6 +772,8 @@ class User(UserSettings, table=True):
     fcm_token: Optional[str] = Field(default=None, index=True)
     plan: str = Field(default="free", index=True) # free, pro, ultra
     last_checked_at: Optional[datetime] = Field(default=None)
+    # Bir sonraki alarm kontrolünün zamanı; NULL ise kullanıcı hemen kontrol edilir.
+    next_check_at: Optional[datetime] = Field(default=None, index=True)
 
     alerts: List["Alert"] = Relationship(back_populates="user")
 
@@ -129,10 +782,143 @@ class User(UserSettings, table=True):
 # ----------------------------
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    ensure_schema_columns()
+
+# create_all mevcut tablolara sonradan eklenen kolonları eklemez ve projede migration aracı yok.
+# Eksik kolonlar (ve indeksleri) başlangıçta burada eklenir. (tablo, kolon, SQL tipi)
+SCHEMA_ADDED_COLUMNS = [
+    ("user", "next_check_at", "TIMESTAMP"),
+]
+
+def ensure_schema_columns():
+    inspector = sa_inspect(engine)
+    with engine.begin() as conn:
+        for table, column, sql_type in SCHEMA_ADDED_COLUMNS:
+            existing = {col["name"] for col in inspector.get_columns(table)}
+            if column in existing:
+                continue
+            # Aynı anda başlayan worker'lardan biri kolonu önce eklemiş olabilir; Postgres'te IF NOT EXISTS
+            # ile kaybeden worker hata almaz. SQLite bu sözdizimini desteklemez (tek process'le kullanılır).
+            if_not_exists = "IF NOT EXISTS " if engine.dialect.name == "postgresql" else ""
+            conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {if_not_exists}{column} {sql_type}'))
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON "{table}" ({column})'))
+            print(f"Şema güncellendi: {table}.{column} kolonu eklendi.")
 
-@app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+    alert_index_rebuild()
+    _run_with_session(seed_symbol_catalog)
+    _run_with_session(load_symbol_catalog)
+
+# ----------------------------
+# Alarm Eşik İndeksi
+# ----------------------------
+# Her (piyasa, sembol) çiftinin alarmları üst ve alt limitlerine göre sıralı iki listede tutulur.
+# Piyasa anahtarın parçasıdır; farklı piyasalarda aynı adı taşıyan semboller birbirini tetiklemez.
+# Fiyat geldiğinde bisect ile doğrudan tetiklenen aralığa atlanır, böylece bir kontrol
+# turunun maliyeti toplam alarm sayısıyla değil, tetiklenen alarm sayısıyla orantılı olur.
+class IndexedAlert(NamedTuple):
+    id: int
+    user_uid: str
+    market: str
+    symbol: str
+    percentage: float
+    upper_limit: float
+    lower_limit: float
+
+_alert_index: Dict[tuple, Dict[str, list]] = {}  # (MARKET, symbol) -> {"upper": [(limit, id)], "lower": [(limit, id)]}
+_alert_index_entries: Dict[int, IndexedAlert] = {}
+# Aktif CRYPTO alarmlarının Binance akış adları -> alarm sayısı. Ekleme/silme ile güncellenir;
+# kripto akışının abonelikleri tüm alarmları taramadan buradan okunur.
+_alert_index_crypto_streams: Dict[str, int] = {}
+# Senkron endpoint'ler threadpool'da çalıştığı için indeks bir thread kilidiyle korunur.
+_alert_index_lock = threading.Lock()
+
+def crypto_stream_name(symbol: str) -> str:
+    """Alarm sembolünün ("BTCUSDT" ya da eski kayıtlardaki "BTC") miniTicker akış adı."""
+    binance_symbol = symbol if symbol.endswith("USDT") else f"{symbol}USDT"
+    return f"{binance_symbol.lower()}@miniTicker"
+
+def _alert_index_key(entry: IndexedAlert) -> tuple:
+    # Piyasa eski kayıtlarda küçük harfle saklanmış olabilir.
+    return (entry.market.upper(), entry.symbol)
+
+def _alert_index_insert(entry: IndexedAlert):
+    buckets = _alert_index.setdefault(_alert_index_key(entry), {"upper": [], "lower": []})
+    bisect.insort(buckets["upper"], (entry.upper_limit, entry.id))
+    bisect.insort(buckets["lower"], (entry.lower_limit, entry.id))
+    _alert_index_entries[entry.id] = entry
+    if entry.market.upper() == "CRYPTO":
+        stream = crypto_stream_name(entry.symbol)
+        _alert_index_crypto_streams[stream] = _alert_index_crypto_streams.get(stream, 0) + 1
+
+def _alert_index_discard(alert_id: int):
+    entry = _alert_index_entries.pop(alert_id, None)
+    if entry is None:
+        return
+    if entry.market.upper() == "CRYPTO":
+        stream = crypto_stream_name(entry.symbol)
+        if _alert_index_crypto_streams.get(stream, 0) <= 1:
+            _alert_index_crypto_streams.pop(stream, None)
+        else:
+            _alert_index_crypto_streams[stream] -= 1
+    buckets = _alert_index.get(_alert_index_key(entry))
+    if not buckets:
+        return
+    for key, limit in (("upper", entry.upper_limit), ("lower", entry.lower_limit)):
+        items = buckets[key]
+        pos = bisect.bisect_left(items, (limit, entry.id))
+        if pos < len(items) and items[pos] == (limit, entry.id):
+            del items[pos]
+    if not buckets["upper"]:
+        del _alert_index[_alert_index_key(entry)]
+
+def alert_index_add(alert: Alert):
+    """Commit edilmiş bir alarmı indekse ekler; aynı ID varsa önce eskisini çıkarır (PUT)."""
+    entry = IndexedAlert(
+        id=alert.id,
+        user_uid=alert.user_uid,
+        market=alert.market,
+        symbol=alert.symbol,
+        percentage=alert.percentage,
+        upper_limit=alert.upper_limit,
+        lower_limit=alert.lower_limit,
+    )
+    with _alert_index_lock:
+        _alert_index_discard(entry.id)
+        _alert_index_insert(entry)
+
+def alert_index_remove(alert_ids):
+    with _alert_index_lock:
+        for alert_id in alert_ids:
+            _alert_index_discard(alert_id)
+
+def alert_index_rebuild():
+    """İndeksi Alert tablosundan sıfırdan oluşturur (uygulama açılışında çağrılır)."""
+    with Session(engine) as session:
+        rows = session.exec(select(
+            Alert.id, Alert.user_uid, Alert.market, Alert.symbol,
+            Alert.percentage, Alert.upper_limit, Alert.lower_limit
+        )).all()
+    with _alert_index_lock:
+        _alert_index.clear()
+        _alert_index_entries.clear()
+        _alert_index_crypto_streams.clear()
+        for row in rows:
+            _alert_index_insert(IndexedAlert(*row))
+    print(f"Alarm indeksi {len(rows)} alarm ile oluşturuldu.")
+
+def alert_index_triggered(market: str, symbol: str, price: float) -> List[IndexedAlert]:
+    """Piyasadaki sembol için verilen fiyatta tetiklenen alarmları döndürür (upper_limit <= fiyat veya lower_limit >= fiyat)."""
+    with _alert_index_lock:
+        buckets = _alert_index.get((market, symbol))
+        if not buckets:
+            return []
+        upper, lower = buckets["upper"], buckets["lower"]
+        # Üst limiti fiyatın altında kalanlar listenin başında, alt limiti fiyatın üstünde kalanlar sonundadır.
+        hit_ids = [alert_id for _, alert_id in upper[:bisect.bisect_right(upper, (price, float('inf')))]]
+        hit_ids.extend(alert_id for _, alert_id in lower[bisect.bisect_left(lower, (price, float('-inf'))):])
+        return [_alert_index_entries[alert_id] for alert_id in dict.fromkeys(hit_ids)]
 
 class RevenueCatEvent(BaseModel):
     app_user_id: str = PydanticField(..., alias="app_user_id")
@@ -145,6 +931,27 @@ class RevenueCatWebhookPayload(BaseModel):
 # Yeni ortam değişkenini kodun en üstünde diğerleri gibi okuyun
 REVENUECAT_WEBHOOK_TOKEN = os.getenv("REVENUECAT_WEBHOOK_TOKEN")
 
+def apply_user_plan(session: Session, user_uid: str, new_plan: str):
+    user = session.get(User, user_uid)
+    if user:
+        if user.plan != new_plan:
+            user.plan = new_plan
+            # Yükseltmede yeni planın kontrol aralığı beklenmeden uygulanır.
+            earliest = datetime.utcnow() + plan_check_interval(new_plan)
+            if user.next_check_at is None or user.next_check_at > earliest:
+                user.next_check_at = earliest
+            session.add(user)
+            session.commit()
+            user_profile_cache.invalidate(user_uid)
+            schedule_user_check(user_uid, user.next_check_at)
+            print(f"Kullanıcı {user_uid} planı '{new_plan}' olarak güncellendi.")
+        else:
+            print(f"Kullanıcı {user_uid} zaten '{new_plan}' planında. Değişiklik yapılmadı.")
+    else:
+        print(f"Webhook uyarısı: {user_uid} ID'li kullanıcı veritabanında bulunamadı.")
+        # İsteğe bağlı: Bu durumda yeni bir kullanıcı da oluşturabilirsiniz.
+        # Şimdilik sadece logluyoruz.
+
 @app.post("/webhooks/revenuecat")
 async def handle_revenuecat_webhook(
     payload: RevenueCatWebhookPayload, 
@@ -172,21 +979,7 @@ async def handle_revenuecat_webhook(
 
     # 4. Adım: Veritabanındaki kullanıcıyı güncelle
     try:
-        with Session(engine) as session:
-            user = session.get(User, user_uid)
-            if user:
-                if user.plan != new_plan:
-                    user.plan = new_plan
-                    session.add(user)
-                    session.commit()
-                    print(f"Kullanıcı {user_uid} planı '{new_plan}' olarak güncellendi.")
-                else:
-                    print(f"Kullanıcı {user_uid} zaten '{new_plan}' planında. Değişiklik yapılmadı.")
-            else:
-                print(f"Webhook uyarısı: {user_uid} ID'li kullanıcı veritabanında bulunamadı.")
-                # İsteğe bağlı: Bu durumda yeni bir kullanıcı da oluşturabilirsiniz.
-                # Şimdilik sadece logluyoruz.
-    
+        await run_db(apply_user_plan, user_uid, new_plan)
     except Exception as e:
         print(f"RevenueCat webhook işlenirken veritabanı hatası: {e}")
         # Hata durumunda RevenueCat'e başarısız olduğumuzu bildirmeyelim ki
@@ -201,83 +994,127 @@ async def handle_revenuecat_webhook(
 # --- run_price_checks fonksiyonunu bu yeni versiyonla değiştirin ---
 
 # Bu yardımcı fonksiyon, kodu daha temiz tutmak için
-async def check_alerts_for_user(user: User, prices: Dict):
-    # CHANGED: Instead of taking data from the database, we take it from the user object directly.
-    user_alerts = user.alerts
-    if not user_alerts:
+def check_alerts_for_user(user: User, triggered_alerts: List[IndexedAlert], prices: Dict, outbox: Dict[int, messaging.Message]):
+    # Hangi alarmların tetiklendiğine alarm indeksi karar verir; burada sadece bildirim hazırlanır.
+    # Mesajlar gönderilmez, alarm ID'siyle outbox'a eklenir; sadece gerçekten silinen alarmlarınki gönderilir.
+    if not triggered_alerts:
         return []
 
+    lang_code = user.language_code if user.language_code in NOTIFICATION_TEMPLATES else "en"
+    template = NOTIFICATION_TEMPLATES[lang_code]
+
     alerts_to_delete_ids = []
-    for alert in user_alerts:
-        lang_code = user.language_code if user.language_code in NOTIFICATION_TEMPLATES else "en"
-        template = NOTIFICATION_TEMPLATES[lang_code]
-        localized_symbol = METAL_LOCALIZATION_MAP.get(alert.symbol, {}).get(lang_code, alert.symbol)
-        
-        current_price = prices.get(alert.symbol)
+    for alert in triggered_alerts:
+        current_price = prices.get((alert.market.upper(), alert.symbol))
         if current_price is None:
             continue
 
-        if current_price >= alert.upper_limit or current_price <= alert.lower_limit:
-            if user.notifications_enabled and user.fcm_token:
-                is_increase = current_price >= alert.upper_limit
-                direction_text = template["increased"] if is_increase else template["decreased"]
-                
-                title = template["title"].format(symbol=localized_symbol)
-                body = template["body"].format(
-                    symbol=localized_symbol,
-                    percentage=alert.percentage,
-                    direction=direction_text,
-                    price=current_price
-                )
-                send_push_notification(token=user.fcm_token, title=title, body=body)
-            
-            alerts_to_delete_ids.append(alert.id)
+        if user.notifications_enabled and user.fcm_token:
+            localized_symbol = METAL_LOCALIZATION_MAP.get(alert.symbol, {}).get(lang_code, alert.symbol)
+            is_increase = current_price >= alert.upper_limit
+            direction_text = template["increased"] if is_increase else template["decreased"]
+
+            title = template["title"].format(symbol=localized_symbol)
+            body = template["body"].format(
+                symbol=localized_symbol,
+                percentage=alert.percentage,
+                direction=direction_text,
+                price=current_price
+            )
+            outbox[alert.id] = build_push_message(token=user.fcm_token, title=title, body=body)
+
+        alerts_to_delete_ids.append(alert.id)
     return alerts_to_delete_ids
 
+def find_triggered_alerts_indexed(prices: Dict, due_uids: set) -> List[IndexedAlert]:
+    """Her (piyasa, sembol) için indeksten sadece tetiklenen aralığı alır, tüm alarmlar taranmaz."""
+    triggered = []
+    for (market, symbol), price in prices.items():
+        for alert in alert_index_triggered(market, symbol, price):
+            if alert.user_uid in due_uids:
+                triggered.append(alert)
+    return triggered
+
+def find_triggered_alerts_vectorized(session: Session, prices: Dict, due_uids: set) -> List[IndexedAlert]:
+    """
+    Sadece gereken kolonları NumPy dizilerine yükler, sembolleri tek bir gather ile fiyata
+    eşler ve tetiklenme maskesini tek bir dizi işlemiyle hesaplar.
+    """
+    if not due_uids or not prices:
+        return []
+
+    rows = session.exec(
+        select(Alert.id, Alert.user_uid, Alert.market, Alert.symbol, Alert.upper_limit, Alert.lower_limit)
+        .where(Alert.user_uid.in_(due_uids))
+    ).all()
+    if not rows:
+        return []
+
+    ids, _, markets, symbols, uppers, lowers = zip(*rows)
+    ids = np.fromiter(ids, dtype=np.int64, count=len(rows))
+    uppers = np.fromiter(uppers, dtype=np.float64, count=len(rows))
+    lowers = np.fromiter(lowers, dtype=np.float64, count=len(rows))
+
+    # Her alarmın (piyasa, sembol) çiftini benzersiz çiftler tablosundaki indekse çevir, sonra fiyatı tek seferde topla.
+    codes: Dict[tuple, int] = {}
+    symbol_codes = np.fromiter(
+        (codes.setdefault((market.upper(), symbol), len(codes)) for market, symbol in zip(markets, symbols)),
+        dtype=np.int64, count=len(rows),
+    )
+    price_table = np.array([prices.get(key, np.nan) for key in codes], dtype=np.float64)
+    current_prices = price_table[symbol_codes]
+
+    # NaN karşılaştırmaları False döner, yani fiyatı olmayan semboller tetiklenmez.
+    mask = (current_prices >= uppers) | (current_prices <= lowers)
+    triggered_ids = ids[mask].tolist()
+    if not triggered_ids:
+        return []
+
+    # Bildirim için gereken diğer alanlar sadece tetiklenen satırlar için okunur.
+    triggered_rows = session.exec(
+        select(
+            Alert.id, Alert.user_uid, Alert.market, Alert.symbol,
+            Alert.percentage, Alert.upper_limit, Alert.lower_limit
+        ).where(Alert.id.in_(triggered_ids))
+    ).all()
+    return [IndexedAlert(*row) for row in triggered_rows]
+
 # Bu fonksiyonları kodunuzun uygun bir yerine (örn: price_fetcher.py veya main.py'ın üst kısımları) ekleyebilirsiniz.
 # Bunlar, toplu veri çekme işlemini yapacak yardımcı fonksiyonlardır.
 
-async def fetch_bist_batch(symbols: set) -> dict:
-    """Verilen BIST sembol listesi için yfinance'tan toplu fiyat çeker."""
+async def fetch_bist_batch(symbols: set, closes_fn=None) -> dict:
+    """Verilen BIST sembol listesi için (varsayılan olarak yfinance'tan) toplu fiyat çeker."""
     if not symbols:
         return {}
     
     prices = {}
     yf_symbols = [s if s.endswith(".IS") else f"{s}.IS" for s in symbols]
     try:
-        data = yf.download(yf_symbols, period="1d", progress=False, auto_adjust=True)['Close']
-        if data.empty:
-            return {}
-        
-        # yfinance'tan gelen sonuç tek bir sembol içinse Series, çoklu ise DataFrame olur.
-        if isinstance(data, pd.Series): # Tek sembol durumu
-             if not data.dropna().empty:
-                short_symbol = yf_symbols[0].split('.')[0]
-                prices[short_symbol] = round(float(data.dropna().iloc[-1]), 2)
-        else: # Çoklu sembol durumu
-            for yf_symbol in yf_symbols:
-                short_symbol = yf_symbol.split('.')[0]
-                if yf_symbol in data and not data[yf_symbol].dropna().empty:
-                    prices[short_symbol] = round(float(data[yf_symbol].dropna().iloc[-1]), 2)
+        closes = await (closes_fn or yf_last_closes)(yf_symbols)
+        for yf_symbol, close in closes.items():
+            prices[yf_symbol.split('.')[0]] = round(close, 2)
     except Exception as e:
         print(f"KRİTİK HATA (Toplu BIST): {e}")
     return prices
 
+async def fetch_bist_yahoo_batch(symbols: set) -> dict:
+    """BIST fiyatlarını Yahoo chart istemcisiyle çeker."""
+    return await fetch_bist_batch(symbols, closes_fn=yahoo_spark_last_prices)
+
 async def fetch_nasdaq_batch(symbols: set) -> dict:
     """Verilen NASDAQ sembol listesi için Finnhub'tan toplu fiyat çeker."""
     if not symbols:
         return {}
     
     prices = {}
-    async with httpx.AsyncClient(timeout=15) as client:
-        tasks = [client.get(f"{FINNHUB_BASE}/quote", params={"symbol": sym, "token": FINNHUB_API_KEY}) for sym in symbols]
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        for sym, r in zip(symbols, responses):
-            if not isinstance(r, Exception) and r.status_code == 200:
-                price_val = r.json().get("c")
-                if price_val:
-                    prices[sym] = round(price_val, 2)
+    tasks = [provider_get("finnhub", "/quote", params={"symbol": sym, "token": FINNHUB_API_KEY}) for sym in symbols]
+    responses = await asyncio.gather(*tasks, return_exceptions=True)
+    
+    for sym, r in zip(symbols, responses):
+        if not isinstance(r, BaseException) and r.status_code == 200:
+            price_val = r.json().get("c")
+            if price_val:
+                prices[sym] = round(price_val, 2)
     return prices
 
 async def fetch_crypto_batch(symbols: set) -> dict:
@@ -286,128 +1123,585 @@ async def fetch_crypto_batch(symbols: set) -> dict:
         return {}
         
     prices = {}
-    # Binance API için sembollerin sonuna "USDT" eklenir
-    binance_symbols = [f"{s.upper()}USDT" for s in symbols]
-    async with httpx.AsyncClient(timeout=15) as client:
-        tasks = [client.get("https://api.binance.com/api/v3/ticker/price", params={"symbol": s}) for s in binance_symbols]
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        for original_sym, r in zip(symbols, responses):
-            if not isinstance(r, Exception) and r.status_code == 200:
-                data = r.json()
-                price_val = data.get("price")
-                if price_val:
-                    prices[original_sym] = round(float(price_val), 2)
+    # Tek tek istek atmak yerine tüm piyasanın anlık görüntüsünden okunur.
+    snapshot = await get_binance_snapshot()
+    for original_sym in symbols:
+        # Alarmlar "BTCUSDT" şeklinde kaydedilir; son eki olmayan semboller için "USDT" eklenir.
+        binance_symbol = original_sym.upper()
+        if not binance_symbol.endswith("USDT"):
+            binance_symbol = f"{binance_symbol}USDT"
+        price_val = snapshot.get(binance_symbol)
+        if price_val:
+            prices[original_sym] = round(price_val, 2)
     return prices
 
 async def fetch_metals_batch(symbols: set) -> dict:
-    """Verilen METAL sembolleri (ALTIN, GÜMÜŞ vb.) için toplu fiyat çeker."""
+    """Verilen METAL sembolleri (ALTIN, GÜMÜŞ vb.) için gram/TL fiyatlarını metal matrisinden okur."""
     if not symbols:
         return {}
 
-    prices = {}
-    metals_yf_map = {"ALTIN": "GC=F", "GÜMÜŞ": "SI=F", "BAKIR": "HG=F"}
-    # Sadece istenen metallerin yf ticker'larını ve her zaman gereken TRY=X'i al
-    yf_tickers_to_fetch = {metals_yf_map[s] for s in symbols if s in metals_yf_map}
-    yf_tickers_to_fetch.add("TRY=X")
-    
-    try:
-        data = yf.download(list(yf_tickers_to_fetch), period="1d", progress=False, auto_adjust=True)['Close']
-        if data.empty:
-            return {}
+    try_row = (await get_metals_matrix()).get("TRY", {})
+    return {symbol: try_row[symbol] for symbol in symbols if try_row.get(symbol) is not None}
 
-        usdtry_rate = data["TRY=X"].dropna().iloc[-1]
-        
-        for metal_name, yf_ticker in metals_yf_map.items():
-            if metal_name in symbols and yf_ticker in data and not data[yf_ticker].dropna().empty:
-                price_usd = data[yf_ticker].dropna().iloc[-1]
-                # Gram/TL fiyatını hesapla
-                prices[metal_name] = round((price_usd * usdtry_rate) / 31.1035, 2)
+async def fetch_nasdaq_yfinance_batch(symbols: set, closes_fn=None) -> dict:
+    """NASDAQ fiyatlarını (varsayılan olarak yfinance'tan) çeker; Finnhub erişilemezken yedek kaynak olarak kullanılır."""
+    if not symbols:
+        return {}
+    closes = await (closes_fn or yf_last_closes)(list(symbols))
+    return {sym: round(close, 2) for sym, close in closes.items()}
+
+async def fetch_nasdaq_yahoo_batch(symbols: set) -> dict:
+    """NASDAQ fiyatlarını Yahoo chart istemcisiyle çeker."""
+    return await fetch_nasdaq_yfinance_batch(symbols, closes_fn=yahoo_spark_last_prices)
+
+# ----------------------------
+# Fiyat Kaynakları: Devre Kesici, Hedge ve Yedek Zincirleri
+# Her piyasa sırayla denenen bir kaynak zincirinden beslenir. Art arda hata veren kaynağın devresi
+# açılır ve bir süre hiç çağrılmaz. Bir kaynak kendi p95 gecikmesini aştığında aynı istek zincirdeki
+# bir sonraki kaynağa da gönderilir ve ilk dolu cevap kullanılır. Zincirin son (ya da tek) kaynağı
+# hedge edilmez: aynı kaynağa giden ikinci istek provider_get'te birleştirilir veya aynı kilitte
+# sıraya girer, yani gerçek bir yedek istek olmaz.
+# Tüm zincir QUOTE_FETCH_BUDGET_SECONDS ile sınırlıdır; yetişmeyen semboller için cache'teki
+# son bilinen değer, "stale" olarak işaretlenip sunulur.
+# ----------------------------
+QUOTE_SOURCES = {
+    "BIST": {"yahoo": fetch_bist_yahoo_batch, "yfinance": fetch_bist_batch},
+    "NASDAQ": {"finnhub": fetch_nasdaq_batch, "yahoo": fetch_nasdaq_yahoo_batch, "yfinance": fetch_nasdaq_yfinance_batch},
+    "CRYPTO": {"binance": fetch_crypto_batch},
+    # Metal matrisi kendi içinde Yahoo chart'tan, eksikler için yfinance'tan beslenir.
+    "METALS": {"metals_matrix": fetch_metals_batch},
+}
+QUOTE_SOURCE_CHAINS = {
+    market: [name.strip() for name in os.getenv(f"QUOTE_SOURCES_{market}", ",".join(sources)).split(",") if name.strip() in sources]
+    for market, sources in QUOTE_SOURCES.items()
+}
+QUOTE_FETCH_BUDGET = float(os.getenv("QUOTE_FETCH_BUDGET_SECONDS", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "60"))
+QUOTE_HEDGE_DEFAULT_DELAY = float(os.getenv("QUOTE_HEDGE_DEFAULT_DELAY_SECONDS", "2"))
+QUOTE_HEDGE_MIN_DELAY = float(os.getenv("QUOTE_HEDGE_MIN_DELAY_SECONDS", "0.3"))
+QUOTE_HEDGE_MAX_DELAY = float(os.getenv("QUOTE_HEDGE_MAX_DELAY_SECONDS", "4"))
+QUOTE_LATENCY_SAMPLES = 200
+QUOTE_LATENCY_MIN_SAMPLES = 20
+
+class QuoteSourceHealth:
+    """Bir kaynağın devre kesicisi (closed -> open -> half_open) ve gecikme geçmişi."""
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.last_error: Optional[str] = None
+        self.latencies: deque = deque(maxlen=QUOTE_LATENCY_SAMPLES)
+        self.stats = {"calls": 0, "successes": 0, "failures": 0, "rejected": 0, "opened": 0, "hedges": 0, "hedge_wins": 0}
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < CIRCUIT_RESET_SECONDS:
+                self.stats["rejected"] += 1
+                return False
+            # Bekleme süresi doldu; sonraki çağrı deneme çağrısıdır.
+            self.state = "half_open"
+        return True
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.stats["successes"] += 1
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            print(f"Fiyat kaynağı '{self.name}' tekrar erişilebilir, devre kapatıldı.")
+        self.state = "closed"
+
+    def record_failure(self, error: str, latency: Optional[float] = None):
+        if latency is not None:
+            self.latencies.append(latency)
+        self.stats["failures"] += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+            print(f"Fiyat kaynağı '{self.name}' devresi {CIRCUIT_RESET_SECONDS:.0f} sn için açıldı: {error}")
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < QUOTE_LATENCY_MIN_SAMPLES:
+            return QUOTE_HEDGE_DEFAULT_DELAY
+        p95 = float(np.percentile(np.fromiter(self.latencies, dtype=np.float64), 95))
+        return min(max(p95, QUOTE_HEDGE_MIN_DELAY), QUOTE_HEDGE_MAX_DELAY)
+
+    def snapshot(self) -> Dict:
+        return {
+            **self.stats,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "hedge_delay_seconds": round(self.hedge_delay(), 3),
+        }
+
+_quote_source_health: Dict[str, QuoteSourceHealth] = {}
+
+def quote_source_health(name: str) -> QuoteSourceHealth:
+    health = _quote_source_health.get(name)
+    if health is None:
+        health = _quote_source_health[name] = QuoteSourceHealth(name)
+    return health
+
+async def _call_quote_source(market: str, name: str, symbols: set) -> Dict[str, float]:
+    """Kaynağı çağırır ve sonucu devre kesiciye işler. Hedge kaybedeni olarak iptal edilirse sadece gecikme kaydedilir."""
+    health = quote_source_health(name)
+    health.stats["calls"] += 1
+    started = time.monotonic()
+    try:
+        prices = await QUOTE_SOURCES[market][name](symbols)
+    except asyncio.CancelledError:
+        # Hedge'i kaybeden çağrı en az bu kadar sürmüştür; p95'in aşağı doğru yanılmaması için kaydedilir.
+        health.latencies.append(time.monotonic() - started)
+        raise
     except Exception as e:
-        print(f"KRİTİK HATA (Toplu METALS): {e}")
+        health.record_failure(f"{type(e).__name__}: {e}", time.monotonic() - started)
+        return {}
+    prices = {sym: price for sym, price in prices.items() if price is not None}
+    if prices or not symbols:
+        health.record_success(time.monotonic() - started)
+    else:
+        health.record_failure("boş cevap", time.monotonic() - started)
     return prices
 
+async def _fetch_hedged(market: str, primary: str, hedge: Optional[str], symbols: set, timeout: float) -> Dict[str, float]:
+    """Birincil kaynağı çağırır; p95 gecikmesi içinde cevap gelmezse hedge kaynağını da devreye sokar."""
+    tasks = {asyncio.create_task(_call_quote_source(market, primary, symbols)): primary}
+    deadline = time.monotonic() + timeout
+    hedged = False
+    try:
+        while tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = remaining
+            if not hedged and hedge is not None:
+                wait_for = min(remaining, quote_source_health(primary).hedge_delay())
+            done, _ = await asyncio.wait(tasks, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks.pop(task)
+                prices = task.result()
+                if prices:
+                    if name != primary:
+                        quote_source_health(name).stats["hedge_wins"] += 1
+                    return prices
+            if not done and not hedged and hedge is not None and quote_source_health(hedge).allow():
+                hedged = True
+                quote_source_health(primary).stats["hedges"] += 1
+                tasks[asyncio.create_task(_call_quote_source(market, hedge, symbols))] = hedge
+        # Bütçe doldu: bitmemiş çağrılar zaman aşımı hatası sayılır.
+        for name in set(tasks.values()):
+            quote_source_health(name).record_failure("zaman aşımı")
+        return {}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def fetch_market_quotes(market: str, symbols: set) -> Dict[str, float]:
+    """
+    Piyasanın kaynak zincirini bütçe içinde dener. Bir kaynağın bulamadığı semboller zincirde
+    sonraki kaynaktan istenir; devresi açık kaynaklar atlanır.
+    """
+    prices: Dict[str, float] = {}
+    missing = set(symbols)
+    deadline = time.monotonic() + QUOTE_FETCH_BUDGET
+    chain = [name for name in QUOTE_SOURCE_CHAINS[market] if quote_source_health(name).allow()]
+    for i, name in enumerate(chain):
+        remaining = deadline - time.monotonic()
+        if not missing or remaining <= 0:
+            break
+        # Sadece zincirde sonraki bir kaynak varsa hedge edilir.
+        hedge = chain[i + 1] if i + 1 < len(chain) else None
+        prices.update(await _fetch_hedged(market, name, hedge, missing, remaining))
+        missing -= prices.keys()
+    if missing and not prices:
+        print(f"{market} için hiçbir kaynaktan fiyat alınamadı (zincir: {QUOTE_SOURCE_CHAINS[market]}).")
+    return prices
+
+# Birleşik fiyat cache'inin her piyasa için kullandığı toplu çekiciler.
+MARKET_FETCHERS = {market: partial(fetch_market_quotes, market) for market in QUOTE_SOURCES}
+
+async def get_market_prices(market: str, symbols, allow_stale: bool = True) -> Dict[str, Optional[float]]:
+    return await quote_cache.get_many(market, symbols, MARKET_FETCHERS[market], allow_stale=allow_stale)
+
 # --- ANA FONKSİYON ---
 
 async def run_price_checks():
+    # Tek çalıştırıcı koruması: cron ve dahili zamanlayıcı aynı anda tur başlatamaz,
+    # böylece aynı alarm için iki kez bildirim gönderilmez.
+    lock = get_async_lock("price_checks")
+    if lock.locked():
+        print("Önceki fiyat kontrolü hâlâ sürüyor, bu tetikleme atlandı."); return
+    async with lock:
+        await _run_price_checks()
+
+# ----------------------------
+# Dağıtık (Shard'lı) Kontrol Modu
+# ----------------------------
+# Açıkken her worker zamanı gelen kullanıcılardan bir shard'ı `FOR UPDATE SKIP LOCKED` ile sahiplenir,
+# next_check_at'i kiralama (lease) süresi kadar ileri alarak diğer worker'lardan gizler ve shard'ı
+# bağımsız işleyip kendi transaction'ında commit eder. Worker çökerse kiralama süresi dolunca
+# kullanıcılar yeniden zamanı gelmiş sayılır ve başka bir worker tarafından alınır.
+ALERT_CHECK_DISTRIBUTED = os.getenv("ALERT_CHECK_DISTRIBUTED", "0") == "1"
+ALERT_CHECK_SHARD_SIZE = int(os.getenv("ALERT_CHECK_SHARD_SIZE", "500"))
+ALERT_CHECK_LEASE = timedelta(seconds=int(os.getenv("ALERT_CHECK_LEASE_SECONDS", "120")))
+
+def claim_due_users(session: Session, now: datetime, limit: int) -> List[str]:
+    is_due = or_(User.next_check_at == None, User.next_check_at <= now)  # noqa: E711
+    query = (
+        select(User.uid)
+        .where(is_due)
+        .order_by(User.next_check_at.asc().nulls_first())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    uids = list(session.exec(query).all())
+    if uids:
+        # Zaman koşulu UPDATE'te tekrar kontrol edilir ve sadece gerçekten kiralanan satırlar döner.
+        # SKIP LOCKED olmayan veritabanlarında (SQLite) iki worker aynı satırları okusa bile kiralamayı biri alır.
+        uids = list(session.exec(
+            update(User)
+            .where(User.uid.in_(uids), is_due)
+            .values(next_check_at=datetime.utcnow() + ALERT_CHECK_LEASE)
+            .returning(User.uid)
+            .execution_options(synchronize_session=False)
+        ).scalars().all())
+    session.commit()
+    return uids
+
+# Tek seferde belleğe alınan kullanıcı sayısı; bellek kullanımı toplam kullanıcıyla değil bu değerle sınırlıdır.
+ALERT_CHECK_CHUNK_SIZE = int(os.getenv("ALERT_CHECK_CHUNK_SIZE", "1000"))
+# Turun bellek kullanımı, tur başındaki RSS'e göre artış olarak raporlanır (her parçadan sonra örneklenir).
+# Böylece yorumlayıcının taban belleği sayılmaz; ama ölçüm sürecin tamamını kapsar, tur sırasında gelen
+# istekler de dahildir. RSS okunamıyorsa (Linux dışı) veya bu ayar açıksa turun tepe Python belleği
+# tracemalloc ile ölçülür (ek CPU maliyeti vardır).
+ALERT_CHECK_TRACE_MEMORY = os.getenv("ALERT_CHECK_TRACE_MEMORY", "0") == "1"
+
+def read_current_rss() -> Optional[int]:
+    """Sürecin o anki RSS değerini byte olarak döndürür."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+# Son kontrol turunun özeti (/stats'ta gösterilir).
+_price_check_stats: Dict = {
+    "last_run_at": None,
+    "duration_seconds": None,
+    "users_checked": 0,
+    "chunks": 0,
+    # memory_metric: "rss_growth" (tur başındaki RSS'e göre en yüksek artış) veya "tracemalloc_peak".
+    "memory_bytes": None,
+    "memory_metric": None,
+}
+
+class CheckUser(NamedTuple):
+    """Kontrol turunda bir kullanıcıdan gereken kolonlar; ORM nesnesi oluşturulmaz."""
+    uid: str
+    plan: str
+    fcm_token: Optional[str]
+    notifications_enabled: bool
+    language_code: str
+
+def next_due_user_chunk(session: Session, now: datetime, after_uid: Optional[str], limit: int) -> List[str]:
+    # uid üzerinden keyset sayfalama: OFFSET kullanılmaz, her sayfa bir öncekinin son uid'sinden devam eder.
+    query = (
+        select(User.uid)
+        .where(or_(User.next_check_at == None, User.next_check_at <= now))  # noqa: E711
+        .order_by(User.uid)
+        .limit(limit)
+    )
+    if after_uid is not None:
+        query = query.where(User.uid > after_uid)
+    return list(session.exec(query).all())
+
+async def _run_price_checks():
     print("Arka plan fiyat kontrolü başladı...")
+    # Bu turdan (cache üzerinden de olsa) yapılan upstream çağrıları alarm önceliğiyle kuyruğa girer.
+    priority_token = provider_priority.set(PRIORITY_ALERTS)
     now = datetime.utcnow()
+    started = time.monotonic()
+    rss_start = None if ALERT_CHECK_TRACE_MEMORY else read_current_rss()
+    use_tracemalloc = rss_start is None
+    if use_tracemalloc:
+        tracemalloc.start()
+    rss_max = rss_start
+    checked = chunks = 0
     try:
-        with Session(engine) as session:
-            # 1. ADIM: KULLANICILARI VE ALARMLARI ÇEKME (Değişiklik Yok)
-            query = select(User).options(joinedload(User.alerts))
-            all_users = session.exec(query).unique().all()
-            if not all_users:
-                print("Kontrol edilecek kullanıcı bulunamadı."); return
-
-            # 2. ADIM: KONTROL ZAMANI GELEN KULLANICILARI FİLTRELEME (Değişiklik Yok)
-            users_to_check = []
-            for user in all_users:
-                # ... (plan bazlı kontrol mantığı aynı kalacak) ...
-                plan = user.plan
-                last_checked = user.last_checked_at or datetime.min
-                check_interval = timedelta(minutes=10)
-                if plan == 'ultra': check_interval = timedelta(minutes=1)
-                elif plan == 'pro': check_interval = timedelta(minutes=3)
-                if (now - last_checked) >= check_interval:
-                    users_to_check.append(user)
-            
-            if not users_to_check:
-                print("Kontrol zamanı gelen kullanıcı yok. Görev sonlandırıldı."); return
-
-            # 3. ADIM: SEMBOLLERİ PİYASALARINA GÖRE GRUPLAMA (YENİ VE ÖNEMLİ)
-            # Tek bir `symbols_to_fetch` seti yerine, piyasaya göre ayrılmış bir sözlük kullanıyoruz.
-            symbols_by_market = {"BIST": set(), "NASDAQ": set(), "CRYPTO": set(), "METALS": set()}
-            for user in users_to_check:
-                for alert in user.alerts:
-                    market = alert.market.upper()
-                    if market in symbols_by_market:
-                        symbols_by_market[market].add(alert.symbol)
-            
-            # 4. ADIM: HER PİYASA İÇİN TOPLU VERİ ÇEKME (YENİ VE EN KRİTİK OPTİMİZASYON)
-            prices = {}
-            
-            # Paralel olarak çalıştırılacak görevleri (task) hazırlıyoruz.
-            batch_tasks = []
-            if symbols_by_market["BIST"]:
-                batch_tasks.append(fetch_bist_batch(symbols_by_market["BIST"]))
-            if symbols_by_market["NASDAQ"]:
-                batch_tasks.append(fetch_nasdaq_batch(symbols_by_market["NASDAQ"]))
-            if symbols_by_market["CRYPTO"]:
-                batch_tasks.append(fetch_crypto_batch(symbols_by_market["CRYPTO"]))
-            if symbols_by_market["METALS"]:
-                batch_tasks.append(fetch_metals_batch(symbols_by_market["METALS"]))
-
-            # Tüm piyasaların verilerini `asyncio.gather` ile AYNI ANDA çekiyoruz.
-            if batch_tasks:
-                list_of_price_dicts = await asyncio.gather(*batch_tasks)
-                # Gelen fiyat sözlüklerini tek bir `prices` sözlüğünde birleştiriyoruz.
-                for price_dict in list_of_price_dicts:
-                    prices.update(price_dict)
-            
-            # 5. ADIM: ALARMLARI KONTROL ETME VE SİLME (Değişiklik Yok)
-            total_deleted_alerts = []
-            for user in users_to_check:
-                deleted_ids = await check_alerts_for_user(user, prices)
-                total_deleted_alerts.extend(deleted_ids)
-                user.last_checked_at = now
-                session.add(user)
-
-            if total_deleted_alerts:
-                delete_stmt = delete(Alert).where(Alert.id.in_(total_deleted_alerts))
-                session.exec(delete_stmt)
-            
-            session.commit()
-            if total_deleted_alerts:
-                print(f"{len(total_deleted_alerts)} adet tetiklenen alarm silindi.")
-            print(f"{len(users_to_check)} kullanıcının alarmları kontrol edildi.")
-
+        if ALERT_CHECK_DISTRIBUTED:
+            while True:
+                uids = await run_db(claim_due_users, now, ALERT_CHECK_SHARD_SIZE)
+                if not uids:
+                    break
+                checked += await check_user_shard(uids)
+                chunks += 1
+                if not use_tracemalloc:
+                    rss_max = max(rss_max, read_current_rss() or 0)
+        else:
+            # Zamanı gelen kullanıcılar sabit boyutlu parçalar halinde okunur; her parça
+            # değerlendirilip commit edildikten sonra bir sonraki yüklenir.
+            last_uid = None
+            while True:
+                uids = await run_db(next_due_user_chunk, now, last_uid, ALERT_CHECK_CHUNK_SIZE)
+                if not uids:
+                    break
+                checked += await check_user_shard(uids)
+                chunks += 1
+                last_uid = uids[-1]
+                if not use_tracemalloc:
+                    rss_max = max(rss_max, read_current_rss() or 0)
+        if not checked:
+            print("Kontrol zamanı gelen kullanıcı yok. Görev sonlandırıldı.")
     except Exception as e:
         print(f"KRİTİK HATA (run_price_checks): {e}")
         traceback.print_exc()
-    
+    finally:
+        if use_tracemalloc:
+            memory, memory_metric = tracemalloc.get_traced_memory()[1], "tracemalloc_peak"
+            tracemalloc.stop()
+        else:
+            memory, memory_metric = rss_max - rss_start, "rss_growth"
+        _price_check_stats.update(
+            last_run_at=now.isoformat(),
+            duration_seconds=round(time.monotonic() - started, 3),
+            users_checked=checked,
+            chunks=chunks,
+            memory_bytes=memory,
+            memory_metric=memory_metric,
+        )
+        if checked:
+            print(f"{checked} kullanıcı {chunks} parçada kontrol edildi, bellek: {memory / 1024 / 1024:.1f} MB ({memory_metric}).")
+        provider_priority.reset(priority_token)
+
     print("Arka plan fiyat kontrolü tamamlandı.")
 
+def load_shard_users(session: Session, uids: List[str]) -> Tuple[List[CheckUser], Dict[str, set]]:
+    """Parçadaki kullanıcıların gereken kolonlarını ve alarmlarının sembollerini piyasaya göre okur."""
+    users = [
+        CheckUser(*row) for row in session.exec(
+            select(User.uid, User.plan, User.fcm_token, User.notifications_enabled, User.language_code)
+            .where(User.uid.in_(uids))
+        ).all()
+    ]
+    # Tek bir `symbols_to_fetch` seti yerine, piyasaya göre ayrılmış bir sözlük kullanıyoruz.
+    symbols_by_market = {"BIST": set(), "NASDAQ": set(), "CRYPTO": set(), "METALS": set()}
+    for market, symbol in session.exec(
+        select(Alert.market, Alert.symbol).where(Alert.user_uid.in_(uids)).distinct()
+    ).all():
+        market = market.upper()
+        if market in symbols_by_market:
+            symbols_by_market[market].add(symbol)
+    return users, symbols_by_market
+
+def commit_shard_results(session: Session, users_to_check: List[CheckUser], prices: Dict, now: datetime):
+    """Alarmları değerlendirir, tetiklenenleri siler, kontrol zamanlarını günceller ve commit eder."""
+    due_uids = {user.uid for user in users_to_check}
+    # Alarm indeksi sadece bu worker'daki CRUD işlemlerini görür; dağıtık modda
+    # diğer worker'ların eklediği alarmları kaçırmamak için alarmlar veritabanından değerlendirilir.
+    if ALERT_EVAL_MODE == "numpy" or ALERT_CHECK_DISTRIBUTED:
+        triggered_alerts = find_triggered_alerts_vectorized(session, prices, due_uids)
+    else:
+        triggered_alerts = find_triggered_alerts_indexed(prices, due_uids)
+
+    triggered_by_user = defaultdict(list)
+    for alert in triggered_alerts:
+        triggered_by_user[alert.user_uid].append(alert)
+
+    triggered_ids = []
+    pending: Dict[int, messaging.Message] = {}
+    for user in users_to_check:
+        triggered_ids.extend(check_alerts_for_user(user, triggered_by_user.get(user.uid, []), prices, pending))
+
+    # Alarmı bu arada kripto akışı (veya başka bir worker) silmişse bildirimi o gönderir; burada tekrar gönderilmez.
+    deleted_ids = persist_check_results(session, [user.uid for user in users_to_check], triggered_ids, now)
+    return deleted_ids, [pending[alert_id] for alert_id in deleted_ids if alert_id in pending]
+
+# Kontrol sonuçları bu büyüklükte parçalar halinde, her parça kendi kısa transaction'ında yazılır.
+CHECK_WRITE_BATCH_SIZE = int(os.getenv("CHECK_WRITE_BATCH_SIZE", "1000"))
+
+def delete_alerts_returning(session: Session, alert_ids: List[int]) -> List[int]:
+    """Alarmları parça parça siler ve gerçekten silinenlerin ID'lerini döndürür (DELETE ... RETURNING)."""
+    deleted_ids = []
+    for i in range(0, len(alert_ids), CHECK_WRITE_BATCH_SIZE):
+        chunk = alert_ids[i:i + CHECK_WRITE_BATCH_SIZE]
+        result = session.exec(
+            delete(Alert).where(Alert.id.in_(chunk)).returning(Alert.id).execution_options(synchronize_session=False)
+        )
+        deleted_ids.extend(result.scalars().all())
+        session.commit()
+    return deleted_ids
+
+def persist_check_results(session: Session, uids: List[str], triggered_alert_ids: List[int], now: datetime) -> List[int]:
+    """
+    Kullanıcı başına UPDATE yerine küme bazlı yazar: her parça için tek bir DELETE ve
+    plana göre next_check_at'i CASE ile hesaplayan tek bir UPDATE.
+    Önce alarmlar silinir; arada bir hata olursa kullanıcılar tekrar kontrol edilir ama
+    silinmiş alarmlar için ikinci bildirim gitmez. Gerçekten silinen alarm ID'lerini döndürür.
+    """
+    deleted_ids = delete_alerts_returning(session, triggered_alert_ids)
+
+    next_check_at = case(
+        *[(User.plan == plan, now + interval) for plan, interval in PLAN_CHECK_INTERVALS.items()],
+        else_=now + PLAN_CHECK_INTERVALS["free"],
+    )
+    for i in range(0, len(uids), CHECK_WRITE_BATCH_SIZE):
+        chunk = uids[i:i + CHECK_WRITE_BATCH_SIZE]
+        session.exec(
+            update(User)
+            .where(User.uid.in_(chunk))
+            .values(last_checked_at=now, next_check_at=next_check_at)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    return deleted_ids
+
+async def check_user_shard(uids: List[str]) -> int:
+    """
+    Verilen kullanıcıları kontrol eder, sonuçları commit eder ve kontrol edilen kullanıcı sayısını döndürür.
+    Fiyatlar beklenirken veritabanı bağlantısı tutulmaz.
+    """
+    now = datetime.utcnow()
+    # 1-3. ADIM: KULLANICILARI VE ALARM SEMBOLLERİNİ PİYASALARINA GÖRE GRUPLAYARAK ÇEKME
+    users_to_check, symbols_by_market = await run_db(load_shard_users, uids)
+    if not users_to_check:
+        return 0
+
+    # 4. ADIM: HER PİYASA İÇİN TOPLU VERİ ÇEKME (YENİ VE EN KRİTİK OPTİMİZASYON)
+    prices = {}
+
+    # Paralel olarak çalıştırılacak görevleri (task) hazırlıyoruz.
+    # Fiyatlar birleşik cache'ten okunur; /prices'ın az önce çektiği semboller için upstream'e gidilmez.
+    # Alarm kontrolünde TTL'i geçmiş (stale) değer kullanılmaz.
+    markets = [market for market, symbols in symbols_by_market.items() if symbols]
+    batch_tasks = [get_market_prices(market, symbols_by_market[market], allow_stale=False) for market in markets]
+
+    # Tüm piyasaların verilerini `asyncio.gather` ile AYNI ANDA çekiyoruz.
+    if batch_tasks:
+        list_of_price_dicts = await asyncio.gather(*batch_tasks)
+        # Gelen fiyat sözlüklerini (piyasa, sembol) anahtarlı tek bir `prices` sözlüğünde birleştiriyoruz.
+        # Kaynaklar yetişemediğinde dönen son bilinen (stale) değerlerle alarm tetiklenmez.
+        for market, price_dict in zip(markets, list_of_price_dicts):
+            stale = quote_cache.stale_symbols(market, price_dict)
+            prices.update({(market, sym): price for sym, price in price_dict.items() if price is not None and sym not in stale})
+
+    # 5. ADIM: ALARMLARI KONTROL ETME VE SİLME
+    total_deleted_alerts, outbox = await run_db(commit_shard_results, users_to_check, prices, now)
+    alert_index_remove(total_deleted_alerts)
+    if total_deleted_alerts:
+        print(f"{len(total_deleted_alerts)} adet tetiklenen alarm silindi.")
+    print(f"{len(users_to_check)} kullanıcının alarmları kontrol edildi.")
+    for user in users_to_check:
+        schedule_user_check(user.uid, now + plan_check_interval(user.plan))
+
+    # 6. ADIM: BİLDİRİMLERİ TOPLU GÖNDERME
+    # Silme işlemi commit edildikten sonra gönderilir; commit başarısız olursa aynı alarm tekrar bildirilmez.
+    if outbox:
+        await dispatch_notifications(outbox)
+    return len(users_to_check)
+
+# ----------------------------
+# Dahili Kontrol Zamanlayıcısı
+# ----------------------------
+# Kullanıcılar bir sonraki kontrol zamanlarına göre bir min-heap'te tutulur.
+# Döngü sadece en yakın kontrol zamanı geldiğinde uyanır ve run_price_checks'i çalıştırır.
+# Cron (/run-checks) ile birlikte kullanılabilir; tek çalıştırıcı koruması turların çakışmasını önler.
+PRICE_CHECK_SCHEDULER_ENABLED = os.getenv("PRICE_CHECK_SCHEDULER_ENABLED", "0") == "1"
+# Heap dışında zamanı gelen kullanıcılar (örn. başka bir instance'ta kaydolanlar) en geç bu sürede fark edilir.
+PRICE_CHECK_SCHEDULER_MAX_SLEEP = float(os.getenv("PRICE_CHECK_SCHEDULER_MAX_SLEEP_SECONDS", "300"))
+
+_check_schedule: list = []  # [(next_check_at, uid)] min-heap
+# Her kullanıcının geçerli kontrol zamanı; heap'te bununla eşleşmeyen kayıtlar eskimiştir ve atlanır.
+_check_schedule_due: Dict[str, datetime] = {}
+_check_schedule_lock = threading.Lock()  # register_token gibi threadpool'daki endpoint'ler de ekleme yapar
+_check_schedule_state = {"active": False, "loop": None, "wakeup": None}
+
+def _wake_check_scheduler():
+    loop, wakeup = _check_schedule_state["loop"], _check_schedule_state["wakeup"]
+    if loop is not None and wakeup is not None:
+        loop.call_soon_threadsafe(wakeup.set)
+
+def schedule_user_check(uid: str, due_at: Optional[datetime] = None):
+    if not _check_schedule_state["active"]:
+        return
+    due_at = due_at or datetime.utcnow()
+    with _check_schedule_lock:
+        if _check_schedule_due.get(uid) == due_at:
+            return
+        _check_schedule_due[uid] = due_at
+        heapq.heappush(_check_schedule, (due_at, uid))
+        is_earliest = _check_schedule[0] == (due_at, uid)
+    # Uyuyan döngü daha geç bir zamana kurulmuş olabilir; yeni kayıt en yakınıysa uyandır.
+    if is_earliest:
+        _wake_check_scheduler()
+
+def _pop_due_checks(now: datetime) -> int:
+    due_count = 0
+    with _check_schedule_lock:
+        while _check_schedule and _check_schedule[0][0] <= now:
+            due_at, uid = heapq.heappop(_check_schedule)
+            if _check_schedule_due.get(uid) == due_at:
+                del _check_schedule_due[uid]
+                due_count += 1
+        return due_count
+
+def _next_scheduled_check() -> Optional[datetime]:
+    with _check_schedule_lock:
+        return _check_schedule[0][0] if _check_schedule else None
+
+def load_check_schedule(session: Session):
+    now = datetime.utcnow()
+    rows = session.exec(select(User.uid, User.next_check_at)).all()
+    with _check_schedule_lock:
+        _check_schedule.clear()
+        _check_schedule_due.clear()
+        for uid, next_check_at in rows:
+            due_at = next_check_at or now
+            _check_schedule_due[uid] = due_at
+            _check_schedule.append((due_at, uid))
+        heapq.heapify(_check_schedule)
+    print(f"Kontrol zamanlayıcısı {len(rows)} kullanıcı ile başlatıldı.")
+
+async def price_check_scheduler_loop():
+    wakeup = asyncio.Event()
+    _check_schedule_state.update(active=True, loop=asyncio.get_running_loop(), wakeup=wakeup)
+    try:
+        await run_db(load_check_schedule)
+        while True:
+            now = datetime.utcnow()
+            if _pop_due_checks(now):
+                # Cron turu sürüyorsa atlamak yerine bitmesini bekle; heap'ten çıkan kullanıcılar kaybolmasın.
+                async with get_async_lock("price_checks"):
+                    await _run_price_checks()
+                continue
+            sleep_for = PRICE_CHECK_SCHEDULER_MAX_SLEEP
+            next_due = _next_scheduled_check()
+            if next_due is not None:
+                sleep_for = min(sleep_for, (next_due - now).total_seconds())
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=max(sleep_for, 0.05))
+                wakeup.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            if next_due is None or next_due > datetime.utcnow():
+                # Uyanma nedeni heap değilse (üst sınır doldu), heap dışından gelen zamanı geçmiş kullanıcıları yakala.
+                await run_price_checks()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"KRİTİK HATA (price_check_scheduler_loop): {e}")
+        traceback.print_exc()
+    finally:
+        _check_schedule_state.update(active=False, loop=None, wakeup=None)
+
 def verify_cron_secret(secret: str = Query(...)):
     """Dependency to verify the cron job secret key."""
     if secret != CRON_SECRET_KEY:
@@ -426,6 +1720,164 @@ async def trigger_price_checks(
     background_tasks.add_task(run_price_checks)
     return {"message": "Fiyat kontrol görevi arka planda başlatıldı."}
 
+@app.get("/stats")
+def get_stats(is_secret_valid: bool = Depends(verify_cron_secret)):
+    """Çalışma zamanı metrikleri (kuyruk derinlikleri vb.). Cron anahtarıyla korunur."""
+    with _yf_stats_lock:
+        yf_stats = dict(_yf_stats)
+    yf_stats["max_workers"] = YF_MAX_WORKERS
+    return {
+        "price_checks": dict(_price_check_stats),
+        "yfinance_executor": yf_stats,
+        "quote_cache": {**quote_cache.stats, "entries": len(quote_cache._entries)},
+        "user_profile_cache": user_profile_cache.snapshot_stats(),
+        "providers": {
+            name: {**limiter.stats, "queue_depth": len(limiter._waiters), "tokens": round(limiter.tokens, 2)}
+            for name, limiter in _provider_limiters.items()
+        },
+        "quote_sources": {name: health.snapshot() for name, health in _quote_source_health.items()},
+    }
+
+# ----------------------------
+# --- CRYPTO CANLI FİYAT AKIŞI (Binance WebSocket) ---
+# ----------------------------
+# Açıkken aktif CRYPTO alarmı olan her sembolün miniTicker akışına abone olunur.
+# Bir sembol fiyat güncellediğinde sadece o sembolün alarmları indeksten değerlendirilir,
+# böylece kripto alarmları cron turunu beklemeden saniyenin altında tetiklenir.
+CRYPTO_STREAM_ENABLED = os.getenv("CRYPTO_STREAM_ENABLED", "0") == "1"
+# Yerel bir sahte akış sunucusuna yönlendirmek için değiştirilebilir.
+BINANCE_STREAM_URL = os.getenv("BINANCE_STREAM_URL", "wss://stream.binance.com:9443/stream")
+# Akıştan anlık değerlendirilen planlar; diğer planlar cron turunda kontrol edilmeye devam eder.
+CRYPTO_STREAM_PLANS = [p.strip() for p in os.getenv("CRYPTO_STREAM_PLANS", "ultra").split(",") if p.strip()]
+CRYPTO_STREAM_RESYNC_SECONDS = float(os.getenv("CRYPTO_STREAM_RESYNC_SECONDS", "5"))
+CRYPTO_STREAM_MAX_BACKOFF = float(os.getenv("CRYPTO_STREAM_MAX_BACKOFF_SECONDS", "60"))
+# Akış planı dışındaki kullanıcıların alarmları her tick'te yeniden sorgulanmasın diye bir süre atlanır.
+CRYPTO_STREAM_SKIP_DURATION = timedelta(seconds=60)
+
+_crypto_stream: Dict = {"subscribed": set(), "request_id": 0}
+_crypto_stream_inflight: set = set()           # işlenmekte olan alarm ID'leri
+_crypto_stream_skipped: Dict[int, datetime] = {}
+_crypto_stream_tasks: set = set()              # event loop'un görevleri erken toplamaması için referans
+
+def crypto_stream_wanted_streams() -> set:
+    """Aktif CRYPTO alarmı olan sembollerin akış adları (indeksin ekleme/silme ile tuttuğu sayaçlardan)."""
+    with _alert_index_lock:
+        return set(_alert_index_crypto_streams)
+
+async def _crypto_stream_send(ws, method: str, streams: set):
+    if not streams:
+        return
+    _crypto_stream["request_id"] += 1
+    await ws.send(json.dumps({"method": method, "params": sorted(streams), "id": _crypto_stream["request_id"]}))
+
+async def _crypto_stream_resync(ws):
+    """Alarmlar eklendikçe/silindikçe abonelikleri periyodik olarak günceller."""
+    while True:
+        wanted = crypto_stream_wanted_streams()
+        subscribed = _crypto_stream["subscribed"]
+        to_add, to_remove = wanted - subscribed, subscribed - wanted
+        if to_add:
+            await _crypto_stream_send(ws, "SUBSCRIBE", to_add)
+        if to_remove:
+            await _crypto_stream_send(ws, "UNSUBSCRIBE", to_remove)
+        if to_add or to_remove:
+            _crypto_stream["subscribed"] = wanted
+            print(f"Kripto akışı: {len(wanted)} sembole abone (+{len(to_add)} / -{len(to_remove)}).")
+        now = datetime.utcnow()
+        for alert_id in [k for k, until in _crypto_stream_skipped.items() if until <= now]:
+            del _crypto_stream_skipped[alert_id]
+        await asyncio.sleep(CRYPTO_STREAM_RESYNC_SECONDS)
+
+def _process_stream_triggers(session: Session, alerts: List[IndexedAlert], prices: Dict):
+    """Tetiklenen alarmların kullanıcılarını yükler, bildirimleri hazırlar ve alarmları siler."""
+    pending: Dict[int, messaging.Message] = {}
+    triggered_ids, skipped_ids = [], []
+    uids = {alert.user_uid for alert in alerts}
+    users = {
+        user.uid: user for user in session.exec(
+            select(User).where(User.uid.in_(uids), User.plan.in_(CRYPTO_STREAM_PLANS))
+        ).all()
+    }
+    alerts_by_user = defaultdict(list)
+    for alert in alerts:
+        if alert.user_uid in users:
+            alerts_by_user[alert.user_uid].append(alert)
+        else:
+            skipped_ids.append(alert.id)
+
+    for uid, user_alerts in alerts_by_user.items():
+        triggered_ids.extend(check_alerts_for_user(users[uid], user_alerts, prices, pending))
+
+    # Kontrol turu alarmı az önce silmişse (bildirimini de o gönderir) burada tekrar bildirilmez.
+    deleted_ids = delete_alerts_returning(session, triggered_ids)
+    return deleted_ids, skipped_ids, [pending[alert_id] for alert_id in deleted_ids if alert_id in pending]
+
+async def _handle_crypto_tick(symbol: str, alerts: List[IndexedAlert], price: float):
+    try:
+        prices = {("CRYPTO", alert.symbol): price for alert in alerts}
+        deleted_ids, skipped_ids, outbox = await run_db(_process_stream_triggers, alerts, prices)
+        alert_index_remove(deleted_ids)
+        skip_until = datetime.utcnow() + CRYPTO_STREAM_SKIP_DURATION
+        for alert_id in skipped_ids:
+            _crypto_stream_skipped[alert_id] = skip_until
+        if deleted_ids:
+            print(f"Kripto akışı: {symbol} @ {price} ile {len(deleted_ids)} alarm tetiklendi.")
+        await dispatch_notifications(outbox)
+    except Exception as e:
+        print(f"KRİTİK HATA (kripto akışı alarm işleme): {e}")
+        traceback.print_exc()
+    finally:
+        _crypto_stream_inflight.difference_update(alert.id for alert in alerts)
+
+def on_crypto_tick(binance_symbol: str, price: float):
+    """Bir sembol güncellendiğinde sadece o sembolün tetiklenen alarmlarını işler."""
+    if CANDLES_ENABLED:
+        record_candle_tick("CRYPTO", price_series_symbol("CRYPTO", binance_symbol), price, time.time())
+    now = datetime.utcnow()
+    candidates = []
+    # Alarmlar "BTCUSDT" şeklinde kaydedilir, eski kayıtlar son eksiz olabilir.
+    for symbol in (binance_symbol, binance_symbol[:-4]):
+        for alert in alert_index_triggered("CRYPTO", symbol, price):
+            if alert.id in _crypto_stream_inflight:
+                continue
+            skip_until = _crypto_stream_skipped.get(alert.id)
+            if skip_until and skip_until > now:
+                continue
+            _crypto_stream_skipped.pop(alert.id, None)
+            candidates.append(alert)
+    if candidates:
+        _crypto_stream_inflight.update(alert.id for alert in candidates)
+        task = asyncio.create_task(_handle_crypto_tick(binance_symbol, candidates, price))
+        _crypto_stream_tasks.add(task)
+        task.add_done_callback(_crypto_stream_tasks.discard)
+
+async def crypto_stream_loop():
+    """Binance combined akışına bağlanır; bağlantı koparsa üstel bekleme ile yeniden bağlanır."""
+    backoff = 1.0
+    while True:
+        resync_task = None
+        try:
+            async with websockets.connect(BINANCE_STREAM_URL, ping_interval=20, ping_timeout=20) as ws:
+                print("Kripto akışına bağlanıldı.")
+                backoff = 1.0
+                _crypto_stream["subscribed"] = set()
+                resync_task = asyncio.create_task(_crypto_stream_resync(ws))
+                async for raw in ws:
+                    message = json.loads(raw)
+                    data = message.get("data")
+                    if not data or data.get("e") != "24hrMiniTicker":
+                        continue  # abonelik yanıtları vb.
+                    on_crypto_tick(data["s"], float(data["c"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Kripto akışı bağlantı hatası: {e}. {backoff:.0f} sn sonra yeniden denenecek.")
+        finally:
+            if resync_task:
+                resync_task.cancel()
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, CRYPTO_STREAM_MAX_BACKOFF)
+
 # ----------------------------
 # CRUD for Alerts and Settings
 # ----------------------------
@@ -442,57 +1894,69 @@ def register_token(user_uid: str = Query(...), token: str = Query(...)):
             user.fcm_token = token
         session.add(user)
         session.commit()
+        user_profile_cache.invalidate(user_uid)
+        if user.next_check_at is None:
+            schedule_user_check(user_uid)
     return {"status": "token registered successfully"}
 
 # --- BU FONKSİYONU GÜNCELLEYİN ---
 
+def check_alert_quota(session: Session, user_uid: str):
+    # 1. Adım: Kullanıcının planını ve mevcut alarm sayısını al
+    user = session.get(User, user_uid)
+    if not user:
+        raise HTTPException(status_code=404, detail="Kullanıcı bulunamadı.")
+
+    user_plan = user.plan
+    limit = PLAN_LIMITS.get(user_plan, 5) # Bilinmeyen bir plan varsa, free limiti uygulanır
+
+    # Veritabanından kullanıcının mevcut alarm sayısını verimli bir şekilde say
+    count_statement = select(func.count(Alert.id)).where(Alert.user_uid == user_uid)
+    user_alarm_count = session.exec(count_statement).one()
+
+    # 2. Adım: Limiti kontrol et
+    if user_alarm_count >= limit:
+        # Eğer kullanıcı limitine ulaşmışsa, 403 Forbidden hatası döndür
+        raise HTTPException(
+            status_code=403,
+            detail="Alarm limitinize ulaştınız. Daha fazla alarm kurmak için lütfen planınızı yükseltin."
+        )
+
+def save_alert(session: Session, alert: Alert) -> Alert:
+    session.add(alert)
+    session.commit()
+    session.refresh(alert)
+    return alert
+
 @app.post("/alerts", response_model=Alert)
 async def create_alert(alert_in: AlertCreate):
     try:
-        with Session(engine) as session:
-            # 1. Adım: Kullanıcının planını ve mevcut alarm sayısını al
-            user = session.get(User, alert_in.user_uid)
-            if not user:
-                raise HTTPException(status_code=404, detail="Kullanıcı bulunamadı.")
-
-            user_plan = user.plan
-            limit = PLAN_LIMITS.get(user_plan, 5) # Bilinmeyen bir plan varsa, free limiti uygulanır
-
-            # Veritabanından kullanıcının mevcut alarm sayısını verimli bir şekilde say
-            count_statement = select(func.count(Alert.id)).where(Alert.user_uid == alert_in.user_uid)
-            user_alarm_count = session.exec(count_statement).one()
-            
-            # 2. Adım: Limiti kontrol et
-            if user_alarm_count >= limit:
-                # Eğer kullanıcı limitine ulaşmışsa, 403 Forbidden hatası döndür
-                raise HTTPException(
-                    status_code=403, 
-                    detail="Alarm limitinize ulaştınız. Daha fazla alarm kurmak için lütfen planınızı yükseltin."
-                )
+        await run_db(check_alert_quota, alert_in.user_uid)
+
+        # 3. Adım: Limit aşılmadıysa, alarmı oluşturma işlemine devam et
+        # Fiyat beklenirken veritabanı bağlantısı tutulmaz.
+        current_price_raw = await fetch_price(alert_in.symbol)
+        if current_price_raw is None:
+            raise HTTPException(status_code=400, detail=f"Fiyat bulunamadı: {alert_in.symbol}")
+
+        current_price = float(current_price_raw)
+        perc = float(alert_in.percentage)
+
+        alert = Alert(
+            market=alert_in.market,
+            symbol=alert_in.symbol.upper(),
+            percentage=perc,
+            base_price=current_price,
+            upper_limit=current_price * (1 + perc / 100),
+            lower_limit=current_price * (1 - perc / 100),
+            user_uid=alert_in.user_uid
+        )
 
-            # 3. Adım: Limit aşılmadıysa, alarmı oluşturma işlemine devam et
-            current_price_raw = await fetch_price(alert_in.symbol)
-            if current_price_raw is None:
-                raise HTTPException(status_code=400, detail=f"Fiyat bulunamadı: {alert_in.symbol}")
+        alert = await run_db(save_alert, alert)
+        alert_index_add(alert)
+        return alert
 
-            current_price = float(current_price_raw)
-            perc = float(alert_in.percentage)
-
-            alert = Alert(
-                market=alert_in.market,
-                symbol=alert_in.symbol.upper(),
-                percentage=perc,
-                base_price=current_price,
-                upper_limit=current_price * (1 + perc / 100),
-                lower_limit=current_price * (1 - perc / 100),
-                user_uid=alert_in.user_uid
-            )
 
-            session.add(alert)
-            session.commit()
-            session.refresh(alert)
-            return alert
-            
     except HTTPException:
         raise # HTTPException'ları tekrar fırlat ki FastAPI doğru yanıtı versin
     except Exception as e:
@@ -516,33 +1980,32 @@ def delete_alert(alert_id: int, user_uid: str = Query(..., description="The UID
             raise HTTPException(status_code=404, detail="Alert not found or permission denied")
         session.delete(alert)
         session.commit()
+    alert_index_remove([alert_id])
     return {"ok": True}
 
 @app.put("/alerts/{alert_id}", response_model=Alert)
 async def edit_alert(alert_id: int, alert_in: AlertCreate): 
     try:
-        with Session(engine) as session:
-            alert = session.get(Alert, alert_id)
-            
-            if not alert or alert.user_uid != alert_in.user_uid:
-                raise HTTPException(status_code=404, detail="Alert not found or permission denied")
-
-            alert.market = alert_in.market
-            alert.symbol = alert_in.symbol.upper()
-            alert.percentage = float(alert_in.percentage)
-            alert.user_uid = alert_in.user_uid
-
-            current_price_raw = await fetch_price(alert.symbol)
-            if current_price_raw is not None:
-                current_price = float(current_price_raw)
-                alert.base_price = current_price
-                alert.upper_limit = current_price * (1 + alert.percentage / 100)
-                alert.lower_limit = current_price * (1 - alert.percentage / 100)
-
-            session.add(alert)
-            session.commit()
-            session.refresh(alert)
-            return alert
+        alert = await run_db(lambda session: session.get(Alert, alert_id))
+
+        if not alert or alert.user_uid != alert_in.user_uid:
+            raise HTTPException(status_code=404, detail="Alert not found or permission denied")
+
+        alert.market = alert_in.market
+        alert.symbol = alert_in.symbol.upper()
+        alert.percentage = float(alert_in.percentage)
+        alert.user_uid = alert_in.user_uid
+
+        current_price_raw = await fetch_price(alert.symbol)
+        if current_price_raw is not None:
+            current_price = float(current_price_raw)
+            alert.base_price = current_price
+            alert.upper_limit = current_price * (1 + alert.percentage / 100)
+            alert.lower_limit = current_price * (1 - alert.percentage / 100)
+
+        alert = await run_db(save_alert, alert)
+        alert_index_add(alert)
+        return alert
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
@@ -576,110 +2039,128 @@ def update_user_settings(user_uid: str, settings: UserSettings):
         
         session.commit()
         session.refresh(user)
+        user_profile_cache.invalidate(user_uid)
         return user
 
 # ----------------------------
 # Push Notification
 # ----------------------------
-def send_push_notification(token: str, title: str, body: str):
-    try:
-        message = messaging.Message(
-            notification=messaging.Notification(title=title, body=body),
-            
-            data={
-                "title": title,
-                "body": body,
-                "click_action": "FLUTTER_NOTIFICATION_CLICK", 
-            },
-            
-            android=messaging.AndroidConfig(
-                priority="high",
-            ),
-            
-            apns=messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(
-                        content_available=True,
-                    )
+# FCM send_each çağrısı başına en fazla 500 mesaj kabul eder.
+FCM_BATCH_SIZE = 500
+FCM_MAX_WORKERS = int(os.getenv("FCM_MAX_WORKERS", "4"))
+_fcm_executor = ThreadPoolExecutor(max_workers=FCM_MAX_WORKERS, thread_name_prefix="fcm")
+
+# Bu hatalar token'ın artık geçersiz olduğunu gösterir; token veritabanından temizlenir.
+# InvalidArgumentError bilerek dahil değildir: FCM onu bozuk mesaj içeriği için de döndürür
+# ve bu durumda geçerli token'lar silinirdi.
+FCM_INVALID_TOKEN_ERRORS = (
+    messaging.UnregisteredError,
+    messaging.SenderIdMismatchError,
+)
+
+def build_push_message(token: str, title: str, body: str) -> messaging.Message:
+    return messaging.Message(
+        notification=messaging.Notification(title=title, body=body),
+        
+        data={
+            "title": title,
+            "body": body,
+            "click_action": "FLUTTER_NOTIFICATION_CLICK", 
+        },
+        
+        android=messaging.AndroidConfig(
+            priority="high",
+        ),
+        
+        apns=messaging.APNSConfig(
+            payload=messaging.APNSPayload(
+                aps=messaging.Aps(
+                    content_available=True,
                 )
-            ),
-            token=token
-        )
-        response = messaging.send(message)
-        print(f"Push notification sent successfully: {response}")
-    except Exception as e:
-        print(f"Error sending FCM notification: {e}")
+            )
+        ),
+        token=token
+    )
+
+def clear_invalid_fcm_tokens(session: Session, tokens: set):
+    """Geçersiz token'ları tek bir UPDATE ile temizler."""
+    if not tokens:
+        return
+    session.exec(update(User).where(User.fcm_token.in_(tokens)).values(fcm_token=None))
+    session.commit()
+    print(f"{len(tokens)} adet geçersiz FCM token'ı temizlendi.")
+
+async def dispatch_notifications(messages: List[messaging.Message]) -> Dict[str, bool]:
+    """
+    Bir turda biriken mesajları 500'lük parçalar halinde messaging.send_each ile,
+    sınırlı bir thread havuzunda gönderir. Token bazında sonuç (başarılı mı) döner.
+    """
+    if not messages:
+        return {}
+
+    loop = asyncio.get_running_loop()
+    chunks = [messages[i:i + FCM_BATCH_SIZE] for i in range(0, len(messages), FCM_BATCH_SIZE)]
+    batch_results = await asyncio.gather(
+        *(loop.run_in_executor(_fcm_executor, messaging.send_each, chunk) for chunk in chunks),
+        return_exceptions=True
+    )
+
+    token_results: Dict[str, bool] = {}
+    invalid_tokens = set()
+    for chunk, batch in zip(chunks, batch_results):
+        if isinstance(batch, Exception):
+            print(f"Error sending FCM batch ({len(chunk)} mesaj): {batch}")
+            for message in chunk:
+                token_results.setdefault(message.token, False)
+            continue
+        for message, response in zip(chunk, batch.responses):
+            # Aynı token'a giden mesajlardan biri başarılıysa token sağlam kabul edilir.
+            token_results[message.token] = token_results.get(message.token, False) or response.success
+            if not response.success and isinstance(response.exception, FCM_INVALID_TOKEN_ERRORS):
+                invalid_tokens.add(message.token)
+
+    # Aynı token'a giden başka bir mesaj başarılıysa token geçerlidir.
+    invalid_tokens = {token for token in invalid_tokens if not token_results[token]}
+    sent_count = sum(1 for ok in token_results.values() if ok)
+    print(f"FCM: {len(messages)} mesaj {len(chunks)} toplu çağrıda gönderildi, "
+          f"{sent_count}/{len(token_results)} token başarılı, {len(invalid_tokens)} geçersiz.")
+
+    if invalid_tokens:
+        try:
+            await run_db(clear_invalid_fcm_tokens, invalid_tokens)
+        except Exception as e:
+            print(f"Geçersiz FCM token'ları temizlenirken hata: {e}")
+    return token_results
+
 # ----------------------------
 # Price Fetch
 # ----------------------------
-_exchange_rate_cache = {}
+def detect_market(symbol: str) -> Optional[str]:
+    """Sembolün hangi piyasaya ait olduğunu bulur."""
+    if symbol in ("ALTIN", "GÜMÜŞ", "BAKIR"):
+        return "METALS"
+    if symbol.endswith(".IS") or symbol in BIST_FALLBACK_NAMES:
+        return "BIST"
+    if symbol in POPULAR_NASDAQ:
+        return "NASDAQ"
+    if symbol.endswith("USDT"):
+        return "CRYPTO"
+    return None
 
 async def fetch_price(symbol: str):
     symbol = symbol.upper()
-    metals_yf = {"ALTIN": "GC=F", "GÜMÜŞ": "SI=F", "BAKIR": "HG=F"}
-    
-    if symbol in metals_yf:
-        try:
-            loop = asyncio.get_event_loop()
-            now = datetime.utcnow()
-            
-            # Dolar/TL kurunu cache'den okumayı dene
-            usdtry = None
-            if "USDTRY" in _exchange_rate_cache:
-                timestamp, rate = _exchange_rate_cache["USDTRY"]
-                if (now - timestamp) < timedelta(minutes=60): # 1 saatlik cache
-                    usdtry = rate
-            
-            # Cache'de yoksa veya süresi geçmişse yeniden çek
-            if usdtry is None:
-                print("Dolar/TL kuru yeniden çekiliyor...")
-                usdtry_ticker = await loop.run_in_executor(None, lambda: yf.Ticker("TRY=X"))
-                usdtry = usdtry_ticker.history(period="1d", auto_adjust=True)['Close'].iloc[-1]
-                _exchange_rate_cache["USDTRY"] = (now, usdtry)
-
-            metal_ticker = await loop.run_in_executor(None, lambda: yf.Ticker(metals_yf[symbol]))
-            price_usd = metal_ticker.history(period="1d", auto_adjust=True)['Close'].iloc[-1]
-            
-            return round((price_usd * usdtry) / 31.1035, 2)
-        except Exception as e:
-            print(f"Error fetching metal {symbol} with yfinance: {e}")
-            return None
-        
-    # Fonksiyonun geri kalanı aynı...
-    if symbol.endswith(".IS") or symbol in BIST_FALLBACK_NAMES:
-        try:
-            yf_symbol = symbol if symbol.endswith(".IS") else f"{symbol}.IS"
-            loop = asyncio.get_event_loop()
-            ticker_obj = await loop.run_in_executor(None, lambda: yf.Ticker(yf_symbol))
-            price = ticker_obj.history(period="1d", auto_adjust=True)['Close'].iloc[-1]
-            return round(float(price), 2)
-        except Exception as e:
-            print(f"Error fetching BIST {symbol} with yfinance: {e}")
-            return None
-
-    async with httpx.AsyncClient(timeout=10) as client:
-        if symbol in POPULAR_NASDAQ:
-            try:
-                r = await client.get(f"{FINNHUB_BASE}/quote", params={"symbol": symbol, "token": FINNHUB_API_KEY})
-                r.raise_for_status()
-                price = r.json().get("c")
-                if price:
-                    return round(float(price), 2)
-            except Exception as e:
-                print(f"Error fetching NASDAQ {symbol} from Finnhub: {e}")
-                return None
-
-        if symbol.endswith("USDT"):
-            try:
-                r = await client.get("https://api.binance.com/api/v3/ticker/price", params={"symbol": symbol})
-                r.raise_for_status()
-                price = float(r.json().get("price", 0))
-                if price > 0:
-                    return round(price, 2)
-            except Exception as e:
-                print(f"Error fetching Crypto {symbol} from Binance: {e}")
-                return None
+    market = detect_market(symbol)
+    if market is None:
         return None
+    if market == "BIST":
+        # fetch_bist_batch sonuçları ".IS" son eki olmadan döndürür.
+        symbol = symbol.split(".")[0]
+    # Birleşik cache sayesinde aynı sembol için art arda kurulan alarmlar tek bir upstream çağrısı yapar.
+    prices = await get_market_prices(market, [symbol])
+    price = prices.get(symbol)
+    if price is None:
+        print(f"Error fetching {market} {symbol}: fiyat bulunamadı")
+    return price
 # ----------------------------
 # --- YENİ ÇEVİRİ SÖZLÜĞÜ (Metal İsimleri) ---
 # ALTIN, GÜMÜŞ, BAKIR sembollerinin farklı dillerdeki karşılıkları.
@@ -799,56 +2280,69 @@ CURRENCY_TICKERS = {
 # ----------------------------
 # METALS
 # ----------------------------
-async def get_metals(user_uid: str) -> Dict[str, Optional[float]]:
-    try:
-        with Session(engine) as session:
-            user = session.get(User, user_uid)
-            language_code = user.language_code if user and user.language_code else 'en'
-
-        target_currency = LANGUAGE_CURRENCY_MAP.get(language_code, 'USD')
-
-        metal_tickers = {"ALTIN": "GC=F", "GÜMÜŞ": "SI=F", "BAKIR": "HG=F"}
-        required_tickers = list(metal_tickers.values())
-        
-        usd_to_target_rate = 1.0 # Default to USD
-
-        if target_currency != "USD":
-            currency_yf_ticker = CURRENCY_TICKERS.get(target_currency)
-            if currency_yf_ticker:
-                required_tickers.append(currency_yf_ticker)
-        
-        loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, 
-            lambda: yf.download(required_tickers, period="1d", progress=False, auto_adjust=True)['Close']
-        )
-
-        if data is None or data.empty:
-            raise ValueError("yfinance'dan veri alınamadı.")
-
-        # Döviz kurunu al
-        if target_currency != "USD" and currency_yf_ticker in data:
-            rate = data[currency_yf_ticker].iloc[-1]
-            if target_currency == "EUR": # EURUSD=X kuru EUR/USD'dir, bize USD/EUR lazım
-                usd_to_target_rate = 1.0 / rate if rate != 0 else 0
-            else: # Diğerleri (TRY=X vb.) zaten USD/CURRENCY şeklindedir
-                usd_to_target_rate = rate
-        
-        result = {}
-        for name, ticker in metal_tickers.items():
-            if ticker in data and not data[ticker].dropna().empty:
-                price_usd_ounce = data[ticker].iloc[-1]
-                price_target_ounce = price_usd_ounce * usd_to_target_rate
-                price_target_gram = price_target_ounce / 31.1035
-                result[name] = round(price_target_gram, 2)
-            else:
-                result[name] = None
-        
-        return result
+# Tüm metallerin tüm para birimlerindeki gram fiyatları tek bir toplu çekimle hesaplanır
+# (metal x para birimi matrisi). /prices metal segmentleri ve METALS alarmları
+# aynı matristen okur; böylece bir yenileme turu para birimi sayısı kadar değil, tek bir çağrı yapar.
+METAL_TICKERS = {"ALTIN": "GC=F", "GÜMÜŞ": "SI=F", "BAKIR": "HG=F"}
+TROY_OUNCE_GRAMS = 31.1035
+METALS_MATRIX_TTL = float(os.getenv("METALS_MATRIX_TTL_SECONDS", "30"))
+
+_metals_matrix: Dict = {"data": None, "timestamp": 0.0}  # data: {para birimi: {metal: gram fiyatı}}
+# Her başarılı matris yenilemesinden sonra listener(matris, unix zamanı) çağrılır.
+metals_matrix_listeners: List = []
+
+def compute_metals_matrix(closes: Dict[str, float]) -> Dict[str, Dict[str, Optional[float]]]:
+    # USD başına kurlar; EURUSD=X kuru EUR/USD olduğu için tersi alınır, diğerleri (TRY=X vb.) zaten USD/X'tir.
+    usd_rates = {"USD": 1.0}
+    for currency, ticker in CURRENCY_TICKERS.items():
+        rate = closes.get(ticker)
+        if currency == "USD" or not rate:
+            continue
+        usd_rates[currency] = 1.0 / rate if currency == "EUR" else rate
+
+    currencies = list(usd_rates)
+    metals = list(METAL_TICKERS)
+    gram_usd = np.array([closes.get(METAL_TICKERS[m], np.nan) for m in metals], dtype=np.float64) / TROY_OUNCE_GRAMS
+    matrix = np.round(np.outer(np.array([usd_rates[c] for c in currencies]), gram_usd), 2)
+    return {
+        currency: {metal: (None if np.isnan(value) else float(value)) for metal, value in zip(metals, row)}
+        for currency, row in zip(currencies, matrix.tolist())
+    }
 
-    except Exception as e:
-        print(f"KRİTİK HATA (get_metals): {e}")
-        traceback.print_exc()
-        return {"Altın": None, "Gümüş": None, "Bakır": None}
+async def get_metals_matrix() -> Dict[str, Dict[str, Optional[float]]]:
+    """Matris taze ise bellekten döner; değilse metaller ve tüm kurlar tek bir indirmeyle yenilenir."""
+    if _metals_matrix["data"] is not None and time.monotonic() - _metals_matrix["timestamp"] < METALS_MATRIX_TTL:
+        return _metals_matrix["data"]
+    async with get_async_lock("metals_matrix"):
+        # Kilidi beklerken başka bir çağrı matrisi yenilemiş olabilir.
+        if _metals_matrix["data"] is not None and time.monotonic() - _metals_matrix["timestamp"] < METALS_MATRIX_TTL:
+            return _metals_matrix["data"]
+        tickers = list(METAL_TICKERS.values()) + [t for c, t in CURRENCY_TICKERS.items() if c != "USD"]
+        try:
+            closes = await yahoo_last_closes(tickers)
+            if not any(ticker in closes for ticker in METAL_TICKERS.values()):
+                raise ValueError("Yahoo/yfinance'dan metal verisi alınamadı.")
+            _metals_matrix["data"] = compute_metals_matrix(closes)
+            _metals_matrix["timestamp"] = time.monotonic()
+            wall_time = time.time()
+            for listener in metals_matrix_listeners:
+                try:
+                    listener(_metals_matrix["data"], wall_time)
+                except Exception as e:
+                    print(f"Metal matrisi: listener hatası: {e}")
+        except Exception as e:
+            # Yenileme başarısızsa (varsa) son matris kullanılmaya devam edilir.
+            print(f"KRİTİK HATA (get_metals_matrix): {e}")
+        return _metals_matrix["data"] or {}
+
+async def get_metals_for_currency(target_currency: str) -> Dict[str, Optional[float]]:
+    matrix = await get_metals_matrix()
+    # Kuru tanımlı olmayan para birimleri için USD fiyatları döner.
+    currency = target_currency if target_currency in CURRENCY_TICKERS else "USD"
+    row = matrix.get(currency)
+    if row is None:
+        return {metal: None for metal in METAL_TICKERS}
+    return dict(row)
 
 # ----------------------------
 # BIST Symbols & Prices
@@ -947,30 +2441,11 @@ BIST_FALLBACK_NAMES = {
     "AKCNS": "Akçansa"
 }
 
-async def get_bist_symbols_with_name():
-    return [{"symbol": s.split(".")[0], "name": BIST_FALLBACK_NAMES.get(s.split(".")[0], s.split(".")[0])}
-            for s in BIST100_SYMBOLS]
-
-async def get_bist_prices():
-    try:
-        data = yf.download(BIST100_SYMBOLS, period="1d", progress=False, auto_adjust=True)['Close']
-    except Exception as e:
-        print(f"Error downloading BIST data: {e}")
-        data = None
-
-    results = []
-    for symbol in BIST100_SYMBOLS:
-        short_symbol = symbol.split(".")[0]
-        price = None
-        if data is not None and not data.empty:
-            try:
-                price_series = data[symbol]
-                if not price_series.dropna().empty:
-                    price = round(float(price_series.dropna().iloc[-1]), 2)
-            except (KeyError, IndexError):
-                price = None
-        results.append({"symbol": short_symbol, "price": price})
-    return results
+async def get_bist_prices(allow_stale: bool = True):
+    short_symbols = [symbol.split(".")[0] for symbol in BIST100_SYMBOLS]
+    prices = await get_market_prices("BIST", short_symbols, allow_stale=allow_stale)
+    stale = quote_cache.stale_symbols("BIST", short_symbols)
+    return [{"symbol": symbol, "price": prices.get(symbol), "stale": symbol in stale} for symbol in short_symbols]
 
 POPULAR_NASDAQ = [
     "AAPL", "TSLA", "MSFT", "AMZN", "GOOGL", "META", "NVDA", "NFLX", "INTC", "AMD", "ADBE", "CSCO", "CMCSA", "PEP",
@@ -979,151 +2454,1052 @@ POPULAR_NASDAQ = [
     "MELI", "EXC", "ALGN", "FAST", "WDAY", "NTES", "SWKS", "KDP"
 ]
 
-async def get_nasdaq_symbols_with_name(n=50):
-    symbols = POPULAR_NASDAQ[:n]
-    results = []
-    async with httpx.AsyncClient(timeout=10) as client:
-        tasks = [client.get(f"{FINNHUB_BASE}/stock/profile2", params={"symbol": sym, "token": FINNHUB_API_KEY}) for sym in symbols]
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
+async def fetch_nasdaq_names(symbols: List[str]) -> Dict[str, str]:
+    """Finnhub profile2'den şirket isimlerini çeker; sadece başarılı cevaplar döner."""
+    names = {}
+    tasks = [
+        provider_get("finnhub", "/stock/profile2", params={"symbol": sym, "token": FINNHUB_API_KEY}, priority=PRIORITY_BACKGROUND)
+        for sym in symbols
+    ]
+    responses = await asyncio.gather(*tasks, return_exceptions=True)
 
     for sym, r in zip(symbols, responses):
-        name = sym
-        if not isinstance(r, Exception) and r.status_code == 200:
-            data = r.json()
-            name = data.get("name") or sym
-        results.append({"symbol": sym, "name": name})
-    return results
+        if not isinstance(r, BaseException) and r.status_code == 200:
+            name = r.json().get("name")
+            if name:
+                names[sym] = name
+    return names
 
-async def get_nasdaq_prices(n=50):
+async def get_nasdaq_prices(n=50, allow_stale: bool = True):
     symbols = POPULAR_NASDAQ[:n]
-    async with httpx.AsyncClient(timeout=10) as client:
-        tasks = [client.get(f"{FINNHUB_BASE}/quote", params={"symbol": sym, "token": FINNHUB_API_KEY}) for sym in symbols]
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    results = []
-    for sym, r in zip(symbols, responses):
-        price = None
-        if not isinstance(r, Exception) and r.status_code == 200:
-            price_val = r.json().get("c")
-            if price_val:
-                price = round(price_val, 2)
-        results.append({"symbol": sym, "price": price})
-    return results
+    prices = await get_market_prices("NASDAQ", symbols, allow_stale=allow_stale)
+    stale = quote_cache.stale_symbols("NASDAQ", symbols)
+    return [{"symbol": sym, "price": prices.get(sym), "stale": sym in stale} for sym in symbols]
 
-async def get_top_crypto_symbols(n=50):
-    url = "https://api.binance.com/api/v3/ticker/price"
-    try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            r = await client.get(url)
+# ----------------------------
+# CRYPTO Symbols & Prices
+# ----------------------------
+# Binance'ten tek istekte tüm piyasanın fiyatı alınır ve hem /prices hem de alarm kontrolü
+# bu anlık görüntüden beslenir. "Top N" sıralaması 24 saatlik quote hacmine göre yapılır.
+CRYPTO_SNAPSHOT_TTL = timedelta(seconds=int(os.getenv("CRYPTO_SNAPSHOT_TTL_SECONDS", "10")))
+CRYPTO_RANKING_TTL = timedelta(minutes=int(os.getenv("CRYPTO_RANKING_TTL_MINUTES", "10")))
+
+_binance_snapshot: Dict = {"timestamp": None, "data": {}}  # "BTCUSDT" -> fiyat
+_binance_ranking: Dict = {"timestamp": None, "data": []}   # hacme göre sıralı USDT çiftleri
+
+async def get_binance_snapshot() -> Dict[str, float]:
+    """Tüm Binance fiyatlarını tek bir /ticker/price isteğiyle çeker ve TTL boyunca paylaşır."""
+    if _binance_snapshot["timestamp"] and (datetime.utcnow() - _binance_snapshot["timestamp"]) < CRYPTO_SNAPSHOT_TTL:
+        return _binance_snapshot["data"]
+
+    async with get_async_lock("binance_snapshot"):
+        # Kilidi beklerken başka bir istek anlık görüntüyü yenilemiş olabilir.
+        if _binance_snapshot["timestamp"] and (datetime.utcnow() - _binance_snapshot["timestamp"]) < CRYPTO_SNAPSHOT_TTL:
+            return _binance_snapshot["data"]
+        try:
+            r = await provider_get("binance", "/ticker/price", weight=4)
             r.raise_for_status()
-            data = r.json()
-            symbols = [d["symbol"] for d in data if d["symbol"].endswith("USDT")]
-            return symbols[:n]
-    except Exception as e:
-        print(f"Error fetching crypto symbols: {e}")
-        return []
+            _binance_snapshot["data"] = {d["symbol"]: float(d["price"]) for d in r.json()}
+            _binance_snapshot["timestamp"] = datetime.utcnow()
+        except Exception as e:
+            # Hata durumunda varsa son başarılı anlık görüntü kullanılmaya devam eder.
+            print(f"Error fetching Binance snapshot: {e}")
+        return _binance_snapshot["data"]
 
-async def get_crypto_prices(n=50):
+async def get_top_crypto_symbols(n=50):
+    """USDT çiftlerini 24 saatlik quote hacmine göre sıralayıp ilk n tanesini döndürür."""
+    if not _binance_ranking["timestamp"] or (datetime.utcnow() - _binance_ranking["timestamp"]) >= CRYPTO_RANKING_TTL:
+        async with get_async_lock("binance_ranking"):
+            if not _binance_ranking["timestamp"] or (datetime.utcnow() - _binance_ranking["timestamp"]) >= CRYPTO_RANKING_TTL:
+                try:
+                    r = await provider_get("binance", "/ticker/24hr", params={"type": "MINI"}, weight=80)
+                    r.raise_for_status()
+                    tickers = [d for d in r.json() if d["symbol"].endswith("USDT")]
+                    tickers.sort(key=lambda d: float(d.get("quoteVolume") or 0), reverse=True)
+                    _binance_ranking["data"] = [d["symbol"] for d in tickers]
+                    _binance_ranking["timestamp"] = datetime.utcnow()
+                except Exception as e:
+                    print(f"Error fetching crypto symbols: {e}")
+    return _binance_ranking["data"][:n]
+
+async def get_crypto_prices(n=50, allow_stale: bool = True):
     symbols = await get_top_crypto_symbols(n)
-    async with httpx.AsyncClient(timeout=10) as client:
-        tasks = [client.get("https://api.binance.com/api/v3/ticker/price", params={"symbol": s}) for s in symbols]
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
+    prices = await get_market_prices("CRYPTO", symbols, allow_stale=allow_stale)
+    stale = quote_cache.stale_symbols("CRYPTO", symbols)
     
     results = []
-    for sym, r in zip(symbols, responses):
-        if not isinstance(r, Exception) and r.status_code == 200:
-            data = r.json()
-            price = round(float(data["price"]), 2)
-            if price > 0:
-                results.append({"symbol": sym[:-4], "price": price}) # USDT son ekini kaldır
+    for sym in symbols:
+        price = prices.get(sym)
+        if price:
+            results.append({"symbol": sym[:-4], "price": price, "stale": sym in stale}) # USDT son ekini kaldır
     return results
 
-@app.get("/prices")
-async def get_all_prices(user_uid: Optional[str] = Query(None)):
-    global _prices_cache
+# ----------------------------
+# /prices Anlık Görüntüsü
+# ----------------------------
+# /prices her zaman bellekteki son anlık görüntüden cevap verir. Segmentler (ana piyasalar ve
+# para birimi bazlı metaller) ayrı kilitlerle, arka plan görevlerinde yenilenir; böylece bir
+# segmentin yavaş yenilenmesi diğerlerini ve okuyucuları bekletmez.
+_prices_refresh_tasks: Dict[str, asyncio.Task] = {}
+_prices_last_read: Dict[str, datetime] = {}
+# Her segment yenilendiğinde artan sürüm numarası; /prices/delta ve akışlar bu numarayı kullanır.
+_prices_version = {"current": 0}
+# Sayaç her process'te sıfırdan başlar. İstemcilere sürüm "<epoch>:<n>" olarak verilir; başka bir
+# process'in (yeniden başlatma öncesi ya da başka bir instance) sürümüyle gelen istek tam anlık görüntü alır.
+PRICES_EPOCH = secrets.token_hex(6)
+# Para birimi bazında bir kez JSON'a çevrilip sıkıştırılmış cevaplar.
+_prices_encoded: Dict[str, Dict] = {}
+# Son sürümlerin değişiklik kümeleri; /prices/delta bu halkadan cevap verir.
+PRICES_DELTA_HISTORY = int(os.getenv("PRICES_DELTA_HISTORY", "256"))
+_prices_changes: deque = deque(maxlen=PRICES_DELTA_HISTORY)
+
+def format_price_version(version: int) -> str:
+    return f"{PRICES_EPOCH}:{version}"
+
+def parse_price_version(value: str) -> Optional[int]:
+    """Bu process'e ait bir sürümse sayacı, değilse (başka epoch, eski tam sayı biçimi vb.) None döndürür."""
+    epoch, _, version = value.partition(":")
+    if epoch != PRICES_EPOCH or not version.isdigit():
+        return None
+    return int(version)
+
+def _segment_price_items(segment_key: str, data) -> Dict[tuple, Tuple[Optional[float], bool]]:
+    """Segment verisini {(market, symbol): (price, stale)} sözlüğüne çevirir."""
+    if data is None:
+        return {}
+    if segment_key == "base":
+        items = {}
+        for market, market_items in zip(("BIST", "NASDAQ", "CRYPTO"), data):
+            for item in market_items:
+                items[(market, item["symbol"])] = (item["price"], item.get("stale", False))
+        return items
+    return {(item["market"], item["symbol"]): (item["price"], item.get("stale", False)) for item in data}
+
+def _segment_version(segment_key: str, old_entry: Dict, new_data) -> int:
+    """
+    Veri değişmediyse eski sürümü korur; böylece kodlanmış cevap tekrar üretilmez ve istemciler 304 alır.
+    Değiştiyse yeni bir sürüm açar ve değişen sembolleri değişiklik halkasına yazar.
+    """
+    if old_entry.get("version") is not None and old_entry.get("data") == new_data:
+        return old_entry["version"]
+    _prices_version["current"] += 1
+    version = _prices_version["current"]
+
+    old_items = _segment_price_items(segment_key, old_entry.get("data"))
+    new_items = _segment_price_items(segment_key, new_data)
+    _prices_changes.append({
+        "version": version,
+        # Ana piyasalar tüm para birimleri için ortaktır; metaller para birimine özeldir.
+        "currency": None if segment_key == "base" else segment_key.split(":", 1)[1],
+        "changed": {key: value for key, value in new_items.items() if old_items.get(key) != value},
+        "removed": [key for key in old_items if key not in new_items],
+    })
+    return version
+
+def _price_segment_entry(segment_key: str) -> Dict:
+    if segment_key == "base":
+        return _prices_cache["base_data"]
+    return _prices_cache["metals_data"].get(segment_key.split(":", 1)[1], {})
+
+async def _refresh_base_segment():
+    async with get_async_lock("prices:base"):
+        try:
+            # Yenileyici yeni veri çekmek için vardır: cache'in stale-while-revalidate yolu kullanılırsa
+            # anlık görüntü her zaman bir upstream turu geride kalır.
+            bist, nasdaq, crypto = await asyncio.gather(
+                get_bist_prices(allow_stale=False),
+                get_nasdaq_prices(allow_stale=False),
+                get_crypto_prices(allow_stale=False),
+            )
+            data = (bist, nasdaq, crypto)
+            _prices_cache["base_data"] = {
+                "data": data,
+                "timestamp": datetime.utcnow(),
+                "version": _segment_version("base", _prices_cache["base_data"], data)
+            }
+            publish_price_updates()
+        except Exception as e:
+            print(f"Ana cache (BIST, NASDAQ, CRYPTO) yenilenemedi: {e}")
+
+async def _refresh_metals_segment(currency: str):
+    async with get_async_lock(f"prices:metals:{currency}"):
+        try:
+            metals_dict = await get_metals_for_currency(currency)
+            # Matris yenilenemediyse son başarılı matristen sunulan fiyatlar "stale" olarak işaretlenir.
+            stale = time.monotonic() - _metals_matrix["timestamp"] >= METALS_MATRIX_TTL
+            data = [{"market": "METALS", "symbol": k, "price": v, "stale": stale} for k, v in metals_dict.items()]
+            _prices_cache["metals_data"][currency] = {
+                "data": data,
+                "timestamp": datetime.utcnow(),
+                "version": _segment_version(f"metals:{currency}", _prices_cache["metals_data"].get(currency, {}), data)
+            }
+            publish_price_updates()
+        except Exception as e:
+            print(f"Metaller için '{currency}' cache'i yenilenemedi: {e}")
+
+def start_price_segment_refresh(segment_key: str) -> asyncio.Task:
+    """Segment için süren bir yenileme varsa onu, yoksa yeni bir arka plan yenilemesini döndürür."""
+    task = _prices_refresh_tasks.get(segment_key)
+    if task is None or task.done():
+        if segment_key == "base":
+            coro = _refresh_base_segment()
+        else:
+            coro = _refresh_metals_segment(segment_key.split(":", 1)[1])
+        task = _prices_refresh_tasks[segment_key] = asyncio.create_task(coro)
+    return task
+
+async def read_price_segment(segment_key: str) -> Optional[Dict]:
+    """
+    Segmenti (data, timestamp, version) bellekten okur; süresi geçtiyse arka planda yeniler,
+    sadece azami bayatlık aşıldıysa bekler.
+    """
+    now = datetime.utcnow()
+    _prices_last_read[segment_key] = now
+    entry = _price_segment_entry(segment_key)
+    timestamp = entry.get("timestamp")
+    if timestamp is not None:
+        age = now - timestamp
+        if age >= CACHE_DURATION:
+            start_price_segment_refresh(segment_key)
+        if age < PRICES_MAX_STALENESS:
+            return entry
+    # Hiç veri yok ya da azami bayatlık aşıldı: devam eden yenilemeyi bekle.
+    await asyncio.shield(start_price_segment_refresh(segment_key))
+    entry = _price_segment_entry(segment_key)
+    if entry.get("timestamp") is None or datetime.utcnow() - entry["timestamp"] >= PRICES_MAX_STALENESS:
+        return None
+    return entry
+
+async def prices_refresh_loop():
+    """Yakın zamanda okunan segmentleri süreleri dolduğunda arka planda yeniler."""
+    while True:
+        await asyncio.sleep(PRICES_REFRESH_POLL_SECONDS)
+        now = datetime.utcnow()
+        # Canlı abonesi olan segmentler okunuyor sayılır.
+        for currency in {group["currency"] for group in _price_stream_groups.values()}:
+            _prices_last_read["base"] = now
+            _prices_last_read[f"metals:{currency}"] = now
+        for segment_key, last_read in list(_prices_last_read.items()):
+            if now - last_read > PRICES_IDLE_TIMEOUT:
+                continue
+            timestamp = _price_segment_entry(segment_key).get("timestamp")
+            if timestamp is None or now - timestamp >= CACHE_DURATION:
+                start_price_segment_refresh(segment_key)
+
+def format_prices_snapshot(base_entry: Dict, metals_entry: Dict) -> List[Dict]:
+    bist, nasdaq, crypto = base_entry["data"]
+    # Sonuçları formatla ve birleştir
+    bist_formatted = [{"market": "BIST", **item} for item in bist]
+    nasdaq_formatted = [{"market": "NASDAQ", **item} for item in nasdaq]
+    crypto_formatted = [{"market": "CRYPTO", **item} for item in crypto]
     
-    if user_uid is None:
-        raise HTTPException(status_code=400, detail="Fiyatları çekmek için Kullanıcı ID'si gereklidir.")
+    return bist_formatted + nasdaq_formatted + crypto_formatted + metals_entry["data"]
 
+def get_encoded_prices(currency: str, base_entry: Dict, metals_entry: Dict) -> Dict:
+    """
+    Anlık görüntüyü para birimi başına, segment sürümleri değiştiğinde sadece bir kez JSON'a çevirir
+    ve gzip ile sıkıştırır. Sonraki istekler hazır byte'ları döndürür.
+    """
+    key = (base_entry["version"], metals_entry["version"])
+    encoded = _prices_encoded.get(currency)
+    if encoded and encoded["key"] == key:
+        return encoded
+
+    all_data = format_prices_snapshot(base_entry, metals_entry)
+    raw = json.dumps(all_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    encoded = {"key": key, "etag": content_etag(raw), "json": raw, "gzip": gzip.compress(raw, compresslevel=6, mtime=0)}
+    _prices_encoded[currency] = encoded
+    return encoded
+
+def content_etag(body: bytes) -> str:
+    """
+    ETag içerikten türetilir: sürüm sayaçları process'e özel olduğundan yeniden başlatmada veya
+    farklı instance'larda aynı sürüm farklı veriye karşılık gelebilir.
+    """
+    return f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+def encoded_json_response(request: Request, body: bytes, gzipped: bytes, etag: str) -> Response:
+    """
+    Hazır byte'lardan ETag'li bir cevap döndürür; If-None-Match eşleşirse 304.
+    Gzip'li ve sıkıştırılmamış gövdeler farklı byte'lar olduğu için farklı ETag taşır.
+    """
+    use_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    if use_gzip:
+        etag = f'{etag[:-1]}-gzip"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=gzipped, media_type="application/json", headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# ----------------------------
+# Kullanıcı Profili Cache'i
+# ----------------------------
+# Sık okunan endpoint'ler (/prices, /prices/delta, akışlar, metaller) sadece kullanıcının dil/para birimi
+# bilgisine ihtiyaç duyar. Bu alanlar LRU+TTL bir cache'te tutulur ve kullanıcıyı değiştiren
+# endpoint'lerde (ayarlar, token kaydı, RevenueCat webhook'u) geçersiz kılınır.
+USER_PROFILE_TTL_SECONDS = float(os.getenv("USER_PROFILE_TTL_SECONDS", "300"))
+USER_PROFILE_CACHE_MAX_ENTRIES = int(os.getenv("USER_PROFILE_CACHE_MAX_ENTRIES", "50000"))
+
+class UserProfile(NamedTuple):
+    language_code: str
+    currency: str
+    plan: str
+    notifications_enabled: bool
+
+class UserProfileCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  # uid -> (UserProfile veya None, monotonic zaman)
+        # Sync endpoint'ler threadpool'dan geçersiz kıldığı için erişim kilitle korunur.
+        self._lock = threading.Lock()
+        # Her geçersiz kılmada artar; okuma sürerken değişirse okunan (eski) değer cache'e yazılmaz.
+        self.generation = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, uid: str):
+        """(bulundu mu, profil) döndürür; kayıtlı olmayan kullanıcılar da (None olarak) cache'lenir."""
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(uid)
+                self.stats["hits"] += 1
+                return True, entry[0]
+            self.stats["misses"] += 1
+            return False, None
+
+    def put(self, uid: str, profile: Optional[UserProfile], generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[uid] = (profile, time.monotonic())
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, uid: str):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(uid, None)
+            self.stats["invalidations"] += 1
+
+    def snapshot_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else None,
+            }
+
+user_profile_cache = UserProfileCache(USER_PROFILE_TTL_SECONDS, USER_PROFILE_CACHE_MAX_ENTRIES)
+
+def _load_user_profile(session: Session, user_uid: str) -> Optional[UserProfile]:
+    row = session.exec(
+        select(User.language_code, User.plan, User.notifications_enabled).where(User.uid == user_uid)
+    ).first()
+    if row is None:
+        return None
+    language_code = row[0] or 'en'
+    return UserProfile(language_code, LANGUAGE_CURRENCY_MAP.get(language_code, 'USD'), row[1], row[2])
+
+async def get_user_profile(user_uid: str) -> Optional[UserProfile]:
+    found, profile = user_profile_cache.get(user_uid)
+    if found:
+        return profile
+    generation = user_profile_cache.generation
+    profile = await run_db(_load_user_profile, user_uid)
+    user_profile_cache.put(user_uid, profile, generation)
+    return profile
+
+async def resolve_user_currency(user_uid: str) -> str:
+    """Kullanıcının diline göre metal fiyatlarının gösterileceği para birimini döndürür."""
     try:
-        with Session(engine) as session:
-            user = session.get(User, user_uid)
-            language_code = user.language_code if user and user.language_code else 'en'
-        target_currency = LANGUAGE_CURRENCY_MAP.get(language_code, 'USD')
+        profile = await get_user_profile(user_uid)
+        return profile.currency if profile else LANGUAGE_CURRENCY_MAP.get('en', 'USD')
     except Exception as e:
         print(f"Kullanıcı ayarları alınırken hata: {e}")
-        target_currency = 'USD'
+        return 'USD'
 
-    async with _prices_cache_lock:
-        base_data_to_fetch = False
-        metals_data_to_fetch = False
-        
-        # 1. Sabit veriler (BIST, NASDAQ, CRYPTO) için ana cache'i kontrol et
-        base_cache = _prices_cache["base_data"]
-        if not base_cache.get("timestamp") or (datetime.utcnow() - base_cache["timestamp"]) >= CACHE_DURATION:
-            print("Ana cache (BIST, NASDAQ, CRYPTO) süresi geçmiş. API'ler çağrılacak.")
-            base_data_to_fetch = True
-        else:
-            print("Ana cache (BIST, NASDAQ, CRYPTO) kullanılıyor.")
-            bist, nasdaq, crypto = base_cache["data"]
-
-        # 2. Metaller için para birimine özel cache'i kontrol et
-        metals_cache = _prices_cache["metals_data"].get(target_currency, {})
-        if not metals_cache.get("timestamp") or (datetime.utcnow() - metals_cache["timestamp"]) >= CACHE_DURATION:
-            print(f"Metaller için '{target_currency}' cache'i süresi geçmiş. Hesaplama yapılacak.")
-            metals_data_to_fetch = True
-        else:
-            print(f"Metaller için '{target_currency}' cache'i kullanılıyor.")
-            metals = metals_cache["data"]
-
-        # 3. Sadece cache'de olmayan verileri API'lerden çek
-        tasks_to_run = []
-        if base_data_to_fetch:
-            tasks_to_run.extend([get_bist_prices(), get_nasdaq_prices(), get_crypto_prices()])
-        if metals_data_to_fetch:
-            tasks_to_run.append(get_metals(user_uid=user_uid))
-
-        if tasks_to_run:
-            results = await asyncio.gather(*tasks_to_run)
-            
-            result_index = 0
-            if base_data_to_fetch:
-                bist, nasdaq, crypto = results[result_index:result_index+3]
-                result_index += 3
-                # Ana cache'i güncelle
-                _prices_cache["base_data"] = {
-                    "data": (bist, nasdaq, crypto),
-                    "timestamp": datetime.utcnow()
-                }
-
-            if metals_data_to_fetch:
-                metals_dict = results[result_index]
-                metals = [{"market": "METALS", "symbol": k, "price": v} for k, v in metals_dict.items()]
-                # Para birimine özel metal cache'ini güncelle
-                _prices_cache["metals_data"][target_currency] = {
-                    "data": metals,
-                    "timestamp": datetime.utcnow()
-                }
-        
-        # Sonuçları formatla ve birleştir
-        bist_formatted = [{"market": "BIST", **item} for item in bist]
-        nasdaq_formatted = [{"market": "NASDAQ", **item} for item in nasdaq]
-        crypto_formatted = [{"market": "CRYPTO", **item} for item in crypto]
-        
-        all_data = bist_formatted + nasdaq_formatted + crypto_formatted + metals
-        
-        return all_data
+async def read_prices_snapshot(target_currency: str):
+    base_entry, metals_entry = await asyncio.gather(
+        read_price_segment("base"),
+        read_price_segment(f"metals:{target_currency}")
+    )
+    if base_entry is None or metals_entry is None:
+        raise HTTPException(status_code=503, detail="Fiyat verisi şu anda alınamıyor.")
+    return base_entry, metals_entry
+
+@app.get("/prices")
+async def get_all_prices(request: Request, user_uid: Optional[str] = Query(None)):
+    if user_uid is None:
+        raise HTTPException(status_code=400, detail="Fiyatları çekmek için Kullanıcı ID'si gereklidir.")
+
+    target_currency = await resolve_user_currency(user_uid)
+    base_entry, metals_entry = await read_prices_snapshot(target_currency)
+
+    encoded = get_encoded_prices(target_currency, base_entry, metals_entry)
+    return encoded_json_response(request, encoded["json"], encoded["gzip"], encoded["etag"])
+
+def collect_price_changes(since: int, currency: str):
+    """
+    `since` sürümünden sonraki değişiklikleri (değişenler, kaldırılanlar) olarak birleştirir.
+    İstenen sürüm halkadan düşmüşse None döner; bu durumda tam anlık görüntü gerekir.
+    """
+    current_version = _prices_version["current"]
+    oldest_version = _prices_changes[0]["version"] if _prices_changes else current_version + 1
+    if since == 0 or since > current_version or since < oldest_version - 1:
+        return None
+
+    merged: Dict[tuple, Tuple[Optional[float], bool]] = {}
+    removed = set()
+    for change in _prices_changes:
+        if change["version"] <= since or change["currency"] not in (None, currency):
+            continue
+        for key in change["removed"]:
+            merged.pop(key, None)
+            removed.add(key)
+        for key, value in change["changed"].items():
+            removed.discard(key)
+            merged[key] = value
+
+    return (
+        [
+            {"market": market, "symbol": symbol, "price": price, "stale": stale}
+            for (market, symbol), (price, stale) in merged.items()
+        ],
+        [{"market": market, "symbol": symbol} for market, symbol in removed],
+    )
+
+@app.get("/prices/delta")
+async def get_prices_delta(since: str = Query(...), user_uid: Optional[str] = Query(None)):
+    """
+    `since` sürümünden bu yana fiyatı değişen sembolleri döndürür. İstenen sürüm değişiklik
+    halkasından düşmüşse veya başka bir epoch'a aitse (sunucu yeniden başlamış) tam anlık görüntü döner.
+    """
+    if user_uid is None:
+        raise HTTPException(status_code=400, detail="Fiyatları çekmek için Kullanıcı ID'si gereklidir.")
+
+    target_currency = await resolve_user_currency(user_uid)
+    base_entry, metals_entry = await read_prices_snapshot(target_currency)
+
+    current_version = format_price_version(_prices_version["current"])
+    since_version = parse_price_version(since)
+    changes = None if since_version is None else collect_price_changes(since_version, target_currency)
+    if changes is None:
+        return {
+            "version": current_version,
+            "full": True,
+            "prices": format_prices_snapshot(base_entry, metals_entry),
+        }
+
+    changed, removed = changes
+    return {"version": current_version, "full": False, "changes": changed, "removed": removed}
     
+# ----------------------------
+# Canlı Fiyat Yayını (WebSocket / SSE)
+# ----------------------------
+# Aboneler (para birimi, piyasalar, semboller) anahtarına göre gruplanır. Her yenilemeden sonra
+# değişiklikler grup başına bir kez JSON'a çevrilir ve gruptaki tüm bağlantıların kuyruğuna konur.
+PRICE_STREAM_QUEUE_SIZE = int(os.getenv("PRICE_STREAM_QUEUE_SIZE", "16"))
+PRICE_STREAM_KEEPALIVE_SECONDS = float(os.getenv("PRICE_STREAM_KEEPALIVE_SECONDS", "25"))
+
+_price_stream_groups: Dict[tuple, Dict] = {}
+
+def _parse_csv_param(value: Optional[str]) -> frozenset:
+    return frozenset(part.strip().upper() for part in (value or "").split(",") if part.strip())
+
+def _price_item_selected(group: Dict, item: Dict) -> bool:
+    if not group["markets"] and not group["symbols"]:
+        return True
+    return item["market"] in group["markets"] or item["symbol"] in group["symbols"]
+
+async def subscribe_prices(user_uid: str, markets: Optional[str], symbols: Optional[str]):
+    """Bağlantıyı uygun gruba ekler; (grup anahtarı, kuyruk, ilk tam anlık görüntü) döndürür."""
+    currency = await resolve_user_currency(user_uid)
+    base_entry, metals_entry = await read_prices_snapshot(currency)
+
+    # Anlık görüntü okunduktan sonra arada await olmadan kaydolunur; böylece ilk mesajla
+    # sonraki değişiklikler arasında boşluk ya da tekrar oluşmaz.
+    version = _prices_version["current"]
+    key = (currency, _parse_csv_param(markets), _parse_csv_param(symbols))
+    group = _price_stream_groups.get(key)
+    if group is None:
+        group = _price_stream_groups[key] = {
+            "currency": key[0], "markets": key[1], "symbols": key[2],
+            "version": version, "queues": set(), "snapshot": (None, None),
+        }
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PRICE_STREAM_QUEUE_SIZE)
+    group["queues"].add(queue)
+
+    cached_version, payload = group["snapshot"]
+    if cached_version != version:
+        items = [item for item in format_prices_snapshot(base_entry, metals_entry) if _price_item_selected(group, item)]
+        payload = json.dumps(
+            {"type": "snapshot", "version": format_price_version(version), "prices": items},
+            ensure_ascii=False, separators=(",", ":")
+        )
+        group["snapshot"] = (version, payload)
+    return key, queue, payload
+
+def unsubscribe_prices(key: tuple, queue: asyncio.Queue):
+    group = _price_stream_groups.get(key)
+    if group is None:
+        return
+    group["queues"].discard(queue)
+    if not group["queues"]:
+        del _price_stream_groups[key]
+
+def publish_price_updates():
+    """Segment yenilemelerinden sonra her gruba yeni değişiklikleri tek seferde kodlayıp iletir."""
+    current_version = _prices_version["current"]
+    for group in list(_price_stream_groups.values()):
+        if group["version"] >= current_version:
+            continue
+        changes = collect_price_changes(group["version"], group["currency"])
+        group["version"] = current_version
+        if changes is None:
+            # Grubun sürümü değişiklik halkasından düşmüş: bağlantılar kapatılır, istemciler yeniden
+            # bağlanıp tam anlık görüntü alır (sessizce değişiklik kaçırmak yerine).
+            for queue in list(group["queues"]):
+                _close_price_stream_queue(queue)
+            continue
+        changed = [item for item in changes[0] if _price_item_selected(group, item)]
+        removed = [item for item in changes[1] if _price_item_selected(group, item)]
+        if not changed and not removed:
+            continue
+        payload = json.dumps(
+            {"type": "delta", "version": format_price_version(current_version), "changes": changed, "removed": removed},
+            ensure_ascii=False, separators=(",", ":")
+        )
+        for queue in list(group["queues"]):
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                # Yetişemeyen bağlantı kapatılır; istemci yeniden bağlanıp tam anlık görüntü alır.
+                _close_price_stream_queue(queue)
+
+def _close_price_stream_queue(queue: asyncio.Queue):
+    """Bekleyen mesajları atar ve bağlantıyı kapatma işaretini (None) kuyruğa koyar."""
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+@app.websocket("/ws/prices")
+async def ws_prices(websocket: WebSocket, user_uid: str, markets: Optional[str] = None, symbols: Optional[str] = None):
+    await websocket.accept()
+    try:
+        key, queue, snapshot = await subscribe_prices(user_uid, markets, symbols)
+    except HTTPException:
+        await websocket.close(code=1013)
+        return
+
+    async def pump():
+        await websocket.send_text(snapshot)
+        while True:
+            payload = await queue.get()
+            if payload is None:
+                return
+            await websocket.send_text(payload)
+
+    async def wait_disconnect():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+    tasks = [asyncio.create_task(pump()), asyncio.create_task(wait_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        unsubscribe_prices(key, queue)
+        if tasks[0].done() and not tasks[1].done():
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+@app.get("/prices/stream")
+async def sse_prices(user_uid: str, markets: Optional[str] = None, symbols: Optional[str] = None):
+    """/ws/prices'ın Server-Sent Events karşılığı."""
+    key, queue, snapshot = await subscribe_prices(user_uid, markets, symbols)
+
+    async def event_stream():
+        try:
+            yield f"data: {snapshot}\n\n"
+            while True:
+                try:
+                    payload = await asyncio.wait_for(queue.get(), PRICE_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if payload is None:
+                    return
+                yield f"data: {payload}\n\n"
+        finally:
+            unsubscribe_prices(key, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ----------------------------
+# Fiyat Geçmişi
+# ----------------------------
+# Upstream'den çekilen her fiyat, sembol başına sabit kapasiteli bir NumPy halkasına eklenir
+# ve periyodik olarak PriceHistory tablosuna toplu yazılır. /history önce bellekten,
+# bellekte olmayan eski aralık için veritabanından okur ve istenen nokta sayısına indirger.
+PRICE_HISTORY_ENABLED = os.getenv("PRICE_HISTORY_ENABLED", "1") == "1"
+PRICE_HISTORY_BUFFER_SIZE = int(os.getenv("PRICE_HISTORY_BUFFER_SIZE", "4096"))
+PRICE_HISTORY_FLUSH_SECONDS = float(os.getenv("PRICE_HISTORY_FLUSH_SECONDS", "60"))
+PRICE_HISTORY_RETENTION = timedelta(days=int(os.getenv("PRICE_HISTORY_RETENTION_DAYS", "30")))
+PRICE_HISTORY_MAX_POINTS = 2000
+
+class PriceRingBuffer:
+    """(unix zamanı, fiyat) çiftlerini iki float64 dizisinde tutan sabit kapasiteli halka."""
+    __slots__ = ("ts", "prices", "total", "flushed")
+
+    def __init__(self, capacity: int):
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.prices = np.zeros(capacity, dtype=np.float64)
+        self.total = 0    # şimdiye kadar eklenen kayıt sayısı (halka başa sarsa da artar)
+        self.flushed = 0  # veritabanına yazılmış kayıt sayısı
+
+    def append(self, ts: float, price: float):
+        capacity = len(self.ts)
+        if self.total and self.ts[(self.total - 1) % capacity] >= ts:
+            return  # zaman sırası bozulmasın
+        i = self.total % capacity
+        self.ts[i] = ts
+        self.prices[i] = price
+        self.total += 1
+
+    def since(self, position: int):
+        """`position`'dan itibaren halkada hâlâ duran kayıtları zaman sırasıyla döndürür."""
+        capacity = len(self.ts)
+        start = max(position, self.total - capacity)
+        idx = np.arange(start, self.total) % capacity
+        return self.ts[idx], self.prices[idx]
+
+    def oldest(self) -> Optional[float]:
+        if not self.total:
+            return None
+        return float(self.ts[max(0, self.total - len(self.ts)) % len(self.ts)])
+
+_price_history: Dict[tuple, PriceRingBuffer] = {}  # (market, symbol) -> halka
+_price_history_state = {"last_prune": 0.0}
+
+# Metal geçmişi para birimi başına tutulur; para birimi verilmezse metal alarmlarının kullandığı TRY kabul edilir.
+PRICE_SERIES_METALS_CURRENCY = "TRY"
+
+def price_series_symbol(market: str, symbol: str, currency: Optional[str] = None) -> str:
+    """
+    Geçmiş ve mumlar /prices'ta gösterilen sembollerle tutulur: kripto "BTCUSDT" yerine "BTC",
+    metaller para birimiyle birlikte ("ALTIN:USD").
+    """
+    if market == "CRYPTO" and symbol.endswith("USDT"):
+        return symbol[:-4]
+    if market == "METALS":
+        return f"{symbol}:{currency or PRICE_SERIES_METALS_CURRENCY}"
+    return symbol
+
+def _append_price_history(market: str, symbol: str, price: float, wall_time: float):
+    key = (market, symbol)
+    buffer = _price_history.get(key)
+    if buffer is None:
+        buffer = _price_history[key] = PriceRingBuffer(PRICE_HISTORY_BUFFER_SIZE)
+    buffer.append(wall_time, float(price))
+
+def record_price_history(market: str, prices: Dict[str, float], wall_time: float):
+    # METALS cache'i metal matrisinden okur; metal geçmişi matris yenilendiğinde tüm para birimleri için kaydedilir.
+    if market == "METALS":
+        return
+    for symbol, price in prices.items():
+        _append_price_history(market, price_series_symbol(market, symbol), price, wall_time)
+
+def record_metals_history(matrix: Dict[str, Dict[str, Optional[float]]], wall_time: float):
+    for currency, row in matrix.items():
+        for metal, price in row.items():
+            if price is not None:
+                _append_price_history("METALS", price_series_symbol("METALS", metal, currency), price, wall_time)
+
+if PRICE_HISTORY_ENABLED:
+    quote_cache.listeners.append(record_price_history)
+    metals_matrix_listeners.append(record_metals_history)
+
+def _insert_price_history(session: Session, rows: List[Dict], prune_before: Optional[datetime]):
+    session.exec(insert(PriceHistory), params=rows)
+    if prune_before is not None:
+        session.exec(delete(PriceHistory).where(PriceHistory.ts < prune_before))
+    session.commit()
+
+async def flush_price_history():
+    """Halkalarda henüz yazılmamış kayıtları tek bir toplu INSERT ile veritabanına yazar."""
+    rows, marks = [], []
+    for (market, symbol), buffer in list(_price_history.items()):
+        if buffer.flushed == buffer.total:
+            continue
+        mark = buffer.total
+        ts, prices = buffer.since(buffer.flushed)
+        rows.extend(
+            {"market": market, "symbol": symbol, "ts": datetime.utcfromtimestamp(t), "price": p}
+            for t, p in zip(ts.tolist(), prices.tolist())
+        )
+        marks.append((buffer, mark))
+    if not rows:
+        return
+    # Eski kayıtlar saatte bir temizlenir.
+    prune_before = None
+    if time.time() - _price_history_state["last_prune"] >= 3600:
+        prune_before = datetime.utcnow() - PRICE_HISTORY_RETENTION
+    try:
+        await run_db(_insert_price_history, rows, prune_before)
+    except Exception as e:
+        # Yazılamayan kayıtlar halkada kalır ve bir sonraki turda tekrar denenir.
+        print(f"Fiyat geçmişi yazılırken hata: {e}")
+        return
+    if prune_before is not None:
+        _price_history_state["last_prune"] = time.time()
+    for buffer, mark in marks:
+        buffer.flushed = mark
+
+async def price_history_flush_loop():
+    while True:
+        await asyncio.sleep(PRICE_HISTORY_FLUSH_SECONDS)
+        await flush_price_history()
+
+def _load_price_history(session: Session, market: str, symbol: str, start: datetime, end: datetime):
+    return session.exec(
+        select(PriceHistory.ts, PriceHistory.price)
+        .where(PriceHistory.market == market, PriceHistory.symbol == symbol)
+        .where(PriceHistory.ts >= start, PriceHistory.ts < end)
+        .order_by(PriceHistory.ts)
+    ).all()
+
+def downsample_prices(ts: np.ndarray, prices: np.ndarray, points: int):
+    """Aralığı eşit zaman dilimlerine böler ve her dilimin son fiyatını alır."""
+    if len(ts) <= points:
+        return ts, prices
+    edges = np.linspace(ts[0], ts[-1], points + 1)
+    buckets = np.minimum(np.searchsorted(edges, ts, side="right") - 1, points - 1)
+    last_in_bucket = np.flatnonzero(np.diff(buckets, append=points))
+    return ts[last_in_bucket], prices[last_in_bucket]
+
+@app.get("/history/{market}/{symbol}")
+async def get_price_history(
+    market: str,
+    symbol: str,
+    hours: float = Query(24, gt=0),
+    points: int = Query(300, ge=2, le=PRICE_HISTORY_MAX_POINTS),
+    currency: Optional[str] = Query(None, description="METALS için para birimi (varsayılan TRY)"),
+):
+    market, symbol = market.upper(), symbol.upper()
+    series_symbol = price_series_symbol(market, symbol, currency.upper() if currency else None)
+    end = time.time()
+    start = max(end - hours * 3600, end - PRICE_HISTORY_RETENTION.total_seconds())
+
+    buffer = _price_history.get((market, series_symbol))
+    mem_ts, mem_prices = buffer.since(0) if buffer else (np.empty(0), np.empty(0))
+    oldest_in_memory = buffer.oldest() if buffer else None
+
+    parts_ts, parts_prices = [], []
+    if oldest_in_memory is None or oldest_in_memory > start:
+        # Bellekte olmayan eski kısım veritabanından okunur.
+        db_end = datetime.utcfromtimestamp(oldest_in_memory) if oldest_in_memory else datetime.utcfromtimestamp(end)
+        rows = await run_db(_load_price_history, market, series_symbol, datetime.utcfromtimestamp(start), db_end)
+        if rows:
+            parts_ts.append(np.array([(row[0] - datetime(1970, 1, 1)).total_seconds() for row in rows]))
+            parts_prices.append(np.array([row[1] for row in rows], dtype=np.float64))
+    lo = np.searchsorted(mem_ts, start, side="left")
+    parts_ts.append(mem_ts[lo:])
+    parts_prices.append(mem_prices[lo:])
+
+    ts, prices = downsample_prices(np.concatenate(parts_ts), np.concatenate(parts_prices), points)
+    if not len(ts):
+        raise HTTPException(status_code=404, detail=f"{market}/{symbol} için fiyat geçmişi bulunamadı.")
+    return {
+        "market": market,
+        "symbol": symbol,
+        "points": [[int(t), p] for t, p in zip(ts.tolist(), prices.tolist())],
+    }
+
+# ----------------------------
+# OHLC Mumları
+# ----------------------------
+# Her tick geldiğinde her aralığın sadece son mumu güncellenir (O(1)); ham geçmişten yeniden
+# hesaplama yapılmaz. Mumlar UTC'ye hizalıdır ve aralık başına sınırlı sayıda tutulur.
+# Sağlayıcılar hacim vermediği için hacim (v) mumdaki tick sayısıdır.
+CANDLES_ENABLED = os.getenv("CANDLES_ENABLED", "1") == "1"
+CANDLE_INTERVALS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+CANDLE_RETENTION = {"1m": 1440, "5m": 2016, "1h": 720, "1d": 365}  # 1 gün, 1 hafta, 1 ay, 1 yıl
+
+_candles: Dict[tuple, deque] = {}  # (market, symbol, aralık) -> deque([başlangıç, o, h, l, c, v])
+_candle_last_tick: Dict[tuple, float] = {}  # (market, symbol) -> son işlenen tick zamanı
+
+def record_candle_tick(market: str, symbol: str, price: float, wall_time: float):
+    # Sırası bozuk (daha eski) tick'ler kapanış fiyatını geriye çekmesin diye yok sayılır.
+    if _candle_last_tick.get((market, symbol), 0.0) > wall_time:
+        return
+    _candle_last_tick[(market, symbol)] = wall_time
+    for interval, seconds in CANDLE_INTERVALS.items():
+        key = (market, symbol, interval)
+        candles = _candles.get(key)
+        if candles is None:
+            candles = _candles[key] = deque(maxlen=CANDLE_RETENTION[interval])
+        start = int(wall_time // seconds * seconds)
+        if candles and candles[-1][0] == start:
+            candle = candles[-1]
+            if price > candle[2]:
+                candle[2] = price
+            if price < candle[3]:
+                candle[3] = price
+            candle[4] = price
+            candle[5] += 1
+        elif not candles or candles[-1][0] < start:
+            candles.append([start, price, price, price, price, 1])
+
+def record_candles(market: str, prices: Dict[str, float], wall_time: float):
+    # Metal mumları matris yenilemelerinden beslenir (bkz. record_metals_history).
+    if market == "METALS":
+        return
+    subscribed = _crypto_stream["subscribed"] if market == "CRYPTO" else ()
+    for symbol, price in prices.items():
+        # Akışa abone olunan semboller akış tick'lerinden beslenir; aynı mumun tick sayısı (v)
+        # iki kaynaktan karışmasın diye cache çekimleri bu semboller için atlanır.
+        if subscribed and f"{symbol.lower()}@miniTicker" in subscribed:
+            continue
+        record_candle_tick(market, price_series_symbol(market, symbol), float(price), wall_time)
+
+def record_metals_candles(matrix: Dict[str, Dict[str, Optional[float]]], wall_time: float):
+    for currency, row in matrix.items():
+        for metal, price in row.items():
+            if price is not None:
+                record_candle_tick("METALS", price_series_symbol("METALS", metal, currency), price, wall_time)
+
+if CANDLES_ENABLED:
+    quote_cache.listeners.append(record_candles)
+    metals_matrix_listeners.append(record_metals_candles)
+
+@app.get("/candles/{market}/{symbol}")
+async def get_candles(
+    market: str,
+    symbol: str,
+    interval: str = Query("1m"),
+    limit: int = Query(300, ge=1, le=max(CANDLE_RETENTION.values())),
+    currency: Optional[str] = Query(None, description="METALS için para birimi (varsayılan TRY)"),
+):
+    if interval not in CANDLE_INTERVALS:
+        raise HTTPException(status_code=400, detail=f"Geçersiz aralık. Desteklenenler: {', '.join(CANDLE_INTERVALS)}")
+    market, symbol = market.upper(), symbol.upper()
+    series_symbol = price_series_symbol(market, symbol, currency.upper() if currency else None)
+    candles = _candles.get((market, series_symbol, interval))
+    if not candles:
+        raise HTTPException(status_code=404, detail=f"{market}/{symbol} için mum verisi bulunamadı.")
+    selected = list(candles)[-limit:]
+    return {
+        "market": market,
+        "symbol": symbol,
+        "interval": interval,
+        "candles": [{"t": t, "o": o, "h": h, "l": l, "c": c, "v": v} for t, o, h, l, c, v in selected],
+    }
+
+# ----------------------------
+# Sembol Kataloğu
+# ----------------------------
+# /symbols_with_name her istekte upstream'e gitmek yerine SymbolCatalog tablosundan yüklenen
+# bellek kopyasından, hazır JSON ve ETag ile cevap verir. BIST ve METALS koddaki listelerden
+# (başlangıçta) beslenir; NASDAQ isimleri ve kripto listesi arka planda en fazla günde bir yenilenir.
+SYMBOL_CATALOG_REFRESH_INTERVAL = timedelta(hours=float(os.getenv("SYMBOL_CATALOG_REFRESH_HOURS", "24")))
+SYMBOL_CATALOG_POLL_SECONDS = float(os.getenv("SYMBOL_CATALOG_POLL_SECONDS", "3600"))
+SYMBOL_CATALOG_CRYPTO_SIZE = int(os.getenv("SYMBOL_CATALOG_CRYPTO_SIZE", "100"))
+# Başarısız bir yenilemeden sonra bu süre dolmadan aynı piyasa için upstream tekrar denenmez.
+SYMBOL_CATALOG_RETRY_SECONDS = float(os.getenv("SYMBOL_CATALOG_RETRY_SECONDS", "60"))
+SYMBOL_CATALOG_MARKETS = ("BIST", "NASDAQ", "CRYPTO", "METALS")
+# n parametresi sadece bu piyasalarda uygulanır (BIST ve METALS her zaman tam listeyi döndürür).
+SYMBOL_CATALOG_LIMITED_MARKETS = ("NASDAQ", "CRYPTO")
+
+_symbol_catalog: Dict[str, List[Dict]] = {}  # market -> [{"symbol", "name"}] (sıralı, sadece aktifler)
+_symbol_catalog_refreshed_at: Dict[str, Optional[datetime]] = {}  # market -> en son updated_at
+_symbol_catalog_encoded: Dict[tuple, Dict] = {}  # (market, n) -> {"etag", "json", "gzip"}
+_symbol_catalog_failed_at: Dict[str, float] = {}  # market -> son başarısız yenilemenin monotonic zamanı
+
+def _static_catalog_rows() -> Dict[str, List[Dict]]:
+    bist = []
+    for ticker in BIST100_SYMBOLS:
+        short = ticker.split(".")[0]
+        bist.append({"symbol": short, "name": BIST_FALLBACK_NAMES.get(short, short), "provider_ticker": ticker})
+    metals = [
+        {"symbol": METAL_LOCALIZATION_MAP[metal]["tr"], "name": METAL_LOCALIZATION_MAP[metal]["tr"], "provider_ticker": ticker}
+        for metal, ticker in METAL_TICKERS.items()
+    ]
+    return {"BIST": bist, "METALS": metals}
+
+# Aynı anda başlayan worker'lar aynı satırları yazabileceği için katalog INSERT ... ON CONFLICT ile yazılır.
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+def upsert_symbol_catalog(session: Session, market: str, rows: List[Dict], refreshed: bool, deactivate_missing: bool):
+    """
+    Satırları (symbol, name, provider_ticker[, rank]) listedeki sırayla yazar. `refreshed` ise isimler
+    kaynaktan geldiği için güncellenir ve updated_at damgalanır; değilse mevcut isimlere dokunulmaz.
+    """
+    now = datetime.utcnow()
+    if rows:
+        stmt = _UPSERT_INSERTS[session.get_bind().dialect.name](SymbolCatalog).values([
+            {
+                "market": market,
+                "symbol": row["symbol"],
+                "name": row["name"],
+                "provider_ticker": row["provider_ticker"],
+                "rank": row.get("rank", rank),
+                "active": True,
+                "updated_at": now if refreshed else None,
+            }
+            for rank, row in enumerate(rows)
+        ])
+        columns = ["provider_ticker", "rank", "active"] + (["name", "updated_at"] if refreshed else [])
+        session.exec(stmt.on_conflict_do_update(
+            index_elements=["market", "symbol"],
+            set_={column: stmt.excluded[column] for column in columns},
+        ))
+    if deactivate_missing:
+        session.exec(
+            update(SymbolCatalog)
+            .where(
+                SymbolCatalog.market == market,
+                SymbolCatalog.symbol.notin_([row["symbol"] for row in rows]),
+                SymbolCatalog.active == True,  # noqa: E712
+            )
+            .values(active=False)
+            .execution_options(synchronize_session=False)
+        )
+    session.commit()
+
+def seed_symbol_catalog(session: Session):
+    # BIST ve METALS için kaynak koddaki listelerdir; her başlangıçta olduğu gibi yazılır.
+    for market, rows in _static_catalog_rows().items():
+        upsert_symbol_catalog(session, market, rows, refreshed=True, deactivate_missing=True)
+    # NASDAQ isimleri Finnhub'dan gelir; tohum sadece eksik sembolleri (isim = sembol) ekler.
+    nasdaq = [{"symbol": sym, "name": sym, "provider_ticker": sym} for sym in POPULAR_NASDAQ]
+    upsert_symbol_catalog(session, "NASDAQ", nasdaq, refreshed=False, deactivate_missing=True)
+
+def load_symbol_catalog(session: Session):
+    catalog: Dict[str, List[Dict]] = {market: [] for market in SYMBOL_CATALOG_MARKETS}
+    refreshed_at: Dict[str, Optional[datetime]] = {}
+    items = session.exec(
+        select(SymbolCatalog).where(SymbolCatalog.active == True).order_by(SymbolCatalog.market, SymbolCatalog.rank)  # noqa: E712
+    ).all()
+    for item in items:
+        catalog.setdefault(item.market, []).append({"symbol": item.symbol, "name": item.name})
+        last = refreshed_at.get(item.market)
+        if item.updated_at is not None and (last is None or item.updated_at > last):
+            refreshed_at[item.market] = item.updated_at
+    _symbol_catalog.clear()
+    _symbol_catalog.update(catalog)
+    _symbol_catalog_refreshed_at.clear()
+    _symbol_catalog_refreshed_at.update(refreshed_at)
+    _symbol_catalog_encoded.clear()
+
+async def _refresh_nasdaq_catalog():
+    symbols = [item["symbol"] for item in _symbol_catalog.get("NASDAQ", [])] or POPULAR_NASDAQ
+    names = await fetch_nasdaq_names(symbols)
+    if not names:
+        raise ValueError("Finnhub'dan hiç şirket ismi alınamadı.")
+    # İsmi alınamayan semboller eski isimleriyle kalır ve bir sonraki günlük yenilemede tekrar denenir.
+    rows = [
+        {"symbol": sym, "name": names[sym], "provider_ticker": sym, "rank": rank}
+        for rank, sym in enumerate(symbols) if sym in names
+    ]
+    await run_db(upsert_symbol_catalog, "NASDAQ", rows, True, False)
+
+async def _refresh_crypto_catalog():
+    symbols = await get_top_crypto_symbols(SYMBOL_CATALOG_CRYPTO_SIZE)
+    if not symbols:
+        raise ValueError("Binance'ten kripto listesi alınamadı.")
+    rows = [{"symbol": s[:-4], "name": s[:-4], "provider_ticker": s} for s in symbols]
+    await run_db(upsert_symbol_catalog, "CRYPTO", rows, True, True)
+
+SYMBOL_CATALOG_REFRESHERS = {
+    "NASDAQ": _refresh_nasdaq_catalog,
+    "CRYPTO": _refresh_crypto_catalog,
+}
+
+def symbol_catalog_retry_after(market: str) -> float:
+    """Son başarısız yenilemeden sonra upstream'in tekrar denenmesine kalan süre (yoksa 0)."""
+    failed_at = _symbol_catalog_failed_at.get(market)
+    if failed_at is None:
+        return 0.0
+    return max(SYMBOL_CATALOG_RETRY_SECONDS - (time.monotonic() - failed_at), 0.0)
+
+async def refresh_symbol_catalog(market: str, force: bool = False):
+    async with get_async_lock(f"symbol_catalog:{market}"):
+        refreshed_at = _symbol_catalog_refreshed_at.get(market)
+        if not force and refreshed_at is not None and datetime.utcnow() - refreshed_at < SYMBOL_CATALOG_REFRESH_INTERVAL:
+            return
+        # force dahil: kilidi bekleyen istekler az önce başarısız olan yenilemeyi tekrarlamaz.
+        if symbol_catalog_retry_after(market) > 0:
+            return
+        try:
+            await SYMBOL_CATALOG_REFRESHERS[market]()
+        except Exception as e:
+            _symbol_catalog_failed_at[market] = time.monotonic()
+            print(f"Sembol kataloğu ({market}) yenilenemedi: {e}")
+            return
+        _symbol_catalog_failed_at.pop(market, None)
+        await run_db(load_symbol_catalog)
+        print(f"Sembol kataloğu ({market}) yenilendi.")
+
+async def symbol_catalog_refresh_loop():
+    while True:
+        for market in SYMBOL_CATALOG_REFRESHERS:
+            await refresh_symbol_catalog(market)
+        await asyncio.sleep(SYMBOL_CATALOG_POLL_SECONDS)
+
+def get_encoded_symbols(market: str, n: int) -> Dict:
+    n = n if market in SYMBOL_CATALOG_LIMITED_MARKETS else 0
+    key = (market, n)
+    encoded = _symbol_catalog_encoded.get(key)
+    if encoded is None:
+        items = _symbol_catalog.get(market, [])
+        if n:
+            items = items[:n]
+        raw = json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        encoded = _symbol_catalog_encoded[key] = {
+            "etag": content_etag(raw),
+            "json": raw,
+            "gzip": gzip.compress(raw, compresslevel=6, mtime=0),
+        }
+    return encoded
+
 @app.get("/symbols_with_name")
-async def symbols_with_name(market: str, n: int = 50):
+async def symbols_with_name(request: Request, market: str, n: int = 50):
     market = market.upper()
-    if market == "BIST":
-        return await get_bist_symbols_with_name()
-    elif market == "NASDAQ":
-        return await get_nasdaq_symbols_with_name(n)
-    elif market == "CRYPTO":
-        symbols = await get_top_crypto_symbols(n)
-        return [{"symbol": s[:-4], "name": s[:-4]} for s in symbols]
-    elif market == "METALS":
-        return [{"symbol": name, "name": name} for name in ["Altın", "Gümüş", "Bakır"]]
-    raise HTTPException(status_code=400, detail="Invalid market specified")
\ No newline at end of file
+    if market not in SYMBOL_CATALOG_MARKETS:
+        raise HTTPException(status_code=400, detail="Invalid market specified")
+    if not _symbol_catalog.get(market) and market in SYMBOL_CATALOG_REFRESHERS:
+        # Katalog hiç doldurulmamışsa (örn. ilk açılışta kripto listesi) bir kez beklenir.
+        # Yenileme başarısızsa SYMBOL_CATALOG_RETRY_SECONDS dolana kadar upstream'e gidilmeden 503 döner.
+        await refresh_symbol_catalog(market, force=True)
+        if not _symbol_catalog.get(market):
+            retry_after = max(int(symbol_catalog_retry_after(market)), 1)
+            raise HTTPException(
+                status_code=503,
+                detail="Sembol listesi şu anda alınamıyor.",
+                headers={"Retry-After": str(retry_after)},
+            )
+    encoded = get_encoded_symbols(market, n)
+    return encoded_json_response(request, encoded["json"], encoded["gzip"], encoded["etag"])
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import tempfile
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# main.py ortam değişkenlerini import sırasında okur; testler için sahte değerler import'tan önce verilir.
+_tmp_dir = tempfile.mkdtemp(prefix="market-watcher-tests-")
+_private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+).decode()
+os.environ.setdefault("CRON_SECRET_KEY", "test-secret")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}")
+os.environ.setdefault("FIREBASE_JSON", json.dumps({
+    "type": "service_account",
+    "project_id": "market-watcher-test",
+    "private_key_id": "test",
+    "private_key": _private_key,
+    "client_email": "test@market-watcher-test.iam.gserviceaccount.com",
+    "client_id": "1",
+    "token_uri": "https://oauth2.googleapis.com/token",
+}))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from sqlmodel import SQLModel  # noqa: E402
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """Her test boş tablolar ve boş alarm indeksiyle başlar."""
+    SQLModel.metadata.drop_all(main.engine)
+    main.create_db_and_tables()
+    main.alert_index_rebuild()
+    yield main.engine
+
+
+class _SendResponse:
+    success = True
+    exception = None
+
+
+class _BatchResponse:
+    def __init__(self, count):
+        self.responses = [_SendResponse() for _ in range(count)]
+        self.success_count = count
+        self.failure_count = 0
+
+
+@pytest.fixture
+def sent_messages(monkeypatch):
+    """FCM'e gitmek yerine gönderilen mesajları toplar."""
+    sent = []
+
+    def send_each(messages, *args, **kwargs):
+        sent.extend(messages)
+        return _BatchResponse(len(messages))
+
+    monkeypatch.setattr(main.messaging, "send_each", send_each)
+    return sent
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import websockets
+
+
+class FakeBinanceStream:
+    """
+    Binance combined stream'in test için yeterli kadarını taklit eden yerel WebSocket sunucusu:
+    SUBSCRIBE/UNSUBSCRIBE isteklerini kaydeder, istenen sembol için miniTicker gönderir
+    ve yeniden bağlanmayı denemek için bağlantıları koparabilir.
+    """
+
+    def __init__(self):
+        self.requests = []          # [(method, params)]
+        self.subscribed = set()
+        self.connection_count = 0
+        self._connections = set()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        port = self._server.sockets[0].getsockname()[1]
+        return f"ws://127.0.0.1:{port}/stream"
+
+    async def __aenter__(self):
+        self._server = await websockets.serve(self._handler, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handler(self, ws):
+        self.connection_count += 1
+        self._connections.add(ws)
+        # Binance'te abonelikler bağlantıya özeldir.
+        self.subscribed = set()
+        try:
+            async for raw in ws:
+                request = json.loads(raw)
+                self.requests.append((request["method"], request["params"]))
+                if request["method"] == "SUBSCRIBE":
+                    self.subscribed.update(request["params"])
+                elif request["method"] == "UNSUBSCRIBE":
+                    self.subscribed.difference_update(request["params"])
+                await ws.send(json.dumps({"result": None, "id": request["id"]}))
+        finally:
+            self._connections.discard(ws)
+
+    async def send_tick(self, symbol: str, price: float):
+        stream = f"{symbol.lower()}@miniTicker"
+        message = json.dumps({"stream": stream, "data": {"e": "24hrMiniTicker", "s": symbol, "c": str(price)}})
+        for ws in list(self._connections):
+            if stream in self.subscribed:
+                await ws.send(message)
+
+    async def drop_connections(self):
+        for ws in list(self._connections):
+            await ws.close()
+
+    async def wait_for(self, predicate, timeout: float = 5.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not predicate():
+            if asyncio.get_running_loop().time() > deadline:
+                raise AssertionError("Beklenen durum zaman aşımına kadar oluşmadı.")
+            await asyncio.sleep(0.02)
@@ -0,0 +1,60 @@
+from sqlmodel import Session
+
+import main
+
+
+def _alert(alert_id: int, market: str, symbol: str, upper: float, lower: float, uid: str = "u") -> main.Alert:
+    return main.Alert(
+        id=alert_id, user_uid=uid, market=market, symbol=symbol, percentage=10,
+        base_price=100, upper_limit=upper, lower_limit=lower,
+    )
+
+
+def _triggered_ids(market, symbol, price):
+    return sorted(alert.id for alert in main.alert_index_triggered(market, symbol, price))
+
+
+def test_index_add_update_and_remove(db):
+    main.alert_index_add(_alert(1, "NASDAQ", "AAPL", upper=110, lower=90))
+    main.alert_index_add(_alert(2, "NASDAQ", "AAPL", upper=120, lower=80))
+    assert _triggered_ids("NASDAQ", "AAPL", 100) == []
+    assert _triggered_ids("NASDAQ", "AAPL", 115) == [1]
+    assert _triggered_ids("NASDAQ", "AAPL", 85) == [1]
+    assert _triggered_ids("NASDAQ", "AAPL", 125) == [1, 2]
+
+    # PUT: aynı ID yeni limitlerle eklenince eski limitler indeksten çıkar.
+    main.alert_index_add(_alert(1, "NASDAQ", "AAPL", upper=130, lower=70))
+    assert _triggered_ids("NASDAQ", "AAPL", 115) == []
+    assert _triggered_ids("NASDAQ", "AAPL", 125) == [2]
+
+    main.alert_index_remove([2])
+    assert _triggered_ids("NASDAQ", "AAPL", 125) == []
+    main.alert_index_remove([1, 999])
+    assert ("NASDAQ", "AAPL") not in main._alert_index
+    assert main._alert_index_entries == {}
+
+
+def test_same_symbol_in_different_markets_does_not_cross_trigger(db):
+    main.alert_index_add(_alert(1, "BIST", "ABC", upper=110, lower=90))
+    main.alert_index_add(_alert(2, "nasdaq", "ABC", upper=11, lower=9))  # eski kayıt: küçük harfli piyasa
+
+    assert _triggered_ids("NASDAQ", "ABC", 10) == []
+    assert _triggered_ids("BIST", "ABC", 10) == [1]
+    assert _triggered_ids("NASDAQ", "ABC", 12) == [2]
+
+
+def test_check_cycle_evaluates_prices_per_market_in_both_modes(db, monkeypatch):
+    with Session(db) as session:
+        session.add(main.User(uid="u", notifications_enabled=False))
+        session.add(_alert(1, "BIST", "ABC", upper=110, lower=90))
+        session.add(_alert(2, "NASDAQ", "ABC", upper=11, lower=9))
+        session.commit()
+    main.alert_index_rebuild()
+    prices = {("BIST", "ABC"): 100.0, ("NASDAQ", "ABC"): 100.0}
+
+    with Session(db) as session:
+        indexed = main.find_triggered_alerts_indexed(prices, {"u"})
+        vectorized = main.find_triggered_alerts_vectorized(session, prices, {"u"})
+
+    assert [alert.id for alert in indexed] == [2]
+    assert [alert.id for alert in vectorized] == [2]
@@ -0,0 +1,22 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_candles_use_prices_symbols_and_a_single_tick_source(monkeypatch):
+    main._candles.clear()
+    main._candle_last_tick.clear()
+    monkeypatch.setitem(main._crypto_stream, "subscribed", {"btcusdt@miniTicker"})
+    t = 1_800_000_000.0
+
+    main.on_crypto_tick("BTCUSDT", 100.0)
+    # Akışın kapsadığı sembol için cache çekimi aynı muma ikinci bir tick olarak eklenmez.
+    main.record_candles("CRYPTO", {"BTCUSDT": 101.0, "ETHUSDT": 10.0}, t)
+    main.record_metals_candles({"TRY": {"ALTIN": 4000.0}, "USD": {"ALTIN": 100.0}}, t)
+
+    client = TestClient(main.app)
+    btc = client.get("/candles/CRYPTO/BTC", params={"interval": "1d"}).json()["candles"]
+    assert [(c["c"], c["v"]) for c in btc] == [(100.0, 1)]
+    assert client.get("/candles/CRYPTO/ETH").json()["candles"][0]["c"] == 10.0
+    assert client.get("/candles/METALS/ALTIN").json()["candles"][0]["c"] == 4000.0
+    assert client.get("/candles/METALS/ALTIN", params={"currency": "USD"}).json()["candles"][0]["c"] == 100.0
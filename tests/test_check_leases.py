@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlmodel import Session, select
+
+import main
+
+
+def _add_due_users(engine, count: int):
+    with Session(engine) as session:
+        for i in range(count):
+            session.add(main.User(uid=f"user-{i:02d}", notifications_enabled=True))
+        session.commit()
+
+
+def test_concurrent_workers_never_claim_the_same_user(db):
+    _add_due_users(db, 20)
+    now = datetime.utcnow()
+
+    def worker():
+        claimed = []
+        while True:
+            with Session(db) as session:
+                uids = main.claim_due_users(session, now, 3)
+            if not uids:
+                return claimed
+            claimed.extend(uids)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: worker(), range(4)))
+
+    claimed = [uid for result in results for uid in result]
+    assert sorted(claimed) == [f"user-{i:02d}" for i in range(20)]
+
+
+def test_lease_expires_and_the_user_can_be_claimed_again(db):
+    _add_due_users(db, 1)
+    now = datetime.utcnow()
+    with Session(db) as session:
+        assert main.claim_due_users(session, now, 10) == ["user-00"]
+        # Kiralama sürerken aynı kullanıcı tekrar sahiplenilmez.
+        assert main.claim_due_users(session, now, 10) == []
+        lease_until = session.exec(select(main.User.next_check_at)).one()
+        assert lease_until >= now + main.ALERT_CHECK_LEASE - timedelta(seconds=5)
+        # Worker kontrolü bitiremeden düştüyse kiralama süresi dolunca kullanıcı tekrar sahiplenilir.
+        assert main.claim_due_users(session, lease_until, 10) == ["user-00"]
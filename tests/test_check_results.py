@@ -0,0 +1,43 @@
+from datetime import datetime
+
+from sqlmodel import Session, select
+
+import main
+
+
+def _alert(uid: str, symbol: str) -> main.Alert:
+    return main.Alert(
+        user_uid=uid, market="NASDAQ", symbol=symbol, percentage=10,
+        base_price=100, upper_limit=110, lower_limit=90,
+    )
+
+
+def test_bulk_writes_set_per_plan_check_times_and_delete_only_triggered(db, monkeypatch):
+    # Küçük parça boyutu, yazımların birden fazla parçaya bölünmesini de sınar.
+    monkeypatch.setattr(main, "CHECK_WRITE_BATCH_SIZE", 2)
+    plans = {"free-user": "free", "pro-user": "pro", "ultra-user": "ultra", "legacy-user": "gold", "idle-user": "pro"}
+    with Session(db) as session:
+        for uid, plan in plans.items():
+            session.add(main.User(uid=uid, plan=plan, notifications_enabled=True))
+        alerts = [_alert("free-user", "AAPL"), _alert("pro-user", "MSFT"), _alert("ultra-user", "NVDA")]
+        session.add_all(alerts)
+        session.commit()
+        alert_ids = [alert.id for alert in alerts]
+
+    now = datetime(2026, 1, 1, 12, 0, 0)
+    checked = ["free-user", "pro-user", "ultra-user", "legacy-user"]
+    with Session(db) as session:
+        deleted = main.persist_check_results(session, checked, [alert_ids[0], alert_ids[2], 999], now)
+
+    assert sorted(deleted) == [alert_ids[0], alert_ids[2]]
+    with Session(db) as session:
+        users = {user.uid: user for user in session.exec(select(main.User)).all()}
+        remaining = session.exec(select(main.Alert.id)).all()
+
+    assert remaining == [alert_ids[1]]
+    for uid in checked:
+        assert users[uid].last_checked_at == now
+        assert users[uid].next_check_at == now + main.plan_check_interval(plans[uid])
+    # Tanınmayan plan free aralığını alır; kontrol edilmeyen kullanıcıya dokunulmaz.
+    assert users["legacy-user"].next_check_at == now + main.PLAN_CHECK_INTERVALS["free"]
+    assert users["idle-user"].last_checked_at is None and users["idle-user"].next_check_at is None
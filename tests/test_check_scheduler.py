@@ -0,0 +1,59 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlmodel import Session
+
+import main
+
+
+def test_rescheduled_user_is_popped_once_at_the_new_time(monkeypatch):
+    monkeypatch.setattr(main, "_check_schedule", [])
+    monkeypatch.setattr(main, "_check_schedule_due", {})
+    monkeypatch.setitem(main._check_schedule_state, "active", True)
+    now = datetime.utcnow()
+
+    main.schedule_user_check("a", now + timedelta(minutes=10))
+    main.schedule_user_check("b", now + timedelta(minutes=5))
+    # "a" öne alınır; heap'teki eski kaydı atlanmalı.
+    main.schedule_user_check("a", now + timedelta(minutes=1))
+
+    assert main._next_scheduled_check() == now + timedelta(minutes=1)
+    assert main._pop_due_checks(now) == 0
+    assert main._pop_due_checks(now + timedelta(minutes=2)) == 1
+    assert main._pop_due_checks(now + timedelta(minutes=20)) == 1
+    assert main._check_schedule == [] and main._check_schedule_due == {}
+
+
+def test_scheduler_wakes_when_an_earlier_check_is_queued(db, monkeypatch):
+    with Session(db) as session:
+        session.add(main.User(uid="later", notifications_enabled=True, next_check_at=datetime.utcnow() + timedelta(hours=1)))
+        session.commit()
+    monkeypatch.setattr(main, "PRICE_CHECK_SCHEDULER_MAX_SLEEP", 60)
+    monkeypatch.setattr(main, "_async_locks", {})
+    runs = []
+
+    async def fake_run_price_checks():
+        runs.append(datetime.utcnow())
+
+    monkeypatch.setattr(main, "_run_price_checks", fake_run_price_checks)
+
+    async def scenario():
+        task = asyncio.create_task(main.price_check_scheduler_loop())
+        try:
+            while "later" not in main._check_schedule_due:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            assert runs == []  # en yakın kontrol bir saat sonra
+            main.schedule_user_check("new-user")
+            for _ in range(100):
+                if runs:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert len(runs) == 1
+    assert "new-user" not in main._check_schedule_due
+    assert not main._check_schedule_state["active"]
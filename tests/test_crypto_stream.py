@@ -0,0 +1,104 @@
+import asyncio
+
+from sqlmodel import Session, select
+
+import main
+from tests.fake_binance_stream import FakeBinanceStream
+
+
+def _add_user_with_alert(engine, uid: str, plan: str, upper: float) -> int:
+    with Session(engine) as session:
+        session.add(main.User(uid=uid, fcm_token=f"token-{uid}", notifications_enabled=True, plan=plan))
+        alert = main.Alert(
+            user_uid=uid, market="CRYPTO", symbol="BTCUSDT", percentage=10,
+            base_price=100, upper_limit=upper, lower_limit=90,
+        )
+        session.add(alert)
+        session.commit()
+        session.refresh(alert)
+        alert_id = alert.id
+    main.alert_index_rebuild()
+    return alert_id
+
+
+def _alert_exists(engine, alert_id: int) -> bool:
+    with Session(engine) as session:
+        return session.exec(select(main.Alert).where(main.Alert.id == alert_id)).first() is not None
+
+
+def test_stream_subscribes_triggers_and_resubscribes_after_reconnect(db, sent_messages, monkeypatch):
+    monkeypatch.setattr(main, "CRYPTO_STREAM_RESYNC_SECONDS", 0.05)
+    alert_id = _add_user_with_alert(db, "ultra-user", "ultra", upper=110)
+    ticks = []
+    on_crypto_tick = main.on_crypto_tick
+
+    def recording_tick(symbol, price):
+        ticks.append((symbol, price))
+        on_crypto_tick(symbol, price)
+
+    monkeypatch.setattr(main, "on_crypto_tick", recording_tick)
+
+    async def scenario():
+        async with FakeBinanceStream() as server:
+            monkeypatch.setattr(main, "BINANCE_STREAM_URL", server.url)
+            task = asyncio.create_task(main.crypto_stream_loop())
+            try:
+                await server.wait_for(lambda: "btcusdt@miniTicker" in server.subscribed)
+
+                await server.send_tick("BTCUSDT", 105.0)
+                await server.wait_for(lambda: ("BTCUSDT", 105.0) in ticks)
+                assert sent_messages == []
+
+                await server.send_tick("BTCUSDT", 112.0)
+                await server.wait_for(lambda: len(sent_messages) == 1)
+                assert sent_messages[0].token == "token-ultra-user"
+                await server.wait_for(lambda: not _alert_exists(db, alert_id))
+
+                # Bağlantı koptuğunda yeniden bağlanılır ve aktif alarmların akışlarına tekrar abone olunur.
+                second_id = _add_user_with_alert(db, "ultra-user-2", "ultra", upper=120)
+                await server.drop_connections()
+                await server.wait_for(lambda: server.connection_count == 2 and "btcusdt@miniTicker" in server.subscribed)
+                await server.send_tick("BTCUSDT", 125.0)
+                await server.wait_for(lambda: len(sent_messages) == 2)
+                assert not _alert_exists(db, second_id)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_stream_does_not_notify_alert_already_deleted_by_check_cycle(db):
+    alert_id = _add_user_with_alert(db, "ultra-user", "ultra", upper=110)
+    alert = main._alert_index_entries[alert_id]
+    with Session(db) as session:
+        # Kontrol turu alarmı silmiş ama henüz indeksten çıkarmamış.
+        assert main.persist_check_results(session, [], [alert_id], main.datetime.utcnow()) == [alert_id]
+        deleted_ids, skipped_ids, outbox = main._process_stream_triggers(session, [alert], {("CRYPTO", "BTCUSDT"): 112.0})
+    assert deleted_ids == []
+    assert skipped_ids == []
+    assert outbox == []
+
+
+def _indexed(alert_id: int, market: str, symbol: str) -> main.Alert:
+    return main.Alert(
+        id=alert_id, user_uid="u", market=market, symbol=symbol, percentage=10,
+        base_price=100, upper_limit=110, lower_limit=90,
+    )
+
+
+def test_wanted_streams_follow_index_add_and_remove(db):
+    main.alert_index_add(_indexed(1, "CRYPTO", "BTCUSDT"))
+    main.alert_index_add(_indexed(2, "CRYPTO", "BTC"))  # eski kayıt biçimi, aynı akış
+    main.alert_index_add(_indexed(3, "CRYPTO", "ETHUSDT"))
+    main.alert_index_add(_indexed(4, "NASDAQ", "AAPL"))
+    assert main.crypto_stream_wanted_streams() == {"btcusdt@miniTicker", "ethusdt@miniTicker"}
+
+    main.alert_index_remove([1])
+    assert "btcusdt@miniTicker" in main.crypto_stream_wanted_streams()
+    main.alert_index_remove([2])
+    assert main.crypto_stream_wanted_streams() == {"ethusdt@miniTicker"}
+
+    # PUT ile piyasası değişen alarm akıştan çıkar.
+    main.alert_index_add(_indexed(3, "NASDAQ", "ETHUSDT"))
+    assert main.crypto_stream_wanted_streams() == set()
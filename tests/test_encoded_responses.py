@@ -0,0 +1,44 @@
+from starlette.requests import Request
+
+import main
+
+
+def _request(**headers) -> Request:
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw})
+
+
+def _entries(price: float):
+    base = {"version": 2, "data": ([{"symbol": "THYAO", "price": price, "stale": False}], [], [])}
+    metals = {"version": 1, "data": []}
+    return base, metals
+
+
+def test_prices_etag_follows_content_not_process_counters():
+    main._prices_encoded.clear()
+    first = main.get_encoded_prices("USD", *_entries(1.0))
+    main._prices_encoded.clear()
+    # Yeniden başlatılmış (veya başka bir) process: aynı sayaç değerleri, farklı veri.
+    second = main.get_encoded_prices("USD", *_entries(2.0))
+    main._prices_encoded.clear()
+    again = main.get_encoded_prices("USD", *_entries(1.0))
+
+    assert first["etag"] != second["etag"]
+    assert first["etag"] == again["etag"]
+
+
+def test_gzip_and_identity_bodies_have_distinct_etags():
+    encoded = main.get_encoded_prices("USD", *_entries(1.0))
+    body, gzipped, etag = encoded["json"], encoded["gzip"], encoded["etag"]
+
+    plain = main.encoded_json_response(_request(), body, gzipped, etag)
+    compressed = main.encoded_json_response(_request(accept_encoding="gzip"), body, gzipped, etag)
+    assert plain.headers["etag"] != compressed.headers["etag"]
+    assert compressed.headers["content-encoding"] == "gzip"
+
+    assert main.encoded_json_response(_request(if_none_match=plain.headers["etag"]), body, gzipped, etag).status_code == 304
+    # Sıkıştırılmamış gövdenin ETag'i gzip'li gövde için geçerli sayılmaz (ve tersi).
+    mixed = main.encoded_json_response(
+        _request(accept_encoding="gzip", if_none_match=plain.headers["etag"]), body, gzipped, etag
+    )
+    assert mixed.status_code == 200
@@ -0,0 +1,44 @@
+import asyncio
+from types import SimpleNamespace
+
+from firebase_admin import exceptions as firebase_exceptions
+from sqlmodel import Session, select
+
+import main
+
+ERRORS = {
+    "token-unregistered": main.messaging.UnregisteredError("Requested entity was not found."),
+    "token-sender-mismatch": main.messaging.SenderIdMismatchError("SenderId mismatch"),
+    # FCM bunu bozuk mesaj içeriği için de döndürür; token geçerli olabilir.
+    "token-bad-payload": firebase_exceptions.InvalidArgumentError("Invalid data payload"),
+}
+
+
+def test_only_unregistered_tokens_are_cleared(db, monkeypatch):
+    tokens = list(ERRORS) + ["token-ok"]
+    with Session(db) as session:
+        for i, token in enumerate(tokens):
+            session.add(main.User(uid=f"user-{i}", fcm_token=token, notifications_enabled=True))
+        session.commit()
+
+    def send_each(messages, *args, **kwargs):
+        responses = [
+            SimpleNamespace(success=message.token not in ERRORS, exception=ERRORS.get(message.token))
+            for message in messages
+        ]
+        return SimpleNamespace(responses=responses)
+
+    monkeypatch.setattr(main.messaging, "send_each", send_each)
+    messages = [main.build_push_message(token=token, title="t", body="b") for token in tokens]
+
+    results = asyncio.run(main.dispatch_notifications(messages))
+
+    assert results == {token: token == "token-ok" for token in tokens}
+    with Session(db) as session:
+        remaining = {uid: token for uid, token in session.exec(select(main.User.uid, main.User.fcm_token)).all()}
+    assert remaining == {
+        "user-0": None,
+        "user-1": None,
+        "user-2": "token-bad-payload",
+        "user-3": "token-ok",
+    }
@@ -0,0 +1,37 @@
+import asyncio
+
+from sqlmodel import Session
+
+import main
+
+
+def _add_users(engine, count: int):
+    with Session(engine) as session:
+        for i in range(count):
+            session.add(main.User(uid=f"user-{i:02d}", notifications_enabled=True))
+        session.commit()
+
+
+def test_due_users_are_loaded_and_checked_in_bounded_chunks(db, monkeypatch):
+    _add_users(db, 7)
+    monkeypatch.setattr(main, "ALERT_CHECK_DISTRIBUTED", False)
+    monkeypatch.setattr(main, "ALERT_CHECK_CHUNK_SIZE", 3)
+    loaded = []
+    load_shard_users = main.load_shard_users
+
+    def recording_load(session, uids):
+        users, symbols_by_market = load_shard_users(session, uids)
+        loaded.append(len(users))
+        return users, symbols_by_market
+
+    monkeypatch.setattr(main, "load_shard_users", recording_load)
+
+    asyncio.run(main._run_price_checks())
+
+    # Her parçada en fazla ALERT_CHECK_CHUNK_SIZE kullanıcı satırı belleğe alınır.
+    assert loaded == [3, 3, 1]
+    stats = main._price_check_stats
+    assert stats["users_checked"] == 7 and stats["chunks"] == 3
+    # Bellek, yorumlayıcının taban belleği değil tur başına göre artış olarak raporlanır.
+    assert stats["memory_metric"] == "rss_growth"
+    assert 0 <= stats["memory_bytes"] < 64 * 1024 * 1024
@@ -0,0 +1,23 @@
+import time
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_history_is_served_under_the_symbols_prices_displays(db):
+    main._price_history.clear()
+    now = time.time()
+    main.record_price_history("CRYPTO", {"BTCUSDT": 60000.0}, now)
+    main.record_metals_history({"TRY": {"ALTIN": 4000.0}, "USD": {"ALTIN": 100.0}}, now)
+    # METALS cache çekimleri matrisle aynı fiyatları tekrar kaydetmez.
+    main.record_price_history("METALS", {"ALTIN": 4000.0}, now)
+
+    client = TestClient(main.app)
+    crypto = client.get("/history/CRYPTO/BTC")
+    assert crypto.status_code == 200
+    assert crypto.json()["points"] == [[int(now), 60000.0]]
+
+    assert client.get("/history/METALS/ALTIN").json()["points"] == [[int(now), 4000.0]]
+    assert client.get("/history/METALS/ALTIN", params={"currency": "usd"}).json()["points"] == [[int(now), 100.0]]
+    assert len(main._price_history[("METALS", "ALTIN:TRY")].since(0)[0]) == 1
@@ -0,0 +1,56 @@
+import asyncio
+
+import main
+
+
+def test_versions_from_another_process_get_a_full_snapshot():
+    main._prices_changes.clear()
+    main._prices_version["current"] = 0
+    main._segment_version("base", {}, ([{"symbol": "THYAO", "price": 1.0, "stale": False}], [], []))
+    main._segment_version("metals:USD", {}, [{"market": "METALS", "symbol": "ALTIN", "price": 2.0, "stale": False}])
+
+    current = main.format_price_version(main._prices_version["current"])
+    assert current.startswith(f"{main.PRICES_EPOCH}:")
+    assert main.parse_price_version(current) == 2
+
+    # Yeniden başlatma öncesinden kalan sürümler (eski tam sayı biçimi ya da başka bir epoch).
+    assert main.parse_price_version("2") is None
+    assert main.parse_price_version("0123456789ab:2") is None
+    assert main.parse_price_version(f"{main.PRICES_EPOCH}:x") is None
+
+    assert main.collect_price_changes(1, "USD") == (
+        [{"market": "METALS", "symbol": "ALTIN", "price": 2.0, "stale": False}], []
+    )
+
+
+def test_stale_flag_changes_are_published_as_deltas():
+    main._prices_changes.clear()
+    main._prices_version["current"] = 0
+    fresh = [{"market": "METALS", "symbol": "ALTIN", "price": 2.0, "stale": False}]
+    stale = [{"market": "METALS", "symbol": "ALTIN", "price": 2.0, "stale": True}]
+    version = main._segment_version("metals:USD", {}, fresh)
+    main._segment_version("metals:USD", {"version": version, "data": fresh}, stale)
+
+    assert main.collect_price_changes(version, "USD") == (
+        [{"market": "METALS", "symbol": "ALTIN", "price": 2.0, "stale": True}], []
+    )
+
+
+def test_subscribers_behind_the_change_ring_are_forced_to_resync():
+    main._prices_changes.clear()
+    main._prices_version["current"] = 0
+    main._price_stream_groups.clear()
+    queue = asyncio.Queue(maxsize=main.PRICE_STREAM_QUEUE_SIZE)
+    main._price_stream_groups["key"] = {
+        "currency": "USD", "markets": frozenset(), "symbols": frozenset(),
+        "version": 1, "queues": {queue}, "snapshot": (None, None),
+    }
+    # Grubun sürümünden sonraki değişiklikler halkada artık yok.
+    for price in range(main.PRICES_DELTA_HISTORY + 2):
+        main._segment_version("metals:USD", {"version": 0, "data": None}, [
+            {"market": "METALS", "symbol": "ALTIN", "price": float(price), "stale": False}
+        ])
+
+    main.publish_price_updates()
+    assert queue.get_nowait() is None
+    main._price_stream_groups.clear()
@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def base_segment(monkeypatch):
+    """Ana segmentin çekicilerini, bir Event açılana kadar bekleyen sahte çekicilerle değiştirir."""
+    state = {"calls": [], "release": None, "fail": False}
+
+    def fake(market, symbol):
+        async def fetch(*args, allow_stale=True):
+            state["calls"].append((market, allow_stale))
+            await state["release"].wait()
+            if state["fail"]:
+                raise RuntimeError("kaynak erişilemez")
+            return [{"symbol": symbol, "price": 2.0, "stale": False}]
+        return fetch
+
+    monkeypatch.setattr(main, "get_bist_prices", fake("BIST", "THYAO"))
+    monkeypatch.setattr(main, "get_nasdaq_prices", fake("NASDAQ", "AAPL"))
+    monkeypatch.setattr(main, "get_crypto_prices", fake("CRYPTO", "BTC"))
+
+    async def get_metals_for_currency(currency):
+        return {"ALTIN": 100.0}
+
+    monkeypatch.setattr(main, "get_metals_for_currency", get_metals_for_currency)
+    monkeypatch.setattr(main, "_prices_refresh_tasks", {})
+    monkeypatch.setattr(main, "_async_locks", {})
+    monkeypatch.setattr(main, "_prices_cache", {"base_data": {"timestamp": None, "data": None}, "metals_data": {}})
+    return state
+
+
+def _store_base(age):
+    old = ([{"symbol": "THYAO", "price": 1.0, "stale": False}], [], [])
+    main._prices_cache["base_data"] = {"data": old, "timestamp": datetime.utcnow() - age, "version": 1}
+
+
+def test_prices_answers_from_memory_while_the_refresh_runs(base_segment):
+    async def scenario():
+        base_segment["release"] = asyncio.Event()
+        _store_base(main.CACHE_DURATION)
+        entry = await asyncio.wait_for(main.read_price_segment("base"), timeout=1)
+        refresh = main._prices_refresh_tasks["base"]
+        await asyncio.sleep(0)
+        running = not refresh.done()
+        base_segment["release"].set()
+        await refresh
+        return entry, running
+
+    entry, running = asyncio.run(scenario())
+    assert entry["data"][0][0]["price"] == 1.0
+    assert running
+    # Yenileyici cache'in stale-while-revalidate yolunu değil, taze çekimi kullanır.
+    assert sorted(base_segment["calls"]) == [("BIST", False), ("CRYPTO", False), ("NASDAQ", False)]
+    assert main._prices_cache["base_data"]["data"][0][0]["price"] == 2.0
+
+
+def test_prices_waits_for_a_refresh_past_max_staleness(base_segment):
+    async def scenario():
+        base_segment["release"] = asyncio.Event()
+        base_segment["release"].set()
+        _store_base(main.PRICES_MAX_STALENESS)
+        return await main.read_price_segment("base")
+
+    entry = asyncio.run(scenario())
+    assert entry["data"][0][0]["price"] == 2.0
+
+
+def test_prices_refuses_data_past_max_staleness_when_the_refresh_fails(base_segment):
+    async def scenario():
+        base_segment["release"] = asyncio.Event()
+        base_segment["release"].set()
+        base_segment["fail"] = True
+        _store_base(main.PRICES_MAX_STALENESS)
+        with pytest.raises(HTTPException) as exc:
+            await main.read_prices_snapshot("USD")
+        return exc.value
+
+    assert asyncio.run(scenario()).status_code == 503
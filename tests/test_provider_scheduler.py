@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def fake_provider(monkeypatch):
+    """"finnhub" istemcisini, istekleri kaydeden bir MockTransport ile değiştirir."""
+    state = {"requests": [], "responses": [], "delay": 0.0}
+
+    async def handler(request):
+        state["requests"].append(request)
+        await asyncio.sleep(state["delay"])
+        if state["responses"]:
+            return state["responses"].pop(0)
+        return httpx.Response(200, json={"c": 1.0})
+
+    def install():
+        main._http_clients["finnhub"] = httpx.AsyncClient(base_url=main.FINNHUB_BASE, transport=httpx.MockTransport(handler))
+        main._provider_semaphores["finnhub"] = asyncio.Semaphore(10)
+        main._provider_limiters["finnhub"] = main.ProviderRateLimiter(6000, 100)
+
+    state["install"] = install
+    monkeypatch.setattr(main, "_provider_inflight", {})
+    yield state
+    main._http_clients.pop("finnhub", None)
+    main._provider_semaphores.pop("finnhub", None)
+    main._provider_limiters.pop("finnhub", None)
+
+
+def test_limiter_releases_queued_requests_by_priority():
+    async def scenario():
+        limiter = main.ProviderRateLimiter(rate_per_minute=1200, burst=1)
+        await limiter.acquire(main.PRIORITY_DEFAULT)  # tek token harcanır, sonrakiler kuyruğa girer
+        order = []
+
+        async def acquire(priority):
+            await limiter.acquire(priority)
+            order.append(priority)
+
+        background = asyncio.create_task(acquire(main.PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        alerts = asyncio.create_task(acquire(main.PRIORITY_ALERTS))
+        await asyncio.gather(background, alerts)
+        return order, limiter.stats
+
+    order, stats = asyncio.run(scenario())
+    assert order == [main.PRIORITY_ALERTS, main.PRIORITY_BACKGROUND]
+    assert stats["queued"] == 2
+
+
+def test_concurrent_identical_requests_are_merged(fake_provider):
+    async def scenario():
+        fake_provider["install"]()
+        fake_provider["delay"] = 0.05
+        return await asyncio.gather(*(main.provider_get("finnhub", "/quote", params={"symbol": "AAPL"}) for _ in range(5)))
+
+    responses = asyncio.run(scenario())
+    assert [r.status_code for r in responses] == [200] * 5
+    assert len(fake_provider["requests"]) == 1
+    assert main._provider_limiters["finnhub"].stats["merged"] == 4
+    assert main._provider_inflight == {}
+
+
+def test_cancelling_the_leader_does_not_cancel_followers(fake_provider):
+    async def scenario():
+        fake_provider["install"]()
+        fake_provider["delay"] = 0.05
+        leader = asyncio.create_task(main.provider_get("finnhub", "/quote", params={"symbol": "AAPL"}))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(main.provider_get("finnhub", "/quote", params={"symbol": "AAPL"}))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        response = await follower
+        return leader, follower, response
+
+    leader, follower, response = asyncio.run(scenario())
+    assert leader.cancelled()
+    assert not follower.cancelled()
+    assert response.status_code == 200
+    assert len(fake_provider["requests"]) == 1
+    assert main._provider_inflight == {}
+
+
+def test_cancelled_leader_is_skipped_by_batch_fetchers(fake_provider, monkeypatch):
+    monkeypatch.setattr(main, "FINNHUB_API_KEY", "test")
+
+    async def scenario():
+        fake_provider["install"]()
+        fake_provider["delay"] = 0.05
+        leader = asyncio.create_task(main.fetch_nasdaq_batch({"AAPL"}))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(main.fetch_nasdaq_batch({"AAPL"}))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(scenario()) == {"AAPL": 1.0}
+
+
+def test_429_blocks_the_provider_for_retry_after_and_retries(fake_provider):
+    async def scenario():
+        fake_provider["install"]()
+        fake_provider["responses"].append(httpx.Response(429, headers={"Retry-After": "0.2"}))
+        started = time.monotonic()
+        response = await main.provider_get("finnhub", "/quote", params={"symbol": "AAPL"})
+        return response, time.monotonic() - started
+
+    response, elapsed = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert len(fake_provider["requests"]) == 2
+    assert elapsed >= 0.2
+    stats = main._provider_limiters["finnhub"].stats
+    assert stats["rate_limited"] == 1 and stats["retries"] == 1
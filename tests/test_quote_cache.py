@@ -0,0 +1,76 @@
+import asyncio
+
+import main
+
+
+def _counting_fetcher(calls, price=1.0, delay=0.05):
+    async def fetch(symbols):
+        calls.append(set(symbols))
+        await asyncio.sleep(delay)
+        return {sym: price for sym in symbols}
+    return fetch
+
+
+def test_concurrent_fetch_price_calls_share_one_upstream_call(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "quote_cache", main.QuoteCache({"NASDAQ": 30.0}, 300.0, 100))
+    monkeypatch.setitem(main.MARKET_FETCHERS, "NASDAQ", _counting_fetcher(calls, price=410.0))
+
+    async def scenario():
+        return await asyncio.gather(*(main.fetch_price("MSFT") for _ in range(100)))
+
+    assert asyncio.run(scenario()) == [410.0] * 100
+    assert calls == [{"MSFT"}]
+    assert main.quote_cache.stats["upstream_calls"] == 1
+    assert main.quote_cache.stats["coalesced"] == 99
+
+
+def test_cache_evicts_least_recently_used_entries():
+    cache = main.QuoteCache({"NASDAQ": 30.0}, 300.0, max_entries=2)
+    calls = []
+    fetch = _counting_fetcher(calls, delay=0)
+
+    async def scenario():
+        await cache.get_many("NASDAQ", ["AAPL"], fetch)
+        await cache.get_many("NASDAQ", ["MSFT"], fetch)
+        await cache.get_many("NASDAQ", ["AAPL"], fetch)  # AAPL en son kullanılan olur
+        await cache.get_many("NASDAQ", ["NVDA"], fetch)  # MSFT çıkarılır
+
+    asyncio.run(scenario())
+    assert [symbol for _, symbol in cache._entries] == ["AAPL", "NVDA"]
+    assert cache.stats["evictions"] == 1
+    assert calls == [{"AAPL"}, {"MSFT"}, {"NVDA"}]
+
+
+def test_expired_value_is_served_while_revalidating():
+    cache = main.QuoteCache({"NASDAQ": 30.0}, 300.0, 100)
+    calls = []
+    prices = {"AAPL": 1.0}
+
+    async def fetch(symbols):
+        calls.append(set(symbols))
+        await asyncio.sleep(0.05)
+        return {sym: prices[sym] for sym in symbols}
+
+    async def scenario():
+        await cache.get_many("NASDAQ", ["AAPL"], fetch)
+        price, fetched_at = cache._entries[("NASDAQ", "AAPL")]
+        cache._entries[("NASDAQ", "AAPL")] = (price, fetched_at - 60)
+        prices["AAPL"] = 2.0
+        # Süresi geçmiş değer beklemeden döner; yenileme arka planda başlar.
+        served = await asyncio.wait_for(cache.get_many("NASDAQ", ["AAPL"], fetch), timeout=0.01)
+        await asyncio.gather(*cache._tasks)
+        refreshed = await cache.get_many("NASDAQ", ["AAPL"], fetch)
+        # Azami bayatlık aşıldıysa eski değer sunulmaz, yeni çekim beklenir.
+        price, fetched_at = cache._entries[("NASDAQ", "AAPL")]
+        cache._entries[("NASDAQ", "AAPL")] = (price, fetched_at - 1000)
+        prices["AAPL"] = 3.0
+        too_old = await cache.get_many("NASDAQ", ["AAPL"], fetch)
+        return served, refreshed, too_old
+
+    served, refreshed, too_old = asyncio.run(scenario())
+    assert served == {"AAPL": 1.0}
+    assert refreshed == {"AAPL": 2.0}
+    assert too_old == {"AAPL": 3.0}
+    assert len(calls) == 3
+    assert cache.stats["stale_hits"] == 1
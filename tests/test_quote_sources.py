@@ -0,0 +1,80 @@
+import asyncio
+
+import main
+
+
+def _slow_source(calls, name, delay, price):
+    async def fetch(symbols):
+        calls.append(name)
+        await asyncio.sleep(delay)
+        return {sym: price for sym in symbols}
+    return fetch
+
+
+def test_single_source_chain_is_not_hedged_to_itself(monkeypatch):
+    calls = []
+    monkeypatch.setitem(main.QUOTE_SOURCES, "CRYPTO", {"binance": _slow_source(calls, "binance", 0.2, 1.0)})
+    monkeypatch.setitem(main.QUOTE_SOURCE_CHAINS, "CRYPTO", ["binance"])
+    monkeypatch.setattr(main, "QUOTE_HEDGE_DEFAULT_DELAY", 0.01)
+    monkeypatch.setattr(main, "_quote_source_health", {})
+
+    prices = asyncio.run(main.fetch_market_quotes("CRYPTO", {"BTCUSDT"}))
+
+    assert prices == {"BTCUSDT": 1.0}
+    assert calls == ["binance"]
+    assert main.quote_source_health("binance").stats["hedges"] == 0
+
+
+def test_slow_source_is_hedged_to_the_next_source_in_the_chain(monkeypatch):
+    calls = []
+    monkeypatch.setitem(main.QUOTE_SOURCES, "NASDAQ", {
+        "finnhub": _slow_source(calls, "finnhub", 1.0, 1.0),
+        "yahoo": _slow_source(calls, "yahoo", 0.0, 2.0),
+    })
+    monkeypatch.setitem(main.QUOTE_SOURCE_CHAINS, "NASDAQ", ["finnhub", "yahoo"])
+    monkeypatch.setattr(main, "QUOTE_HEDGE_DEFAULT_DELAY", 0.01)
+    monkeypatch.setattr(main, "_quote_source_health", {})
+
+    prices = asyncio.run(main.fetch_market_quotes("NASDAQ", {"AAPL"}))
+
+    assert prices == {"AAPL": 2.0}
+    assert calls == ["finnhub", "yahoo"]
+    assert main.quote_source_health("finnhub").stats["hedges"] == 1
+    assert main.quote_source_health("yahoo").stats["hedge_wins"] == 1
+
+
+def test_stale_flag_marks_only_values_kept_after_a_failed_fetch(monkeypatch):
+    cache = main.QuoteCache({"BIST": 30.0}, 300.0, 100)
+    monkeypatch.setattr(main, "quote_cache", cache)
+    monkeypatch.setattr(main, "BIST100_SYMBOLS", ["ASELS.IS", "GARAN.IS"])
+    upstream = {"healthy": True, "price": 1.0}
+
+    async def fetch(symbols):
+        if not upstream["healthy"]:
+            raise RuntimeError("kaynak erişilemez")
+        return {sym: upstream["price"] for sym in symbols}
+
+    monkeypatch.setitem(main.MARKET_FETCHERS, "BIST", fetch)
+
+    def expire_entries():
+        for key, (price, fetched_at) in list(cache._entries.items()):
+            cache._entries[key] = (price, fetched_at - 60)
+
+    async def scenario():
+        await main.get_bist_prices(allow_stale=False)
+        expire_entries()
+        # TTL'i geçmiş değer arka planda yenilenirken sunulur; bu bir hata değildir.
+        served_while_revalidating = await main.get_bist_prices()
+        await asyncio.gather(*cache._tasks)
+        expire_entries()
+        upstream["price"] = 2.0
+        healthy_refresh = await main.get_bist_prices(allow_stale=False)
+        expire_entries()
+        upstream["healthy"] = False
+        failed_refresh = await main.get_bist_prices(allow_stale=False)
+        return served_while_revalidating, healthy_refresh, failed_refresh
+
+    served, healthy, failed = asyncio.run(scenario())
+    assert [(item["price"], item["stale"]) for item in served] == [(1.0, False)] * 2
+    assert [(item["price"], item["stale"]) for item in healthy] == [(2.0, False)] * 2
+    assert [(item["price"], item["stale"]) for item in failed] == [(2.0, True)] * 2
@@ -0,0 +1,65 @@
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+import main
+
+
+def test_seeding_twice_does_not_conflict_on_the_unique_key(db):
+    # İkinci "worker" aynı satırları yazar; INSERT ... ON CONFLICT sayesinde hata almaz.
+    with Session(db) as first, Session(db) as second:
+        main.seed_symbol_catalog(first)
+        main.seed_symbol_catalog(second)
+        rows = second.exec(select(main.SymbolCatalog).where(main.SymbolCatalog.market == "NASDAQ")).all()
+    assert len(rows) == len(main.POPULAR_NASDAQ)
+
+
+def test_upsert_keeps_names_unless_refreshed_and_deactivates_missing(db):
+    with Session(db) as session:
+        rows = [{"symbol": "AAPL", "name": "Apple Inc", "provider_ticker": "AAPL"},
+                {"symbol": "MSFT", "name": "Microsoft", "provider_ticker": "MSFT"}]
+        main.upsert_symbol_catalog(session, "NASDAQ", rows, refreshed=True, deactivate_missing=True)
+        main.upsert_symbol_catalog(
+            session, "NASDAQ", [{"symbol": "AAPL", "name": "AAPL", "provider_ticker": "AAPL"}],
+            refreshed=False, deactivate_missing=True,
+        )
+        items = {item.symbol: item for item in session.exec(select(main.SymbolCatalog)).all()}
+    assert items["AAPL"].name == "Apple Inc" and items["AAPL"].active
+    assert not items["MSFT"].active
+
+
+def test_symbols_etag_follows_content(db):
+    with Session(db) as session:
+        main.seed_symbol_catalog(session)
+        main.load_symbol_catalog(session)
+    first = main.get_encoded_symbols("BIST", 50)["etag"]
+    with Session(db) as session:
+        main.load_symbol_catalog(session)
+    # Yeniden yükleme (ya da başka bir instance) aynı içerik için aynı ETag'i üretir.
+    assert main.get_encoded_symbols("BIST", 50)["etag"] == first
+    assert main.get_encoded_symbols("METALS", 50)["etag"] != first
+
+
+def test_empty_catalog_backs_off_after_a_failed_refresh(db, monkeypatch):
+    calls = []
+
+    async def failing_refresh():
+        calls.append("CRYPTO")
+        raise RuntimeError("Binance erişilemez")
+
+    monkeypatch.setitem(main.SYMBOL_CATALOG_REFRESHERS, "CRYPTO", failing_refresh)
+    monkeypatch.setitem(main._symbol_catalog, "CRYPTO", [])
+    monkeypatch.setattr(main, "_symbol_catalog_failed_at", {})
+    monkeypatch.setattr(main, "_async_locks", {})
+    client = TestClient(main.app)
+
+    first = client.get("/symbols_with_name", params={"market": "CRYPTO"})
+    second = client.get("/symbols_with_name", params={"market": "CRYPTO"})
+
+    assert first.status_code == second.status_code == 503
+    assert 1 <= int(second.headers["retry-after"]) <= main.SYMBOL_CATALOG_RETRY_SECONDS
+    # Bekleme süresi dolmadan upstream tekrar denenmez.
+    assert calls == ["CRYPTO"]
+
+    main._symbol_catalog_failed_at["CRYPTO"] -= main.SYMBOL_CATALOG_RETRY_SECONDS
+    client.get("/symbols_with_name", params={"market": "CRYPTO"})
+    assert calls == ["CRYPTO", "CRYPTO"]
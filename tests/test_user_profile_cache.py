@@ -0,0 +1,44 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_settings_edit_invalidates_the_cached_profile(db, monkeypatch):
+    monkeypatch.setattr(main, "user_profile_cache", main.UserProfileCache(ttl=300, max_entries=100))
+    client = TestClient(main.app)
+    client.post("/user/settings/u1", json={"notifications_enabled": True, "language_code": "en"})
+
+    assert asyncio.run(main.resolve_user_currency("u1")) == "USD"
+    assert asyncio.run(main.resolve_user_currency("u1")) == "USD"
+    assert main.user_profile_cache.stats["hits"] == 1
+
+    client.post("/user/settings/u1", json={"notifications_enabled": True, "language_code": "tr"})
+
+    # Düzenlemeden sonra TTL beklenmeden yeni para birimi okunur.
+    assert asyncio.run(main.resolve_user_currency("u1")) == "TRY"
+    assert main.user_profile_cache.stats["invalidations"] == 2
+
+
+def test_read_started_before_an_invalidation_is_not_cached():
+    cache = main.UserProfileCache(ttl=300, max_entries=100)
+    old = main.UserProfile("en", "USD", "free", True)
+    generation = cache.generation
+    # Okuma sürerken profil düzenlenir; okunan eski değer cache'e yazılmamalı.
+    cache.invalidate("u1")
+    cache.put("u1", old, generation)
+    assert cache.get("u1") == (False, None)
+
+    cache.put("u1", old, cache.generation)
+    assert cache.get("u1") == (True, old)
+
+
+def test_profile_cache_is_bounded_by_lru():
+    cache = main.UserProfileCache(ttl=300, max_entries=2)
+    for uid in ("a", "b"):
+        cache.put(uid, None, cache.generation)
+    cache.get("a")
+    cache.put("c", None, cache.generation)
+    assert list(cache._entries) == ["a", "c"]
+    assert cache.stats["evictions"] == 1
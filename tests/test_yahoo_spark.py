@@ -0,0 +1,98 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import main
+
+# Stub'ın bildiği fiyatlar. "NOCLOSE.IS" sadece kapanış dizisiyle döner, "MISSING.IS" hiç dönmez.
+STUB_PRICES = {f"T{i}.IS": 10.0 + i for i in range(45)}
+
+
+class _YahooStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append((url.path, self.headers.get("User-Agent")))
+        if url.path != "/v7/finance/spark" or not self.headers.get("User-Agent", "").startswith("Mozilla/"):
+            self.send_response(403)
+            self.end_headers()
+            return
+        result = []
+        for symbol in parse_qs(url.query)["symbols"][0].split(","):
+            if symbol in STUB_PRICES:
+                chart = {"meta": {"symbol": symbol, "regularMarketPrice": STUB_PRICES[symbol]}}
+            elif symbol == "NOCLOSE.IS":
+                chart = {"meta": {"symbol": symbol}, "indicators": {"quote": [{"close": [5.0, 5.5, None]}]}}
+            else:
+                continue
+            result.append({"symbol": symbol, "response": [chart]})
+        body = json.dumps({"spark": {"result": result, "error": None}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def yahoo_stub(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _YahooStubHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setitem(main.PROVIDER_CONFIG["yahoo"], "base_url", f"http://127.0.0.1:{server.server_port}")
+    main._http_clients.pop("yahoo", None)
+    monkeypatch.setattr(main, "_quote_source_health", {})
+    yield server
+    server.shutdown()
+    server.server_close()
+    main._http_clients.pop("yahoo", None)
+
+
+async def _with_clients(coro):
+    try:
+        return await coro
+    finally:
+        await main.close_http_clients()
+
+
+def test_spark_batches_tickers_and_falls_back_to_yfinance(yahoo_stub, monkeypatch):
+    fallback_calls = []
+
+    async def yf_last_closes(tickers):
+        fallback_calls.append(list(tickers))
+        return {ticker: 1.0 for ticker in tickers}
+
+    monkeypatch.setattr(main, "yf_last_closes", yf_last_closes)
+    tickers = list(STUB_PRICES) + ["NOCLOSE.IS", "MISSING.IS"]
+
+    closes = asyncio.run(_with_clients(main.yahoo_last_closes(tickers)))
+
+    # 47 ticker, 20'lik gruplar halinde 3 istekte çekilir.
+    assert len(yahoo_stub.requests) == 3
+    assert all(path == "/v7/finance/spark" for path, _ in yahoo_stub.requests)
+    assert all(agent == "Mozilla/5.0" for _, agent in yahoo_stub.requests)
+    assert closes["T0.IS"] == 10.0 and closes["T44.IS"] == 54.0
+    assert closes["NOCLOSE.IS"] == 5.5
+    # Yahoo'nun döndürmediği ticker yfinance'tan tamamlanır.
+    assert fallback_calls == [["MISSING.IS"]]
+    assert closes["MISSING.IS"] == 1.0
+
+
+def test_bist_yahoo_source_reads_prices_from_the_stub(yahoo_stub):
+    prices = asyncio.run(_with_clients(main.fetch_bist_yahoo_batch({"T1", "T2"})))
+
+    assert prices == {"T1": 11.0, "T2": 12.0}
+    assert len(yahoo_stub.requests) == 1
+
+
+def test_parse_spark_accepts_the_legacy_format():
+    payload = {"AAPL": {"symbol": "AAPL", "close": [1.0, None, 2.5]}, "MSFT": {"close": []}}
+
+    assert main.parse_yahoo_spark_prices(payload) == {"AAPL": 2.5}